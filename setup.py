@@ -22,5 +22,10 @@ setup(
     author_email='gwas-info@ebi.ac.uk',
     install_requires=['pandas_schema>=0.3.4',
                   'tqdm>=4.48.2'
-                 ]
+                 ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        's3': ['boto3'],
+        'jit': ['numba']
+    }
 )
@@ -0,0 +1,149 @@
+import os
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""
+Typed Parquet and Arrow IPC copies of the validated rows.
+
+Each column is given the type of the dtype of its field in the schema, so
+the table can be loaded without parsing or type inference. Columns that are
+not in the schema are kept as strings, and so is p_value, because p-values
+can be smaller than the smallest float64 and would be written as 0.
+Parquet files are written in row groups of `row_group_size` rows, with
+column statistics, and can be partitioned by chromosome into a directory of
+<column>=<value>/part-0.parquet files as read by pyarrow.dataset, pandas and
+Spark.
+
+Rows past the error limit aren't validated, so a value may still not fit the
+type of its column (e.g. "abc" or 1.5 for an integer). Such rows are left out
+of the table and counted in `dropped`.
+"""
+
+
+ROW_GROUP_SIZE = 1024 * 1024
+TEXT_FIELDS = ['PVAL']
+ARROW_TYPES = {float: 'float64', int: 'int64', str: 'string'}
+
+
+class TypedTableWriter:
+    def __init__(self, path, columns, schema, format='parquet', partition_col=None, row_group_size=ROW_GROUP_SIZE):
+        """
+        :param path: the file to write, or the directory if partitioned
+        :param columns: the column labels of the rows that will be added
+        :param schema: the validation schema, for the dtype of each field
+        :param format: 'parquet' or 'arrow' (the Arrow IPC file format)
+        :param partition_col: label of a column to partition a parquet table by
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required to write the validated rows as {}".format(format))
+        if partition_col and format != 'parquet':
+            raise ValueError("Only parquet tables can be partitioned")
+        self.path = path
+        self.format = format
+        self.partition_col = partition_col
+        self.row_group_size = row_group_size
+        self.arrow_schema = arrow_schema(columns, schema)
+        if partition_col:
+            self.arrow_schema = self.arrow_schema.remove(self.arrow_schema.get_field_index(partition_col))
+        self.writers = {}
+        self.pending = {}
+        """partition -> tables waiting to fill a row group"""
+        self.dropped = 0
+        # partitions of an earlier table would otherwise be read with this one
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def add(self, df):
+        """
+        :param df: validated rows, as strings
+        """
+        if df.empty:
+            return
+        if not self.partition_col:
+            self.buffer(None, self.typed_table(df))
+            return
+        for value, rows in df.groupby(self.partition_col, sort=False):
+            self.buffer(value, self.typed_table(rows.drop(columns=self.partition_col)))
+
+    def typed_table(self, df):
+        table = typed_table(df, self.arrow_schema)
+        self.dropped += len(df) - table.num_rows
+        return table
+
+    def buffer(self, partition, table):
+        pending = self.pending.setdefault(partition, [])
+        pending.append(table)
+        if sum(t.num_rows for t in pending) >= self.row_group_size:
+            self.flush(partition)
+
+    def flush(self, partition):
+        table = pa.concat_tables(self.pending.pop(partition, []))
+        if table.num_rows:
+            self.writer(partition).write_table(table, **({'row_group_size': self.row_group_size}
+                                                         if self.format == 'parquet' else {}))
+
+    def writer(self, partition):
+        if partition not in self.writers:
+            if self.format == 'arrow':
+                self.writers[partition] = pa.ipc.new_file(self.path, self.arrow_schema)
+            elif self.partition_col:
+                directory = os.path.join(self.path, '{}={}'.format(self.partition_col, partition))
+                os.makedirs(directory, exist_ok=True)
+                self.writers[partition] = pq.ParquetWriter(os.path.join(directory, 'part-0.parquet'), self.arrow_schema)
+            else:
+                self.writers[partition] = pq.ParquetWriter(self.path, self.arrow_schema)
+        return self.writers[partition]
+
+    def close(self):
+        for partition in list(self.pending):
+            self.flush(partition)
+        if not self.writers and not self.partition_col:
+            # a table without rows still has its columns
+            self.writer(None)
+        for writer in self.writers.values():
+            writer.close()
+        return self.path
+
+
+def arrow_schema(columns, schema):
+    fields = {field['label']: (field_id, field.get('dtype', str)) for field_id, field in schema['fields'].items()}
+    types = []
+    for column in columns:
+        field_id, dtype = fields.get(column, (None, str))
+        arrow_type = 'string' if field_id in TEXT_FIELDS else ARROW_TYPES.get(dtype, 'string')
+        types.append(pa.field(column, pa.type_for_alias(arrow_type)))
+    return pa.schema(types)
+
+
+def typed_table(df, arrow_schema):
+    """
+    The rows of df, converted from strings to the types of the columns in
+    arrow_schema, without the rows with a value that can't be converted.
+    """
+    columns = {}
+    valid = pd.Series(True, index=df.index)
+    for field in arrow_schema:
+        values = df[field.name]
+        if not pa.types.is_string(field.type):
+            numbers = pd.to_numeric(values, errors='coerce')
+            valid &= numbers.notna() | values.isna()
+            if pa.types.is_integer(field.type):
+                valid &= numbers.isna() | (numbers == numbers.round())
+            values = numbers
+        columns[field.name] = values
+    arrays = []
+    for field in arrow_schema:
+        values = columns[field.name][valid]
+        if pa.types.is_integer(field.type):
+            values = values.astype('Int64')
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
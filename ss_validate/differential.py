@@ -0,0 +1,418 @@
+import os
+import sys
+import gzip
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import functools
+import threading
+import contextlib
+from collections import OrderedDict, namedtuple
+
+import pandas as pd
+from pandas_schema import Schema, Column
+from pandas_schema.validation import MatchesPatternValidation
+
+from ss_validate.schema import SCHEMA
+from ss_validate.helpers import is_dtype, is_data_line, p_value_validation_allow_zero
+from ss_validate.gzindex import BgzfWriter
+from ss_validate.sharded import Coordinator, run_worker
+from ss_validate.validator import Validator, shard_validator
+
+"""
+Differential testing of the ways that Validator can validate a file.
+
+Every engine must give the same verdict, rows with errors and error messages
+as the reference, which doesn't use Validator at all: a pandas_schema Schema
+built straight from SCHEMA, with the stock validations, applied to each chunk
+of rows as pandas reads them. The plain Validator, without the compiled
+kernels or the pipeline threads, is one of the engines compared to it. Files of adversarial rows are
+generated from a seed: edge-case numbers (1e-400, zero, -0, inf, NaN, hex),
+odd alleles and chromosomes, empty and NA cells, comment and blank lines,
+CRLF line endings and rows with too few or too many fields. Each file is
+validated plain and BGZF compressed, with and without zero_pvalues, by every
+engine, and any difference from the reference is reported along with the
+throughput of each engine.
+
+New engines are added with @engine(name) and take (file, zero_pvalues, workdir).
+
+    python -m ss_validate.differential --rows 5000 --seeds 0 1 2
+"""
+
+
+Verdict = namedtuple('Verdict', ['valid', 'nrows', 'ragged', 'rows_to_drop', 'errors'])
+Divergence = namedtuple('Divergence', ['dataset', 'engine', 'field', 'reference', 'found'])
+
+ENGINES = OrderedDict()
+REFERENCE = 'reference'
+
+COLUMNS = ['chromosome', 'base_pair_location', 'effect_allele', 'other_allele', 'beta', 'standard_error',
+           'effect_allele_frequency', 'p_value', 'variant_id', 'rsid', 'ci_lower', 'ci_upper', 'n', 'info']
+FLOAT_EDGES = ['0', '-0', '0.0', '1', '-1', '1.0', '.5', '5.', '+0.5', '1e-400', '1E-400', '5e-324', '1e308',
+               '1e309', '-1e309', 'inf', '-inf', 'Infinity', 'nan', 'NaN', 'NA', '', '1e', 'e-5', '0x1p-3',
+               '1_000', ' 0.5', '0.5 ', '1,5', '--1', '0.99999999999999999', '1.0000000000000001', '١']
+PVALUE_EDGES = ['0', '0.0', '-0', '0e0', '0e-5', '0.0e-400', '1', '1.0', '1e0', '1e+0', '10e-2', '1e-1', '1e-400',
+                '1E-400', '9.9e-1000', '1.5e-400', '-1e-400', '0.5e-1', '2', '1.0000001', '5e-324', 'e-5',
+                '1e-', '1e-400e', 'NA', '', 'nan', 'inf']
+INT_EDGES = ['0', '1', '-1', '999999999', '1000000000', '1.0', '1e3', '01', '+5', '9223372036854775808', 'NA', '']
+CHR_EDGES = ['0', '1', '22', '23', '25', '26', 'X', 'chr1', '01', ' 1', '1.0', 'NA', '']
+ALLELE_EDGES = ['A', 'a', 'N', '-', 'I', 'D', 'ACGTN', 'acgt', 'LONG_STRING', 'long_string', 'AT G', 'Å',
+                'NA', '']
+RSID_EDGES = ['rs1', 'RS1', 'rs', 'rs12a', '.', 'NA', '']
+
+
+def engine(name):
+    """
+    Register an engine: a function of (file, zero_pvalues, workdir) returning a Verdict.
+    """
+    def register(function):
+        ENGINES[name] = function
+        return function
+    return register
+
+
+def verdict(validator, valid):
+    return Verdict(valid=valid,
+                   nrows=validator.nrows,
+                   ragged=[tuple(int(x) for x in line) for line in validator.get_row_index().ragged_lines()],
+                   rows_to_drop=sorted(int(row) for row in validator.rows_to_drop),
+                   errors=[(int(e.row), e.column, str(e.value), str(e.message)) for e in validator.errors])
+
+
+def run_validator(validator):
+    try:
+        validator.validate_file_squareness()
+        return verdict(validator, validator.validate_data())
+    finally:
+        validator.close()
+
+
+@contextlib.contextmanager
+def validator_logging():
+    """
+    Keep what the engines log out of the output.
+    """
+    package_logger = logging.getLogger('ss_validate')
+    level = package_logger.level
+    package_logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        package_logger.setLevel(level)
+
+
+def new_validator(file, workdir, **kwargs):
+    return Validator(file, logfile=os.path.join(workdir, 'differential.log'), dropbad=True, **kwargs)
+
+
+def reference_schema(header, zero_pvalues):
+    """
+    The Schema of SCHEMA for the columns of header, in their order, with the stock
+    pandas_schema validations in place of those that remember the values they have seen.
+    """
+    fields = {field['label']: (field_id, field) for field_id, field in SCHEMA['fields'].items()}
+    columns = []
+    for label in header:
+        if label not in fields:
+            continue
+        field_id, field = fields[label]
+        validations = field['validation']
+        if zero_pvalues and field_id == 'PVAL':
+            validations = [is_dtype(float), p_value_validation_allow_zero]
+        validations = [MatchesPatternValidation(v.pattern, v.options) if isinstance(v, MatchesPatternValidation)
+                       else v for v in validations]
+        columns.append(Column(field['label'], validations, allow_empty=not field['mandatory']))
+    return Schema(columns)
+
+
+def physical_lines(file):
+    with (gzip.open(file, 'rb') if file.endswith('.gz') else open(file, 'rb')) as f:
+        yield from f
+
+
+@engine(REFERENCE)
+def reference_engine(file, zero_pvalues, workdir, chunksize=100000):
+    """
+    Each chunk validated by pandas_schema on its own, with the dummy row
+    that gives the p-value validation a value in scientific notation, as
+    the validator did before it had any other engines.
+    """
+    nrows, ragged, header = 0, [], None
+    for line_number, text in enumerate(physical_lines(file), start=1):
+        if not is_data_line(text):
+            continue
+        nfields = len(text.rstrip(b'\n').rstrip(b'\r').split(b'\t'))
+        if header is None:
+            header = nfields
+            continue
+        if nfields != header:
+            ragged.append((line_number, nfields))
+        nrows += 1
+    header = pd.read_csv(file, sep='\t', comment='#', nrows=1, index_col=False).columns.tolist()
+    labels = [field['label'] for field in SCHEMA['fields'].values()]
+    to_validate = [label for label in header if label in labels]
+    schema = reference_schema(to_validate, zero_pvalues)
+    p_value = SCHEMA['fields']['PVAL']['label']
+    errors = []
+    for chunk in pd.read_csv(file, sep='\t', dtype=str, comment='#', header=0, names=header,
+                             usecols=range(len(header)), index_col=False, chunksize=chunksize):
+        df = chunk[to_validate].append(pd.Series({p_value: '1000e1000'}, name=-99), ignore_index=False)
+        errors.extend(error for error in schema.validate(df) if error.row != -99)
+    return Verdict(valid=not errors,
+                   nrows=nrows,
+                   ragged=ragged,
+                   rows_to_drop=sorted({int(error.row) for error in errors}),
+                   errors=[(int(e.row), e.column, str(e.value), str(e.message)) for e in errors])
+
+
+@engine('plain')
+def plain_engine(file, zero_pvalues, workdir):
+    """The Validator without the compiled kernels or the pipeline threads."""
+    return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, jit=False, pipeline_depth=0))
+
+
+@engine('jit')
+def jit_engine(file, zero_pvalues, workdir):
+    """The compiled kernels, or the plain Validator again if Numba isn't installed."""
+    return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, jit=True))
+
+
+@engine('small_chunks')
+def small_chunks_engine(file, zero_pvalues, workdir):
+    return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, chunksize=97))
+
+
+@engine('pipelined')
+def pipelined_engine(file, zero_pvalues, workdir):
+    """Small chunks read and parsed well ahead of the validation by the pipeline threads."""
+    return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, chunksize=97, pipeline_depth=8))
+
+
+@engine('incremental')
+def incremental_engine(file, zero_pvalues, workdir):
+    """The second of two runs, which reuses the stored errors of every chunk."""
+    for _ in range(2):
+        result = run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, chunksize=97,
+                                             incremental=True))
+    os.remove(file + '.state.json')
+    return result
+
+
+@engine('memory_governed')
+def memory_governed_engine(file, zero_pvalues, workdir):
+    """Under constant memory pressure, so the errors are spilled and the chunks shrink."""
+    validator = new_validator(file, workdir, zero_pvalues=zero_pvalues, chunksize=800, memory_budget=1000)
+    validator.governor.min_chunk_rows = 101
+    validator.governor.measure = lambda: 900
+    return run_validator(validator)
+
+
+@engine('sharded')
+def sharded_engine(file, zero_pvalues, workdir):
+    coordinator = Coordinator(file, shard_size=4096)
+    make_validator = functools.partial(shard_validator, logfile=os.path.join(workdir, 'differential.log'))
+    workers = [threading.Thread(target=run_worker, args=(coordinator.url, make_validator, coordinator.token),
+                                daemon=True)
+               for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    try:
+        return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, coordinator=coordinator))
+    finally:
+        coordinator.close()
+        for worker in workers:
+            worker.join()
+
+
+@engine('partitioned')
+def partitioned_engine(file, zero_pvalues, workdir):
+    """The rows of each chromosome validated by one of two worker processes."""
+    return run_validator(new_validator(file, workdir, zero_pvalues=zero_pvalues, chunksize=500,
+                                       split_by_chromosome=True, processes=2))
+
+
+def adversarial_lines(nrows, seed, edge_rate=0.2):
+    """
+    A header and nrows rows of tab separated values, most of them valid, with
+    edge cases at edge_rate, and some comment lines, blank lines, CRLF line
+    endings and ragged rows.
+    """
+    rng = random.Random(seed)
+
+    def pick(valid, edges):
+        return rng.choice(edges) if rng.random() < edge_rate else valid()
+
+    def float_value():
+        return pick(lambda: rng.choice(['{:.5f}', '{:.3e}', '{:.3E}', '{}']).format(rng.gauss(0, 1)), FLOAT_EDGES)
+
+    def positive_value():
+        return pick(lambda: '{:.4g}'.format(rng.uniform(0, 2)), FLOAT_EDGES)
+
+    def allele():
+        return pick(lambda: ''.join(rng.choice('ACGT') for _ in range(rng.choice([1, 1, 1, 2, 5]))), ALLELE_EDGES)
+
+    lines = ['\t'.join(COLUMNS) + '\n']
+    for _ in range(nrows):
+        chromosome = pick(lambda: str(rng.randint(1, 25)), CHR_EDGES)
+        position = pick(lambda: str(rng.randint(1, 250000000)), INT_EDGES)
+        effect, other = allele(), allele()
+        if rng.random() < 0.7:
+            variant_id = '{}_{}_{}_{}'.format(chromosome, position, other, effect)
+        else:
+            variant_id = pick(lambda: '1_1_A_G', ['1_1_A', 'X_1_A_G', '1_1_a_g', '', 'NA'])
+        row = [chromosome,
+               position,
+               effect,
+               other,
+               float_value(),
+               positive_value(),
+               pick(lambda: '{:.4f}'.format(rng.random()), FLOAT_EDGES),
+               pick(lambda: rng.choice(['{:.4g}', '{:.3e}', '{:.3E}']).format(10 ** -rng.uniform(0, 400)),
+                    PVALUE_EDGES),
+               variant_id,
+               pick(lambda: 'rs{}'.format(rng.randint(1, 10 ** 9)), RSID_EDGES),
+               float_value(),
+               float_value(),
+               pick(lambda: str(rng.randint(0, 500000)), INT_EDGES),
+               positive_value()]
+        if rng.random() < 0.005:
+            del row[rng.randrange(len(row))]
+        elif rng.random() < 0.005:
+            row.append('extra')
+        if rng.random() < 0.005:
+            lines.append('# a comment\n')
+        if rng.random() < 0.002:
+            lines.append('\n')
+        lines.append('\t'.join(row) + ('\r\n' if rng.random() < 0.01 else '\n'))
+    return lines
+
+
+def write_datasets(directory, nrows, seed):
+    """
+    Write the adversarial rows of a seed, plain and BGZF compressed.
+
+    :return: paths of the files
+    """
+    data = ''.join(adversarial_lines(nrows, seed)).encode()
+    plain = os.path.join(directory, 'adversarial_{}.tsv'.format(seed))
+    with open(plain, 'wb') as f:
+        f.write(data)
+    with BgzfWriter(plain + '.gz') as out:
+        out.write(data)
+    return [plain, plain + '.gz']
+
+
+def compare(reference, found):
+    """
+    The fields of two verdicts that differ, with the first difference in each.
+    """
+    differences = []
+    for field in Verdict._fields:
+        expected, actual = getattr(reference, field), getattr(found, field)
+        if expected == actual:
+            continue
+        if isinstance(expected, list):
+            first = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+            expected = expected[first] if first < len(expected) else 'nothing more ({} items)'.format(len(expected))
+            actual = actual[first] if first < len(actual) else 'nothing more ({} items)'.format(len(actual))
+        differences.append((field, expected, actual))
+    return differences
+
+
+class DifferentialReport:
+    def __init__(self):
+        self.divergences = []
+        self.rows = OrderedDict()
+        """engine -> rows validated"""
+        self.seconds = OrderedDict()
+        """engine -> seconds taken"""
+        self.failures = []
+        """(dataset, engine, exception)"""
+
+    @property
+    def ok(self):
+        return not self.divergences and not self.failures
+
+    def throughput(self, engine):
+        return self.rows[engine] / self.seconds[engine] if self.seconds[engine] else float('inf')
+
+    def format(self):
+        lines = ['{:<20}{:>12}{:>12}{:>14}'.format('engine', 'rows', 'seconds', 'rows/second')]
+        for name in self.rows:
+            lines.append('{:<20}{:>12}{:>12.2f}{:>14.0f}'.format(name, self.rows[name], self.seconds[name],
+                                                                self.throughput(name)))
+        for dataset, name, error in self.failures:
+            lines.append('FAILED {} on {}: {!r}'.format(name, dataset, error))
+        for d in self.divergences:
+            lines.append('DIVERGED {} on {}: {} is {!r}, the reference has {!r}'.format(
+                d.engine, d.dataset, d.field, d.found, d.reference))
+        lines.append('All engines agree with the reference' if self.ok else
+                     '{} divergences, {} failures'.format(len(self.divergences), len(self.failures)))
+        return '\n'.join(lines)
+
+
+def run_harness(nrows=2000, seeds=(0,), engines=None, zero_pvalues=(False, True), workdir=None):
+    """
+    Validate the adversarial files of each seed with every engine and compare them to the
+    reference. The reference of the compressed file is also compared to that of the plain file.
+
+    :param engines: names of the engines to compare, defaults to all of them
+    :return: DifferentialReport
+    """
+    names = [name for name in (engines or ENGINES) if name != REFERENCE]
+    report = DifferentialReport()
+    for name in [REFERENCE] + names:
+        report.rows[name] = 0
+        report.seconds[name] = 0.0
+    directory = workdir or tempfile.mkdtemp(prefix='ss_validate_differential_')
+    try:
+        with validator_logging():
+            for seed in seeds:
+                plain = {}
+                for file in write_datasets(directory, nrows, seed):
+                    for zero in zero_pvalues:
+                        dataset = '{} zero_pvalues={}'.format(os.path.basename(file), zero)
+                        expected = None
+                        for name in [REFERENCE] + names:
+                            start = time.time()
+                            try:
+                                found = ENGINES[name](file, zero, directory)
+                            except Exception as e:
+                                report.failures.append((dataset, name, e))
+                                continue
+                            report.seconds[name] += time.time() - start
+                            report.rows[name] += found.nrows
+                            if name == REFERENCE:
+                                expected = found
+                                if zero in plain:
+                                    report.divergences.extend(Divergence(dataset, name, *difference)
+                                                              for difference in compare(plain[zero], found))
+                                plain.setdefault(zero, found)
+                            elif expected is not None:
+                                report.divergences.extend(Divergence(dataset, name, *difference)
+                                                          for difference in compare(expected, found))
+                            if expected is None:
+                                break
+    finally:
+        if workdir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return report
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Compare the validation engines on adversarial files')
+    argparser.add_argument("--rows", help='Rows in each file', type=int, default=2000)
+    argparser.add_argument("--seeds", help='Seeds of the files to generate', type=int, nargs='+', default=[0])
+    argparser.add_argument("--engines", help='Engines to compare, defaults to all of: {}'.format(', '.join(ENGINES)),
+                           nargs='+', choices=list(ENGINES))
+    args = argparser.parse_args()
+    report = run_harness(args.rows, args.seeds, args.engines)
+    print(report.format())
+    sys.exit(0 if report.ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pandas_schema.validation_warning import ValidationWarning
+
+"""
+Duplicate variant detection during the streaming validation.
+
+The key of every row (e.g. chromosome, base_pair_location, effect_allele and
+other_allele) is packed into two 64 bit hashes. The keys seen so far are kept
+as a few sorted runs of (hash, hash, row) that each chunk is looked up in
+with a binary search. Runs are merged as they accumulate, and when they take
+more memory than the budget they are written to disk and memory mapped, so
+memory use stays bounded however many rows the file has. The runs on disk
+are merged in turn, MAX_DISK_RUNS of the same size at a time and a block of
+each at a time, so a chunk is looked up in a number of runs that grows with
+the logarithm of the number of spills rather than with the spills.
+"""
+
+
+HASH_KEYS = ('ss_validate_dup1', 'ss_validate_dup2')
+MAX_MEMORY_RUNS = 8
+MAX_DISK_RUNS = 8
+MIN_MERGE_BLOCK = 4096
+"""keys read from each run at a time when the runs on disk are merged, at least"""
+
+
+class DuplicateCheck:
+    def __init__(self, columns, memory_budget=256, spill_dir=None):
+        """
+        :param columns: labels of the columns that together identify a variant
+        :param memory_budget: MB of keys to hold in memory before spilling them to disk
+        :param spill_dir: where to write the spilled keys, defaults to the system temp dir
+        """
+        self.columns = list(columns)
+        self.label = '+'.join(self.columns)
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.spill_dir = spill_dir
+        self._tmpdir = None
+        self.memory_runs = []
+        self.disk_runs = []
+        self.disk_levels = []
+        """the number of merges each run on disk has been through"""
+        self.nspills = 0
+
+    def get_errors(self, df):
+        """
+        Errors for the rows of a chunk whose key has been seen before,
+        either earlier in the file or earlier in the chunk.
+        """
+        keys = df[self.columns]
+        keys = keys[keys.notna().all(axis=1).values]
+        if keys.empty:
+            return []
+        run = sort_run(pd.util.hash_pandas_object(keys, index=False, hash_key=HASH_KEYS[0]).values,
+                       pd.util.hash_pandas_object(keys, index=False, hash_key=HASH_KEYS[1]).values,
+                       keys.index.values.astype(np.int64))
+        h1, h2, rows = run
+
+        first_rows = np.full(len(rows), -1, dtype=np.int64)
+        for seen in self.memory_runs + self.disk_runs:
+            missing = np.flatnonzero(first_rows < 0)
+            first_rows[missing] = lookup(seen, h1[missing], h2[missing])
+        # a duplicate within the chunk is a duplicate of the first row with its key
+        same_as_previous = np.zeros(len(rows), dtype=bool)
+        same_as_previous[1:] = (h1[1:] == h1[:-1]) & (h2[1:] == h2[:-1])
+        group_start = np.maximum.accumulate(np.where(same_as_previous, 0, np.arange(len(rows))))
+        within = same_as_previous & (first_rows < 0)
+        first_rows[within] = np.where(first_rows[group_start[within]] >= 0,
+                                      first_rows[group_start[within]],
+                                      rows[group_start[within]])
+
+        duplicate = first_rows >= 0
+        self.add_run(tuple(a[~duplicate] for a in run))
+        if not duplicate.any():
+            return []
+        order = np.argsort(rows[duplicate], kind='stable')
+        duplicate_rows = rows[duplicate][order]
+        values = keys.loc[duplicate_rows].astype(str)
+        values = values.iloc[:, 0].str.cat(values.iloc[:, 1:], sep=':').tolist()
+        errors = []
+        for row, first_row, value in zip(duplicate_rows.tolist(), first_rows[duplicate][order].tolist(), values):
+            error = ValidationWarning(message='is a duplicate of row {}'.format(first_row),
+                                      value=value,
+                                      row=row,
+                                      column=self.label)
+            error.rule = 'duplicate'
+            errors.append(error)
+        return errors
+
+    def add_run(self, run):
+        if not len(run[0]):
+            return
+        self.memory_runs.append(run)
+        if len(self.memory_runs) > MAX_MEMORY_RUNS:
+            self.memory_runs = [merge_runs(self.memory_runs)]
+        if sum(a.nbytes for run in self.memory_runs for a in run) > self.memory_budget:
+            self.spill_memory_runs()
+
+    def spill_memory_runs(self):
+        if self.memory_runs:
+            self.spill(merge_runs(self.memory_runs))
+            self.memory_runs = []
+
+    def spill(self, run):
+        paths = self.run_paths()
+        for path, a in zip(paths, run):
+            np.save(path, a)
+        self.disk_runs.append(load_run(paths))
+        self.disk_levels.append(0)
+        # like the memory runs, the runs on disk are merged once there are too many of them
+        while len(self.disk_levels) >= MAX_DISK_RUNS and len(set(self.disk_levels[-MAX_DISK_RUNS:])) == 1:
+            level = self.disk_levels[-1]
+            runs = self.disk_runs[-MAX_DISK_RUNS:]
+            del self.disk_runs[-MAX_DISK_RUNS:], self.disk_levels[-MAX_DISK_RUNS:]
+            paths = self.run_paths()
+            block = max(MIN_MERGE_BLOCK, self.memory_budget // (2 * len(runs) * sum(a.itemsize for a in runs[0])))
+            merge_disk_runs(runs, paths, block)
+            for old in runs:
+                for a in old:
+                    os.remove(a.filename)
+            self.disk_runs.append(load_run(paths))
+            self.disk_levels.append(level + 1)
+
+    def run_paths(self):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='ss_validate_dups_', dir=self.spill_dir)
+        self.nspills += 1
+        return [os.path.join(self._tmpdir, '{}{}.npy'.format(name, self.nspills)) for name in ['h1', 'h2', 'row']]
+
+    def finish(self):
+        self.memory_runs = []
+        self.disk_runs = []
+        self.disk_levels = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        return []
+
+
+def sort_run(h1, h2, rows):
+    """
+    A run is a tuple of (first hash, second hash, row) arrays sorted by key and then row.
+    """
+    order = np.lexsort((rows, h2, h1))
+    return h1[order], h2[order], rows[order]
+
+
+def merge_runs(runs):
+    return sort_run(*(np.concatenate(arrays) for arrays in zip(*runs)))
+
+
+def load_run(paths):
+    return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+
+def merge_disk_runs(runs, paths, block):
+    """
+    Merge runs into one written to paths, reading `block` keys of each run at
+    a time. Each step merges the blocks and writes out the keys up to the
+    smallest last key of a block whose run has more after it, as no key still
+    to be read can come before them.
+    """
+    total = sum(len(run[0]) for run in runs)
+    merged = [np.lib.format.open_memmap(path, mode='w+', dtype=a.dtype, shape=(total,))
+              for path, a in zip(paths, runs[0])]
+    starts = np.zeros(len(runs), dtype=np.int64)
+    written = 0
+    while written < total:
+        blocks = [tuple(np.asarray(a[start:start + block]) for a in run) for run, start in zip(runs, starts)]
+        sources = np.repeat(np.arange(len(runs)), [len(b[0]) for b in blocks])
+        h1, h2, rows = (np.concatenate(arrays) for arrays in zip(*blocks))
+        order = np.lexsort((rows, h2, h1))
+        h1, h2, rows, sources = h1[order], h2[order], rows[order], sources[order]
+        unfinished = [b for b, run, start in zip(blocks, runs, starts) if start + len(b[0]) < len(run[0])]
+        if unfinished:
+            last = min((b[0][-1], b[1][-1], b[2][-1]) for b in unfinished)
+            ready = (h1 < last[0]) | ((h1 == last[0]) & ((h2 < last[1]) | ((h2 == last[1]) & (rows <= last[2]))))
+            n = int(ready.sum())
+        else:
+            n = len(h1)
+        for out, a in zip(merged, (h1, h2, rows)):
+            out[written:written + n] = a[:n]
+        starts += np.bincount(sources[:n], minlength=len(runs))
+        written += n
+    for out in merged:
+        out.flush()
+    del merged
+
+
+def lookup(seen, h1, h2):
+    """
+    The row in the run `seen` with each of the keys (h1, h2), or -1.
+    """
+    seen_h1, seen_h2, seen_rows = seen
+    first_rows = np.full(len(h1), -1, dtype=np.int64)
+    if len(seen_h1) == 0 or len(h1) == 0:
+        return first_rows
+    start = np.searchsorted(seen_h1, h1, side='left')
+    end = np.searchsorted(seen_h1, h1, side='right')
+    single = np.flatnonzero((end - start) == 1)
+    matched = single[seen_h2[start[single]] == h2[single]]
+    first_rows[matched] = seen_rows[start[matched]]
+    # keys sharing the first hash are told apart by the second, one by one
+    for i in np.flatnonzero((end - start) > 1):
+        same = np.flatnonzero(seen_h2[start[i]:end[i]] == h2[i])
+        if len(same):
+            first_rows[i] = seen_rows[start[i] + same[0]]
+    return first_rows
+
+
+def duplicate_checks(header, schema, memory_budget=256, spill_dir=None):
+    """
+    A DuplicateCheck for each of the schema's duplicate keys whose columns are all in the header.
+    """
+    checks = []
+    for field_ids in schema.get('duplicate_keys', []):
+        columns = [schema['fields'][field_id]['label'] for field_id in field_ids]
+        if all(column in header for column in columns):
+            checks.append(DuplicateCheck(columns, memory_budget, spill_dir))
+    return checks
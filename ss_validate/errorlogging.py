@@ -0,0 +1,90 @@
+import queue
+import threading
+from collections import Counter
+
+"""
+Logging the errors of a validation off the thread that validates.
+
+Validator hands the errors it reports from each chunk to an ErrorLogger,
+which puts them on a queue as they are. A background thread formats them and
+logs them, one record per error, so that each error is a line of the log. The queue holds at most
+QUEUE_CHUNKS lists of errors, so a validation that finds errors faster than
+they can be written waits for the thread rather than holding them all in
+memory. Given a limit of `per_rule`, only the first `per_rule` errors of each
+(column, rule) are logged; the rest are counted, and when the logger is
+flushed each rule that had more logs e.g. "...and 48,213 more
+base_pair_location in_range errors".
+"""
+
+
+QUEUE_CHUNKS = 64
+
+
+class ErrorLogger:
+    def __init__(self, target, per_rule=None, queue_chunks=QUEUE_CHUNKS):
+        """
+        :param target: the logger to log the errors to
+        :param per_rule: errors to log for each (column, rule), or None to log all of them
+        :param queue_chunks: the most lists of errors waiting to be logged
+        """
+        self.target = target
+        self.per_rule = per_rule
+        self.counts = Counter()
+        """(column, rule) -> errors seen"""
+        self.queue = queue.Queue(maxsize=queue_chunks)
+        self.thread = None
+
+    def log(self, errors):
+        if not errors:
+            return
+        if self.thread is None:
+            # started on the first errors, so that validators without errors don't start one
+            self.thread = threading.Thread(target=self.run, name='ss-validate-errors', daemon=True)
+            self.thread.start()
+        self.queue.put(errors)
+
+    def run(self):
+        while True:
+            errors = self.queue.get()
+            try:
+                if errors is None:
+                    return
+                self.write(errors)
+            finally:
+                self.queue.task_done()
+
+    def write(self, errors):
+        for error in errors:
+            key = (error.column, getattr(error, 'rule', None))
+            self.counts[key] += 1
+            if self.per_rule is None or self.counts[key] <= self.per_rule:
+                self.target.error(error)
+
+    def wait(self):
+        """
+        Wait for the errors that have been queued to be logged, so that what is
+        logged next comes after them.
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+    def flush(self):
+        """
+        Wait for the errors that have been queued to be logged, then log how
+        many were left out for each rule.
+        """
+        self.wait()
+        for (column, rule), count in sorted(self.counts.items(), key=str):
+            if self.per_rule is not None and count > self.per_rule:
+                self.target.error("...and {:,} more {} errors".format(
+                    count - self.per_rule, ' '.join(str(part) for part in (column, rule) if part is not None)))
+        self.counts.clear()
+
+    def close(self):
+        """
+        Log what is still queued and stop the thread.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
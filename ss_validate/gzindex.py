@@ -0,0 +1,190 @@
+import io
+import struct
+import zlib
+import numpy as np
+
+from ss_validate.storage import open_raw
+
+"""
+Gzip reading with access points for random access.
+
+A gzip file may be made of several members, each of which can be
+decompressed on its own (BGZF files are a series of small members). While
+the file is read the start of a member is recorded as an access point every
+`span` bytes of uncompressed data, so that a later read can start from the
+nearest member rather than from the beginning of the file. A file with a
+single member only has the access point at its start.
+
+BGZF blocks can also be found without decompressing them, from the block
+size in their header, which is how a BGZF file is split into shards.
+"""
+
+
+SPAN = 1024 * 1024
+READ_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+BGZF_BLOCK_SIZE = 65280
+"""maximum uncompressed bytes in a BGZF block, as written by bgzip"""
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+
+
+class GzipMemberReader(io.RawIOBase):
+    def __init__(self, file, start=(0, 0), span=SPAN, end=None):
+        """
+        :param file: path or S3 URL of the gzip file
+        :param start: (compressed offset, uncompressed offset) of the member to start at
+        :param span: minimum uncompressed distance between recorded access points
+        :param end: compressed offset of a member to stop before, defaults to the end of the file
+        """
+        super().__init__()
+        self._fh = open_raw(file)
+        self._fh.seek(start[0])
+        self._compressed_pos = start[0]
+        self.position = start[1]
+        """uncompressed offset of the next byte to be returned"""
+        self.span = span
+        self.end = end
+        self.access_points = [tuple(start)]
+        self._decompressor = zlib.decompressobj(wbits=31)
+        self._buffer = b''
+        self._offset = 0
+        """bytes of the buffer already returned"""
+        self._in_member = False
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset == len(self._buffer) and not self._eof:
+            self._fill()
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = memoryview(self._buffer)[self._offset:self._offset + n]
+        self._offset += n
+        self.position += n
+        return n
+
+    def _fill(self):
+        data = self._decompressor.unconsumed_tail or self._fh.read(READ_SIZE)
+        if not self._decompressor.unconsumed_tail:
+            self._compressed_pos += len(data)
+        if not data and not self._in_member:
+            self._eof = True
+            return
+        self._buffer = self._decompressor.decompress(data, READ_SIZE * 16)
+        self._offset = 0
+        if not data and not self._buffer and not self._decompressor.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        self._in_member = not self._decompressor.eof
+        if self._decompressor.eof:
+            self._next_member()
+
+    def _next_member(self):
+        unused = self._decompressor.unused_data
+        uncompressed_end = self.position + len(self._buffer)
+        member_start = self._compressed_pos - len(unused)
+        if not unused:
+            unused = self._fh.read(READ_SIZE)
+            self._compressed_pos += len(unused)
+        if not unused.startswith(GZIP_MAGIC) or (self.end is not None and member_start >= self.end):
+            # trailing padding after the last member is ignored, as gzip does
+            self._eof = True
+            return
+        if uncompressed_end - self.access_points[-1][1] >= self.span:
+            self.access_points.append((member_start, uncompressed_end))
+        self._decompressor = zlib.decompressobj(wbits=31)
+        self._buffer += self._decompressor.decompress(unused, READ_SIZE * 16)
+        self._in_member = not self._decompressor.eof
+        if self._decompressor.eof:
+            self._next_member()
+
+    def close(self):
+        self._fh.close()
+        super().close()
+
+
+class BgzfWriter:
+    """
+    Writes a BGZF file in blocks of BGZF_BLOCK_SIZE uncompressed bytes, keeping
+    the compressed offset of every block so that uncompressed offsets can be
+    turned into the virtual offsets used by tabix once the file is closed.
+    """
+    def __init__(self, path, level=6):
+        self._fh = open(path, 'wb')
+        self.level = level
+        self._buffer = bytearray()
+        self.position = 0
+        """uncompressed bytes written"""
+        self.block_offsets = [0]
+        """compressed offset of every block written, and of the end of the last one"""
+
+    def write(self, data):
+        self._buffer += data
+        self.position += len(data)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+
+    def _write_block(self, data):
+        block = bgzf_block(data, self.level)
+        self._fh.write(block)
+        self.block_offsets.append(self.block_offsets[-1] + len(block))
+
+    def virtual_offsets(self, offsets):
+        """
+        The virtual offsets (compressed offset of the block << 16 | offset within
+        the block) of uncompressed offsets in the closed file.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        blocks = np.array(self.block_offsets, dtype=np.uint64)
+        return (blocks[offsets // BGZF_BLOCK_SIZE] << np.uint64(16)) | (offsets % BGZF_BLOCK_SIZE).astype(np.uint64)
+
+    def close(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._fh.write(bgzf_block(b''))
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def bgzf_block(data, level=6):
+    """
+    Compress at most BGZF_BLOCK_SIZE bytes as a BGZF block, a gzip member
+    with its compressed size in the header. bgzf_block(b'') is the end of file marker.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                              BGZF_HEADER.size + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def bgzf_blocks(file):
+    """
+    The (compressed offset, uncompressed size) of every block of a BGZF file,
+    read from the block headers and trailers. None if the file is not BGZF.
+    """
+    blocks = []
+    with open_raw(file) as fh:
+        offset = 0
+        while True:
+            header = fh.read(BGZF_HEADER.size)
+            if len(header) < BGZF_HEADER.size:
+                break
+            id1, id2, _, flags, _, _, _, xlen, si1, si2, slen, bsize = BGZF_HEADER.unpack(header)
+            if (id1, id2) != (0x1f, 0x8b):
+                # trailing padding after the last member
+                break
+            if not flags & 4 or (si1, si2, slen) != (ord('B'), ord('C'), 2):
+                return None
+            fh.seek(offset + bsize + 1 - 4)
+            isize, = struct.unpack('<I', fh.read(4))
+            blocks.append((offset, isize))
+            offset += bsize + 1
+    return blocks or None
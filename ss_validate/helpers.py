@@ -1,4 +1,9 @@
+import io
+import gzip
 import math
+import pathlib
+import contextlib
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 from pandas_schema.validation import (MatchesPatternValidation,
@@ -6,7 +11,10 @@ from pandas_schema.validation import (MatchesPatternValidation,
                                       CanConvertValidation,
                                       CustomSeriesValidation,
                                       _SeriesValidation)
+from pandas_schema.validation_warning import ValidationWarning
 from ss_validate import __version__
+from ss_validate.gzindex import GzipMemberReader, READ_SIZE
+from ss_validate.storage import open_raw, is_remote
 
 
 class InInclusiveRangeValidation(_SeriesValidation):
@@ -77,23 +85,78 @@ class InRangeValidationUpperInclusive(_SeriesValidation):
         return (series > self.min) & (series <= self.max)
 
 
+class _DistinctValueValidation:
+    """
+    Mixin for validations of single values, e.g. regexes, that validates
+    each distinct value of a chunk once and broadcasts the verdicts back to the
+    cells. The verdicts are kept in a bounded LRU cache across chunks, so that a
+    column with a few distinct values, like chromosome or the alleles, is barely
+    validated after the first chunk. Columns where most values are distinct, like
+    rsid, are validated cell by cell as before.
+    """
+    cache_size = 65536
+    max_distinct_fraction = 0.5
+
+    def validate(self, series: pd.Series) -> pd.Series:
+        codes, uniques = pd.factorize(series)
+        if len(uniques) > self.max_distinct_fraction * len(series):
+            return super().validate(series)
+        cache = self.__dict__.setdefault('_verdicts', OrderedDict())
+        # the last verdict is that of a missing value, which has the code -1
+        verdicts = np.empty(len(uniques) + 1, dtype=bool)
+        unknown = []
+        for code, value in enumerate(uniques):
+            verdict = cache.get(value)
+            if verdict is None:
+                unknown.append(code)
+            else:
+                verdicts[code] = verdict
+                cache.move_to_end(value)
+        if unknown:
+            values = uniques.take(unknown)
+            verdicts[unknown] = np.asarray(super().validate(pd.Series(values, dtype=series.dtype)), dtype=bool)
+            for value, verdict in zip(values, verdicts[unknown]):
+                cache[value] = bool(verdict)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        if (codes < 0).any():
+            verdicts[-1] = bool(super().validate(pd.Series([np.nan], dtype=series.dtype)).iloc[0])
+        return pd.Series(verdicts[codes], index=series.index)
+
+
+class DistinctValueMatchesPatternValidation(_DistinctValueValidation, MatchesPatternValidation):
+    pass
+
+
+def with_rule(validation, rule):
+    """
+    Name a validation, so that its errors can be reported by rule.
+    """
+    validation.rule = rule
+    return validation
+
+
+def rule_name(validation):
+    return getattr(validation, 'rule', type(validation).__name__)
+
+
 def match_regex(pattern):
-    return MatchesPatternValidation(r'{}'.format(pattern))
+    return with_rule(DistinctValueMatchesPatternValidation(r'{}'.format(pattern)), 'match_regex')
 
 
 def in_list(list):
-    return InListValidation(list, message=f"is not an accepted value. Value must be be {list}")
+    return with_rule(InListValidation(list, message=f"is not an accepted value. Value must be be {list}"), 'in_list')
 
 
 def in_range(lower=-math.inf, upper=math.inf):
-    return InInclusiveRangeValidation(lower, upper)
+    return with_rule(InInclusiveRangeValidation(lower, upper), 'in_range')
 
 
 def is_dtype(dtype):
-    return CanConvertValidation(dtype)
+    return with_rule(CanConvertValidation(dtype), 'is_dtype')
 
 
-p_value_validation = InRangeValidationUpperInclusive(0, 1) | (
+p_value_validation = with_rule(InRangeValidationUpperInclusive(0, 1) | (
         CustomSeriesValidation(
             lambda x: pd.to_numeric(x.str.split('e|E', expand=True)[1].fillna(value=np.nan)
                                     , errors='coerce') < -1,
@@ -102,9 +165,9 @@ p_value_validation = InRangeValidationUpperInclusive(0, 1) | (
             lambda x: pd.to_numeric(x.str.split('e|E', expand=True)[0].fillna(value=np.nan)
                                     , errors='coerce') > 0,
             'Numbers should be between 0 and 1')
-)
+), 'p_value')
 
-p_value_validation_allow_zero = InInclusiveRangeValidation(0, 1) | (
+p_value_validation_allow_zero = with_rule(InInclusiveRangeValidation(0, 1) | (
         CustomSeriesValidation(
             lambda x: pd.to_numeric(x.str.split('e|E', expand=True)[1].fillna(value=np.nan)
                                     , errors='coerce') < -1,
@@ -113,7 +176,165 @@ p_value_validation_allow_zero = InInclusiveRangeValidation(0, 1) | (
             lambda x: pd.to_numeric(x.str.split('e|E', expand=True)[0].fillna(value=np.nan)
                                     , errors='coerce') > 0,
             'Numbers should be between 0 and 1')
-)
+), 'p_value')
+
+
+class _FrameValidation:
+    """
+    A validation across several columns. validate() is given a series for each
+    of the columns and returns a boolean series which is False for the failing
+    rows. Errors are reported against the first column.
+    """
+    def __init__(self, rule, message):
+        self.rule = rule
+        self.message = message
+
+    def validate(self, *series) -> pd.Series:
+        raise NotImplementedError
+
+    def get_errors(self, df, columns):
+        failing = df.index[~self.validate(*[df[column] for column in columns]).values]
+        errors = []
+        for row in failing:
+            error = ValidationWarning(message=self.message, value=df.at[row, columns[0]], row=row, column=columns[0])
+            error.rule = self.rule
+            errors.append(error)
+        return errors
+
+
+class VariantIdValidation(_FrameValidation):
+    """
+    Checks that variant_id is <chromosome>_<base_pair_location>_<other_allele>_<effect_allele>.
+    """
+    def __init__(self):
+        super().__init__('variant_id_matches_position',
+                         'does not match <chromosome>_<base_pair_location>_<other_allele>_<effect_allele>')
+
+    def validate(self, variant_id, chromosome, base_pair_location, other_allele, effect_allele):
+        expected = chromosome.str.cat([base_pair_location, other_allele, effect_allele], sep='_')
+        return expected.isna() | variant_id.isna() | (variant_id.str.upper() == expected.str.upper())
+
+
+class ConfidenceIntervalValidation(_FrameValidation):
+    """
+    Checks that ci_lower <= effect <= ci_upper.
+    """
+    def __init__(self):
+        super().__init__('effect_in_confidence_interval', 'is not between ci_lower and ci_upper')
+
+    def validate(self, effect, lower, upper):
+        effect, lower, upper = (pd.to_numeric(s, errors='coerce') for s in (effect, lower, upper))
+        present = effect.notna() & lower.notna() & upper.notna()
+        return ~present | ((lower <= effect) & (effect <= upper))
+
+
+class StandardErrorValidation(_FrameValidation):
+    """
+    Checks that standard_error > 0 where there is an effect size.
+    """
+    def __init__(self):
+        super().__init__('positive_standard_error', 'is not > 0 for a row with an effect size')
+
+    def validate(self, standard_error, effect):
+        standard_error, effect = (pd.to_numeric(s, errors='coerce') for s in (standard_error, effect))
+        return effect.isna() | standard_error.isna() | (standard_error > 0)
+
+
+class NegLogPValueValidation(_FrameValidation):
+    """
+    Checks that neg_log_10_p_value agrees with p_value. The p-value's log is taken
+    from its mantissa and exponent, so that values too small for a float still compare.
+    """
+    def __init__(self, rtol=1e-3, atol=1e-2):
+        self.rtol = rtol
+        self.atol = atol
+        super().__init__('p_values_agree', 'does not agree with -log10(p_value)')
+
+    def validate(self, neg_log_p, p_value):
+        neg_log_p = pd.to_numeric(neg_log_p, errors='coerce')
+        mantissa, exponent = split_scientific(p_value)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = -(np.log10(mantissa) + exponent)
+        comparable = neg_log_p.notna() & (mantissa > 0) & np.isfinite(expected)
+        close = np.isclose(neg_log_p, expected, rtol=self.rtol, atol=self.atol)
+        return ~comparable | close
+
+
+def split_scientific(series):
+    """
+    The mantissa and exponent of numbers written like 1.5e-400, as floats.
+    Numbers without an exponent have an exponent of 0.
+    """
+    parts = series.str.split('e|E', n=1, expand=True)
+    mantissa = pd.to_numeric(parts[0], errors='coerce')
+    if 1 in parts:
+        exponent = pd.to_numeric(parts[1].fillna('0'), errors='coerce')
+    else:
+        exponent = pd.Series(0.0, index=series.index)
+    return mantissa, exponent
+
+
+def is_gzipped(file):
+    return pathlib.Path(file).suffix in [".gz", ".gzip"]
+
+
+def open_binary(file, offset=0, access_points=None, record_access_points=False):
+    """
+    Open a (optionally gzipped) local file or S3 object for reading bytes,
+    starting from an offset in the uncompressed data.
+
+    :param access_points: (compressed offset, uncompressed offset) pairs recorded
+        by GzipMemberReader, used to avoid decompressing from the start of the file
+    :param record_access_points: read a gzipped file with a GzipMemberReader, which
+        records access points, even from the start, where the gzip module is faster
+    """
+    if is_gzipped(file) and offset == 0 and not record_access_points:
+        raw = open_raw(file)
+        fh = gzip.GzipFile(fileobj=raw)
+        # closed with it, as when GzipFile opens the file itself
+        fh.myfileobj = raw
+        # GzipFile reads lines a call at a time, BufferedReader reads them in C
+        return io.BufferedReader(fh, buffer_size=READ_SIZE * 16)
+    if is_gzipped(file):
+        start = (0, 0)
+        for point in access_points if access_points is not None else []:
+            if point[1] <= offset:
+                start = tuple(int(p) for p in point)
+        fh = io.BufferedReader(GzipMemberReader(file, start=start), buffer_size=READ_SIZE)
+        to_skip = offset - start[1]
+        while to_skip > 0:
+            skipped = len(fh.read(min(to_skip, READ_SIZE * 16)))
+            if skipped == 0:
+                break
+            to_skip -= skipped
+        return fh
+    fh = open_raw(file)
+    fh.seek(offset)
+    return fh
+
+
+@contextlib.contextmanager
+def csv_source(file):
+    """
+    What to give pandas to read a file, with its compression: the path of a
+    local file, which pandas opens itself, or an open S3 object.
+    """
+    if not is_remote(file):
+        yield file, 'infer'
+        return
+    with open_raw(file) as fh:
+        yield fh, 'gzip' if is_gzipped(file) else None
+
+
+def is_data_line(line):
+    """
+    False for the comment and blank lines that pandas skips with comment='#'.
+    """
+    if line.endswith(b'\n'):
+        line = line[:-1]
+    if line.endswith(b'\r'):
+        line = line[:-1]
+    return len(line) > 0 and not line.startswith(b'#')
 
 
 def get_version():
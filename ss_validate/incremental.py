@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+
+from pandas_schema.validation_warning import ValidationWarning
+from ss_validate.storage import local_name
+
+"""
+Stored results for incremental revalidation.
+
+The errors found in each chunk of a file are saved alongside the digest of
+the chunk's bytes. When the file is validated again with the same settings,
+the errors of a chunk whose digest has not changed are reused instead of
+parsing and validating the chunk again, so only edited chunks and anything
+appended to the file are revalidated.
+"""
+
+
+STATE_VERSION = 1
+
+
+class IncrementalState:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.chunks = {}
+        """chunk number -> (digest, errors as records from errors_to_records())"""
+        self.reused = 0
+
+    @classmethod
+    def load(cls, path, key):
+        """
+        The state saved at path, or an empty state if there is none
+        or it was saved with different settings.
+        """
+        state = cls(path, key)
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('key') == key:
+                state.chunks = {int(chunk): (digest, errors) for chunk, (digest, errors) in saved['chunks'].items()}
+        return state
+
+    def errors(self, chunk, digest, first_row):
+        """
+        The stored errors of a chunk, or None if its content has changed.
+        """
+        stored = self.chunks.get(chunk)
+        if stored is None or stored[0] != digest:
+            return None
+        self.reused += 1
+        return errors_from_records(stored[1], first_row)
+
+    def record(self, chunk, digest, first_row, errors):
+        self.chunks[chunk] = (digest, errors_to_records(errors, first_row))
+
+    def save(self, nchunks):
+        """
+        :param nchunks: number of chunks in the file, any beyond it are dropped
+        """
+        chunks = {chunk: stored for chunk, stored in self.chunks.items() if chunk < nchunks}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'chunks': chunks}, f)
+        os.replace(tmp_path, self.path)
+
+
+def errors_to_records(errors, first_row=0):
+    """
+    Errors as JSON serialisable lists of [row - first_row, column, value, message, rule].
+    """
+    return [[int(error.row) - first_row, error.column, error.value, error.message, getattr(error, 'rule', None)]
+            for error in errors]
+
+
+def errors_from_records(records, first_row=0):
+    errors = []
+    for row, column, value, message, rule in records:
+        error = ValidationWarning(message=message, value=value, row=first_row + row, column=column)
+        error.rule = rule
+        errors.append(error)
+    return errors
+
+
+def state_path(file):
+    return local_name(file) + ".state.json"
+
+
+def settings_key(**settings):
+    """
+    A digest of everything other than the content of a chunk that its errors depend on.
+    """
+    settings['state_version'] = STATE_VERSION
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
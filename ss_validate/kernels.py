@@ -0,0 +1,468 @@
+import re
+import numpy as np
+import pandas as pd
+from pandas_schema.validation import CanConvertValidation, MatchesPatternValidation, _SeriesValidation
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from ss_validate.helpers import (InInclusiveRangeValidation, InExclusiveRangeValidation,
+                                 InRangeValidationUpperInclusive, DistinctValueMatchesPatternValidation,
+                                 p_value_validation, p_value_validation_allow_zero)
+
+"""
+JIT compiled validation of the cells of a chunk, used when Numba is installed.
+
+The cells of every column with rules that a kernel can check are joined into
+one buffer of bytes, and a single compiled loop tokenizes it, parses each cell
+once and applies all the rules of its column, setting a bit for each failed
+rule in a bitmask for the row. The rules are the dtype checks (float, int and str),
+the numeric ranges, the p-value rule and regexes made of literals and
+character classes, which are compiled to a DFA.
+
+A kernel only decides the cells it can decide exactly as pandas would: plain
+decimal numbers, and ASCII strings for a regex. Any other cell, e.g. ' 0.5',
+'inf', '1e-400' for a range, or a number within rounding of a bound, is
+marked as uncertain and validated by the validation itself, so the errors
+are the same as without the kernels.
+"""
+
+
+FLOAT, INT, RANGE, PVALUE, REGEX, STRING = range(6)
+MAX_RULES = 64
+"""rules checked by the kernel in a chunk, one bit each"""
+MAX_DFA_STATES = 256
+SAFE_DIGITS = 15
+"""digits of a number without an exponent that every parser reads as the same float"""
+NEAR_BOUND = 1e-12
+PANDAS_DIGITS = 17
+"""digits of a number that pandas reads, including leading zeros, ignoring the rest"""
+POW10 = np.array([10.0 ** k for k in range(23)])
+REGEX_LITERAL = re.compile(r'[A-Za-z0-9_]')
+
+
+def available():
+    return numba is not None
+
+
+class PrecomputedValidation(_SeriesValidation):
+    """
+    A validation whose verdicts are already known, giving the errors that the
+    original validation would give for them.
+    """
+    def __init__(self, validation, verdicts):
+        self.validation = validation
+        self.verdicts = verdicts
+        super().__init__()
+
+    @property
+    def default_message(self):
+        return self.validation.message
+
+    def validate(self, series: pd.Series) -> pd.Series:
+        return pd.Series(self.verdicts, index=series.index)
+
+
+class KernelRule:
+    def __init__(self, kind, lower=-np.inf, upper=np.inf, lower_inclusive=True, upper_inclusive=True, dfa=None):
+        self.kind = kind
+        self.lower = lower
+        self.upper = upper
+        self.lower_inclusive = lower_inclusive
+        self.upper_inclusive = upper_inclusive
+        self.dfa = dfa
+
+
+def kernel_rule(validation):
+    """
+    The rule that a kernel applies for a validation, or None if it can't be checked by a kernel.
+    """
+    if '_kernel_rule' not in validation.__dict__:
+        validation.__dict__['_kernel_rule'] = find_kernel_rule(validation)
+    return validation.__dict__['_kernel_rule']
+
+
+def find_kernel_rule(validation):
+    if validation is p_value_validation:
+        return KernelRule(PVALUE, 0, 1, lower_inclusive=False)
+    if validation is p_value_validation_allow_zero:
+        return KernelRule(PVALUE, 0, 1)
+    kind = type(validation)
+    if kind is CanConvertValidation and validation.callable in (float, int, str):
+        return KernelRule({float: FLOAT, int: INT, str: STRING}[validation.callable])
+    if kind is InInclusiveRangeValidation:
+        return KernelRule(RANGE, validation.min, validation.max)
+    if kind is InExclusiveRangeValidation:
+        return KernelRule(RANGE, validation.min, validation.max, lower_inclusive=False, upper_inclusive=False)
+    if kind is InRangeValidationUpperInclusive:
+        return KernelRule(RANGE, validation.min, validation.max, lower_inclusive=False)
+    if kind in (MatchesPatternValidation, DistinctValueMatchesPatternValidation) and not validation.options:
+        dfa = pattern_dfa(validation.pattern)
+        if dfa is not None:
+            return KernelRule(REGEX, dfa=dfa)
+    return None
+
+
+def parse_pattern(pattern):
+    """
+    The alternatives of a regex like '^LONG_STRING$|^[ACTGactg]+$', each a list of
+    (set of bytes, whether it repeats), or None if it has any other syntax.
+    """
+    alternatives = []
+    for alternative in pattern.split('|'):
+        if not (alternative.startswith('^') and alternative.endswith('$')):
+            return None
+        body, items, i = alternative[1:-1], [], 0
+        while i < len(body):
+            if body[i] == '[':
+                end = body.find(']', i)
+                if end < 0:
+                    return None
+                chars = class_bytes(body[i + 1:end])
+                if chars is None:
+                    return None
+                i = end + 1
+            elif REGEX_LITERAL.match(body[i]):
+                chars = {ord(body[i])}
+                i += 1
+            else:
+                return None
+            repeat = i < len(body) and body[i] == '+'
+            i += repeat
+            items.append((frozenset(chars), repeat))
+        alternatives.append(items)
+    return alternatives
+
+
+def class_bytes(members):
+    chars, i = set(), 0
+    while i < len(members):
+        if not REGEX_LITERAL.match(members[i]):
+            return None
+        if i + 2 < len(members) and members[i + 1] == '-':
+            if not REGEX_LITERAL.match(members[i + 2]):
+                return None
+            chars.update(range(ord(members[i]), ord(members[i + 2]) + 1))
+            i += 3
+        else:
+            chars.add(ord(members[i]))
+            i += 1
+    return chars if chars else None
+
+
+def pattern_dfa(pattern):
+    """
+    A DFA matching whole strings against a regex of parse_pattern(), as a transition
+    table of the bytes from each state, where state 0 never matches, and whether each
+    state matches. The DFA starts in state 1.
+    """
+    alternatives = parse_pattern(pattern)
+    if alternatives is None:
+        return None
+
+    def step(positions, byte):
+        following = set()
+        for alternative, position in positions:
+            items = alternatives[alternative]
+            if position < len(items) and byte in items[position][0]:
+                following.add((alternative, position + 1))
+            if position > 0 and items[position - 1][1] and byte in items[position - 1][0]:
+                following.add((alternative, position))
+        return frozenset(following)
+
+    start = frozenset((alternative, 0) for alternative in range(len(alternatives)))
+    states = {frozenset(): 0, start: 1}
+    transitions = [[0] * 256, None]
+    todo = [start]
+    while todo:
+        positions = todo.pop()
+        row = []
+        for byte in range(256):
+            following = step(positions, byte)
+            if following not in states:
+                if len(states) >= MAX_DFA_STATES:
+                    return None
+                states[following] = len(states)
+                transitions.append(None)
+                todo.append(following)
+            row.append(states[following])
+        transitions[states[positions]] = row
+    accept = np.zeros(len(states), dtype=np.bool_)
+    for positions, state in states.items():
+        accept[state] = any(position == len(alternatives[alternative]) for alternative, position in positions)
+    return np.array(transitions, dtype=np.int32), accept
+
+
+def _in_range(value, lower, upper, lower_inclusive, upper_inclusive):
+    above = value >= lower if lower_inclusive else value > lower
+    below = value <= upper if upper_inclusive else value < upper
+    return above and below
+
+
+def _near(value, bound):
+    return np.isfinite(bound) and abs(value - bound) <= NEAR_BOUND * max(abs(value), abs(bound), 1e-300)
+
+
+def _validate_cells(buf, nrows, column_ends, missing_cells, rule_ends, kinds, lowers, uppers, lower_inclusive,
+                    upper_inclusive, dfa_starts, dfa_table, dfa_accept, missing_passes, failed, uncertain):
+    """
+    Check the cells of each column in buf, a cell to a line, against the rules of the
+    column, setting bit k of failed or uncertain for a row if rule k failed or can't be
+    decided. The rules of column c are those from rule_ends[c - 1] to rule_ends[c], and
+    missing_cells[c, row] is True where a cell is missing (and empty in buf).
+
+    :return: False if a column doesn't have nrows cells
+    """
+    start = 0
+    first_rule = 0
+    for column in range(len(column_ends)):
+        end = column_ends[column]
+        position = start
+        for row in range(nrows):
+            if position >= end:
+                return False
+            cell_end = position
+            while buf[cell_end] != 10:
+                cell_end += 1
+            # parse the cell as a number: [+-]digits[.digits][e[+-]digits]
+            p = position
+            negative = False
+            if p < cell_end and (buf[p] == 43 or buf[p] == 45):
+                negative = buf[p] == 45
+                p += 1
+            mantissa = 0
+            scale = 0
+            nonzero = False
+            ndigits = 0
+            int_digits = 0
+            fraction = False
+            ascii = True
+            while p < cell_end:
+                byte = buf[p]
+                if 48 <= byte <= 57:
+                    digit = byte - 48
+                    ndigits += 1
+                    if not fraction:
+                        int_digits += 1
+                    if ndigits > PANDAS_DIGITS:
+                        # dropped, as pandas drops them
+                        if not fraction:
+                            scale += 1
+                    else:
+                        if digit != 0:
+                            nonzero = True
+                        if fraction:
+                            scale -= 1
+                        mantissa = mantissa * 10 + digit
+                elif byte == 46 and not fraction:
+                    fraction = True
+                else:
+                    break
+                p += 1
+            is_int = int_digits > 0 and not fraction and p == cell_end
+            is_float = ndigits > 0
+            has_exponent = False
+            exponent = 0
+            exponent_ok = True
+            if is_float and p < cell_end and (buf[p] == 101 or buf[p] == 69):
+                has_exponent = True
+                p += 1
+                exponent_negative = False
+                if p < cell_end and (buf[p] == 43 or buf[p] == 45):
+                    exponent_negative = buf[p] == 45
+                    p += 1
+                exponent_digits = 0
+                while p < cell_end and 48 <= buf[p] <= 57:
+                    if exponent_digits < 6:
+                        exponent = exponent * 10 + (buf[p] - 48)
+                    else:
+                        exponent_ok = False
+                    exponent_digits += 1
+                    p += 1
+                if exponent_digits == 0:
+                    is_float = False
+                if exponent_negative:
+                    exponent = -exponent
+            if p != cell_end:
+                is_float = False
+            for q in range(position, cell_end):
+                if buf[q] >= 128:
+                    ascii = False
+            missing = missing_cells[column, row]
+            # the float value of the cell, if it is close enough to the value pandas reads
+            # that only a bound within NEAR_BOUND of it could be on the other side of it,
+            # and plain if it is the value pandas reads
+            value = 0.0
+            known_value = False
+            plain = False
+            # pandas reads an integer exactly however long it is, not truncated like the mantissa
+            long_integer = ndigits > PANDAS_DIGITS and not fraction
+            if is_float and exponent_ok and not long_integer:
+                while mantissa != 0 and mantissa % 10 == 0:
+                    mantissa //= 10
+                    scale += 1
+                k = scale + exponent
+                if mantissa == 0:
+                    known_value = -22 <= exponent <= 22
+                    plain = known_value and not has_exponent
+                elif ndigits <= PANDAS_DIGITS and mantissa <= 9007199254740992 and -22 <= k <= 22:
+                    known_value = True
+                    plain = not has_exponent and ndigits <= SAFE_DIGITS
+                    value = mantissa * POW10[k] if k >= 0 else mantissa / POW10[-k]
+                elif -300 <= k <= 300 - PANDAS_DIGITS:
+                    # far from overflow and underflow, which pandas reads as NaN or 0, so only rounding differs
+                    known_value = True
+                    if -22 <= k <= 22:
+                        value = mantissa * POW10[k] if k >= 0 else mantissa / POW10[-k]
+                    else:
+                        value = mantissa * 10.0 ** k
+                if negative:
+                    value = -value
+
+            for rule in range(first_rule, rule_ends[column]):
+                bit = np.uint64(1) << np.uint64(rule)
+                kind = kinds[rule]
+                passed = False
+                known = True
+                if missing:
+                    passed = missing_passes[rule]
+                elif kind == FLOAT:
+                    passed = True
+                    known = is_float
+                elif kind == STRING:
+                    passed = True
+                elif kind == INT:
+                    passed = True
+                    known = is_int
+                elif kind == RANGE or kind == PVALUE:
+                    if kind == PVALUE and has_exponent and is_float:
+                        # or a mantissa above 0 with an exponent below -1
+                        if not exponent_ok or long_integer:
+                            known = False
+                        elif exponent < -1 and nonzero and not negative:
+                            passed = True
+                    if not passed and known:
+                        if not known_value:
+                            known = False
+                        elif not plain and (_near(value, lowers[rule]) or _near(value, uppers[rule])):
+                            known = False
+                        else:
+                            passed = _in_range(value, lowers[rule], uppers[rule],
+                                               lower_inclusive[rule], upper_inclusive[rule])
+                else:
+                    if not ascii:
+                        known = False
+                    else:
+                        state = dfa_starts[rule]
+                        for q in range(position, cell_end):
+                            state = dfa_table[state, buf[q]]
+                            if state == 0:
+                                break
+                        passed = dfa_accept[state]
+                if not known:
+                    uncertain[row] |= bit
+                elif not passed:
+                    failed[row] |= bit
+            position = cell_end + 1
+        if position != end:
+            return False
+        start = end
+        first_rule = rule_ends[column]
+    return True
+
+
+if numba is not None:
+    _in_range = numba.njit(cache=True)(_in_range)
+    _near = numba.njit(cache=True)(_near)
+    _validate_cells = numba.njit(cache=True, nogil=True)(_validate_cells)
+
+
+def missing_verdict(validation, kind):
+    """Whether a missing value passes a validation, which for a regex is whether 'nan' matches."""
+    if kind == REGEX:
+        return bool(validation.validate(pd.Series([np.nan], dtype=object)).iloc[0])
+    return kind in (FLOAT, STRING)
+
+
+def chunk_verdicts(df, pd_schema):
+    """
+    The verdicts of the validations of pd_schema that a kernel can check, on the cells of df.
+
+    :return: {(column label, index of the validation): boolean array}
+    """
+    columns = []
+    rules = []
+    for column in pd_schema.columns:
+        column_rules = [(i, rule) for i, rule in ((i, kernel_rule(v)) for i, v in enumerate(column.validations))
+                        if rule is not None][:MAX_RULES - len(rules)]
+        if not column_rules:
+            continue
+        missing = df[column.name].isna().to_numpy()
+        cells = df[column.name].to_numpy(copy=True)
+        if any(type(cell) is not float for cell in cells[missing]):
+            # missing values other than NaN, which the validations treat differently
+            continue
+        cells[missing] = ''
+        try:
+            text = '\n'.join(cells.tolist())
+        except TypeError:
+            # not every cell is a string
+            continue
+        columns.append((column, text.encode('utf-8') + b'\n', missing))
+        rules.extend((column, i, rule) for i, rule in column_rules)
+    nrows = len(df)
+    if not rules or not nrows:
+        return {}
+    column_ends = np.cumsum([len(data) for _, data, _ in columns])
+    rule_ends = np.cumsum([sum(1 for c, _, _ in rules if c is column) for column, _, _ in columns])
+    dfa_starts = np.zeros(len(rules), dtype=np.int64)
+    tables = [np.zeros((1, 256), dtype=np.int32)]
+    accepts = [np.zeros(1, dtype=np.bool_)]
+    offset = 1
+    for k, (_, _, rule) in enumerate(rules):
+        if rule.kind == REGEX:
+            table, accept = rule.dfa
+            # state 0 of every DFA is the shared state 0
+            tables.append(np.where(table[1:] == 0, 0, table[1:] + offset - 1).astype(np.int32))
+            accepts.append(accept[1:])
+            dfa_starts[k] = offset
+            offset += len(table) - 1
+    failed = np.zeros(nrows, dtype=np.uint64)
+    uncertain = np.zeros(nrows, dtype=np.uint64)
+    complete = _validate_cells(np.frombuffer(b''.join(data for _, data, _ in columns), dtype=np.uint8),
+                               nrows,
+                               column_ends.astype(np.int64),
+                               np.stack([missing for _, _, missing in columns]),
+                               rule_ends.astype(np.int64),
+                               np.array([rule.kind for _, _, rule in rules], dtype=np.int64),
+                               np.array([rule.lower for _, _, rule in rules], dtype=np.float64),
+                               np.array([rule.upper for _, _, rule in rules], dtype=np.float64),
+                               np.array([rule.lower_inclusive for _, _, rule in rules], dtype=np.bool_),
+                               np.array([rule.upper_inclusive for _, _, rule in rules], dtype=np.bool_),
+                               dfa_starts,
+                               np.concatenate(tables),
+                               np.concatenate(accepts),
+                               np.array([missing_verdict(column.validations[i], rule.kind)
+                                         for column, i, rule in rules], dtype=np.bool_),
+                               failed,
+                               uncertain)
+    if not complete:
+        # a cell with a line break
+        return {}
+    verdicts = {}
+    for k, (column, i, rule) in enumerate(rules):
+        bit = np.uint64(1) << np.uint64(k)
+        verdict = (failed & bit) == 0
+        undecided = np.flatnonzero(uncertain & bit)
+        if len(undecided):
+            series = df[column.name].iloc[undecided]
+            if rule.kind == PVALUE:
+                # the p-value rule needs a value with an exponent among those it validates
+                series = pd.concat([series, pd.Series(['1e0'])])
+                verdict[undecided] = np.asarray(column.validations[i].validate(series), dtype=bool)[:-1]
+            else:
+                verdict[undecided] = np.asarray(column.validations[i].validate(series), dtype=bool)
+        verdicts[(column.name, i)] = verdict
+    return verdicts
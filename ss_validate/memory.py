@@ -0,0 +1,353 @@
+import os
+import gc
+import sys
+import json
+import ctypes
+import shutil
+import logging
+import tempfile
+import itertools
+
+import numpy as np
+
+from ss_validate.incremental import errors_to_records, errors_from_records
+
+"""
+Keeping a validation within a memory budget.
+
+Between chunks the governor measures the resident set size of the process.
+Above HIGH_WATER of the budget it frees what it can (garbage, the errors and
+the numbers of the rows with errors held in memory, which are moved to
+temporary files, and memory that malloc has kept), and if that is not enough it halves the number of rows in the next
+chunks. Below LOW_WATER the chunks grow back to their full size. If the
+process is still over the budget with chunks of MIN_CHUNK_ROWS rows it stops
+with MemoryBudgetExceeded, rather than carrying on until it is killed.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+HIGH_WATER = 0.8
+LOW_WATER = 0.5
+MIN_CHUNK_ROWS = 1000
+SPILL_BATCH = 10000
+"""errors read back from the spill file at a time"""
+MAX_ROW_RUNS = 8
+MERGE_BLOCK = 65536
+"""rows read from each run at a time when the spilled runs of rows are merged"""
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def rss_mb():
+    """
+    Resident set size of this process in MB, or the peak if the current size can't be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def release_memory():
+    """
+    Collect garbage and hand memory that malloc is holding on to back to the system.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryGovernor:
+    def __init__(self, budget, chunksize, min_chunk_rows=MIN_CHUNK_ROWS, measure=rss_mb):
+        """
+        :param budget: MB that the process may use
+        :param chunksize: number of rows in a chunk when there is memory to spare
+        :param measure: function returning the memory in use in MB
+        """
+        self.budget = budget
+        self.max_chunk_rows = chunksize
+        self.min_chunk_rows = min(min_chunk_rows, chunksize)
+        self.chunk_rows = chunksize
+        self.measure = measure
+        self.peak = 0
+
+    @property
+    def under_pressure(self):
+        """whether work that only makes things faster, like reading ahead, should wait"""
+        return self.chunk_rows < self.max_chunk_rows
+
+    def check(self, spill=()):
+        """
+        Check the memory in use after a chunk, adjusting the size of the next chunks.
+
+        :param spill: functions that move state out of memory, tried in order until enough is freed
+        :return: the number of rows to read in the next chunk
+        """
+        used = self.measure()
+        self.peak = max(self.peak, used)
+        for free in itertools.chain([None], spill):
+            if used <= self.budget * HIGH_WATER:
+                break
+            if free is not None:
+                free()
+            release_memory()
+            used = self.measure()
+        if used > self.budget * HIGH_WATER:
+            if used > self.budget and self.chunk_rows == self.min_chunk_rows:
+                raise MemoryBudgetExceeded(
+                    "Using {:.0f} MB, over the memory budget of {} MB, even with chunks of {} rows".format(
+                        used, self.budget, self.chunk_rows))
+            if self.chunk_rows > self.min_chunk_rows:
+                self.chunk_rows = max(self.min_chunk_rows, self.chunk_rows // 2)
+                logger.warning("Using {:.0f} MB of the memory budget of {} MB, reading chunks of {} rows".format(
+                    used, self.budget, self.chunk_rows))
+        elif used < self.budget * LOW_WATER and self.chunk_rows < self.max_chunk_rows:
+            self.chunk_rows = min(self.max_chunk_rows, self.chunk_rows * 2)
+        return self.chunk_rows
+
+
+class ErrorLog:
+    def __init__(self, spill_dir=None):
+        """
+        A list of errors that can move the errors it holds in memory to a
+        temporary file. They are read back, in order, when it is iterated.
+
+        :param spill_dir: where to write the spilled errors, defaults to the system temp dir
+        """
+        self.spill_dir = spill_dir
+        self.in_memory = []
+        self.nspilled = 0
+        self.path = None
+
+    def append(self, error):
+        self.in_memory.append(error)
+
+    def extend(self, errors):
+        self.in_memory.extend(errors)
+
+    def __len__(self):
+        return self.nspilled + len(self.in_memory)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        if self.path is not None:
+            with open(self.path) as f:
+                while True:
+                    lines = list(itertools.islice(f, SPILL_BATCH))
+                    if not lines:
+                        break
+                    yield from errors_from_records([json.loads(line) for line in lines])
+        yield from list(self.in_memory)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("error index out of range")
+        if i >= self.nspilled:
+            return self.in_memory[i - self.nspilled]
+        return next(itertools.islice(iter(self), i, None))
+
+    def spill(self):
+        if not self.in_memory:
+            return
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix='ss_validate_errors_', suffix='.jsonl', dir=self.spill_dir)
+            os.close(fd)
+        with open(self.path, 'a') as f:
+            for record in errors_to_records(self.in_memory):
+                f.write(json.dumps(record, default=str) + '\n')
+        logger.info("Moved {} errors from memory to {}".format(len(self.in_memory), self.path))
+        self.nspilled += len(self.in_memory)
+        self.in_memory = []
+
+    def __del__(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class RowLog:
+    def __init__(self, spill_dir=None):
+        """
+        The numbers of the rows with errors, each once, in the order they were
+        added. Like ErrorLog, the rows held in memory can be moved to a
+        temporary file, which is read back when it is iterated. So that a row
+        can still be looked up, each spill is also written as a sorted, memory
+        mapped run, and MAX_ROW_RUNS runs of the same size are merged into one,
+        so there are few runs to search however often the rows are spilled.
+        Otherwise it can be used as the list of rows it replaces.
+
+        :param spill_dir: where to write the spilled rows, defaults to the system temp dir
+        """
+        self.spill_dir = spill_dir
+        self.in_memory = []
+        self.in_memory_set = set()
+        self.nspilled = 0
+        self.runs = []
+        self.levels = []
+        """the number of merges each run has been through"""
+        self._tmpdir = None
+        self._nfiles = 0
+
+    def add(self, row):
+        """
+        :return: whether the row was added, i.e. it wasn't already there
+        """
+        if row in self:
+            return False
+        self.in_memory.append(row)
+        self.in_memory_set.add(row)
+        return True
+
+    def append(self, row):
+        """
+        Like add(), as the log holds each row once.
+        """
+        self.add(row)
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def __contains__(self, row):
+        if row in self.in_memory_set:
+            return True
+        for run in self.runs:
+            i = np.searchsorted(run, row)
+            if i < len(run) and run[i] == row:
+                return True
+        return False
+
+    def among(self, rows):
+        """
+        The rows of an array of rows, e.g. the index of a chunk, that are in the log.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        found = np.fromiter((row in self.in_memory_set for row in rows.tolist()), dtype=bool, count=len(rows))
+        if len(rows):
+            for run in self.runs:
+                start = np.searchsorted(run, rows.min(), side='left')
+                end = np.searchsorted(run, rows.max(), side='right')
+                found |= np.isin(rows, run[start:end])
+        return rows[found]
+
+    def __len__(self):
+        return self.nspilled + len(self.in_memory)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        if self.nspilled:
+            with open(self.order_path, 'rb') as f:
+                while True:
+                    rows = np.fromfile(f, dtype=np.int64, count=SPILL_BATCH)
+                    if not len(rows):
+                        break
+                    yield from rows.tolist()
+        yield from list(self.in_memory)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row index out of range")
+        if i >= self.nspilled:
+            return self.in_memory[i - self.nspilled]
+        with open(self.order_path, 'rb') as f:
+            f.seek(i * np.dtype(np.int64).itemsize)
+            return int(np.fromfile(f, dtype=np.int64, count=1)[0])
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    __hash__ = None  # mutable, like the list it replaces
+
+    def __repr__(self):
+        return 'RowLog({})'.format(list(self))
+
+    @property
+    def order_path(self):
+        return os.path.join(self._tmpdir, 'rows.bin')
+
+    def spill(self):
+        if not self.in_memory:
+            return
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='ss_validate_rows_', dir=self.spill_dir)
+        rows = np.array(self.in_memory, dtype=np.int64)
+        with open(self.order_path, 'ab') as f:
+            rows.tofile(f)
+        path = self.run_path()
+        np.save(path, np.sort(rows))
+        self.runs.append(np.load(path, mmap_mode='r'))
+        self.levels.append(0)
+        while len(self.levels) >= MAX_ROW_RUNS and len(set(self.levels[-MAX_ROW_RUNS:])) == 1:
+            level = self.levels[-1]
+            runs = self.runs[-MAX_ROW_RUNS:]
+            del self.runs[-MAX_ROW_RUNS:], self.levels[-MAX_ROW_RUNS:]
+            path = self.run_path()
+            merge_sorted_runs(runs, path)
+            for run in runs:
+                os.remove(run.filename)
+            self.runs.append(np.load(path, mmap_mode='r'))
+            self.levels.append(level + 1)
+        logger.info("Moved {} rows with errors from memory to {}".format(len(rows), self._tmpdir))
+        self.nspilled += len(rows)
+        self.in_memory = []
+        self.in_memory_set = set()
+
+    def run_path(self):
+        self._nfiles += 1
+        return os.path.join(self._tmpdir, 'run{}.npy'.format(self._nfiles))
+
+    def __del__(self):
+        if self._tmpdir is not None:
+            self.runs = []
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def merge_sorted_runs(runs, path, block=MERGE_BLOCK):
+    """
+    Merge sorted arrays into one written to path, reading `block` rows of each
+    at a time. Each step writes out the rows up to the smallest last row of a
+    block whose run has more after it, as no row still to be read comes before
+    them.
+    """
+    total = sum(len(run) for run in runs)
+    merged = np.lib.format.open_memmap(path, mode='w+', dtype=np.int64, shape=(total,))
+    starts = [0] * len(runs)
+    written = 0
+    while written < total:
+        blocks = [np.asarray(run[start:start + block]) for run, start in zip(runs, starts)]
+        unfinished = [b[-1] for b, run, start in zip(blocks, runs, starts) if start + len(b) < len(run)]
+        last = min(unfinished) if unfinished else None
+        rows = np.sort(np.concatenate(blocks), kind='mergesort')
+        n = int(np.searchsorted(rows, last, side='right')) if unfinished else len(rows)
+        merged[written:written + n] = rows[:n]
+        for i, b in enumerate(blocks):
+            starts[i] += int(np.searchsorted(b, last, side='right')) if unfinished else len(b)
+        written += n
+    merged.flush()
+    del merged
@@ -0,0 +1,242 @@
+import os
+import glob
+import queue
+import shutil
+import logging
+import tempfile
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ss_validate.incremental import errors_to_records, errors_from_records
+from ss_validate.storage import local_name
+from ss_validate.qcstats import QCStats
+
+"""
+Validation partitioned by chromosome, in parallel worker processes.
+
+The row index records the byte offset of every chunk of the file, so the
+workers read, parse and validate whole chunks themselves, and the process
+that started them only hands out chunk numbers. A worker splits its chunk by
+the value of the chromosome column and writes the rows without errors of
+each chromosome to a piece file. Rows whose chromosome is not one of the
+accepted values all fail the chromosome check, so they are kept together, in
+the OTHER partition. The pieces are appended to the output file of their
+chromosome, <file>.chr<chromosome>.valid, in the order of the chunks, which
+is also when the base_pair_locations of each chromosome are checked to be
+sorted. The rows keep their number in the file throughout, and the errors of
+each chunk are handed back in order, so Validator treats them as it would the
+chunks of a serial validation. With qc_stats, each worker also gathers the
+QC statistics of its rows, which are merged when it finishes.
+
+The workers are started with the forkserver (or spawn) method, as the
+validator has threads running, e.g. the one writing the log, which a forked
+child would inherit in whatever state they were in. At most QUEUE_CHUNKS
+chunks per worker are handed out ahead of the first one not yet finished.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+QUEUE_CHUNKS = 4
+OTHER = 'other'
+"""the partition of the rows without an accepted chromosome"""
+
+
+def start_method():
+    return 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class ChromosomePartitions:
+    def __init__(self, validator, processes=None):
+        """
+        :param validator: the Validator reading the file, set up to validate it
+        :param processes: number of worker processes, defaults to the number of CPUs
+        """
+        self.validator = validator
+        self.processes = max(1, processes or os.cpu_count() or 1)
+        self.bp_col = validator.prop_from_field('BP', 'label')
+        self.output_prefix = local_name(validator.file)
+        self.summary = {}
+        """partition -> rows, valid rows, unsorted rows, first unsorted row and output file"""
+        self.last_positions = {}
+        self.workers_done = 0
+
+    def output(self, partition):
+        return '{}.chr{}.valid'.format(self.output_prefix, partition)
+
+    def remove_outputs(self):
+        """
+        Remove the outputs of an earlier run, which may have chromosomes this one hasn't.
+        """
+        for path in glob.glob(glob.escape(self.output_prefix) + '.chr*.valid'):
+            os.remove(path)
+
+    def chunk_errors(self):
+        """
+        Yield (number of rows, errors) for each chunk of the file, in order.
+        """
+        validator = self.validator
+        row_index = validator.get_row_index()
+        nchunks = len(row_index.chunk_offsets)
+        self.remove_outputs()
+        pieces = tempfile.mkdtemp(prefix='ss_validate_partitions_', dir=os.path.dirname(self.output_prefix) or '.')
+        context = multiprocessing.get_context(start_method())
+        tasks = context.Queue()
+        results = context.Queue()
+        settings = {'cwd': os.getcwd(),
+                    'file': validator.file,
+                    'zero_pvalues': validator.zero_pvalues,
+                    'cross_field': validator.cross_field,
+                    'logfile': validator.logfile,
+                    'qc_stats': validator.qc_stats,
+                    'chunksize': validator.chunksize,
+                    'row_index': row_index,
+                    'chromosomes': validator.prop_from_field('CHR', 'validation')[0].options,
+                    'chr_col': validator.prop_from_field('CHR', 'label'),
+                    'bp_col': self.bp_col,
+                    'pieces': pieces}
+        workers = [context.Process(target=partition_worker, args=(tasks, results, settings), daemon=True)
+                   for _ in range(self.processes)]
+        for worker in workers:
+            worker.start()
+        done = {}
+        """chunk -> result of a chunk finished ahead of the ones before it"""
+        queued = 0
+        finished = False
+        try:
+            for number in range(nchunks):
+                while queued < min(nchunks, number + QUEUE_CHUNKS * self.processes):
+                    tasks.put(queued)
+                    queued += 1
+                while number not in done:
+                    try:
+                        self.receive(results.get(timeout=1), done)
+                    except queue.Empty:
+                        check_alive(workers)
+                result = done.pop(number)
+                self.append_pieces(result['pieces'])
+                yield result['nrows'], errors_from_records(result['errors'])
+            for _ in workers:
+                tasks.put(None)
+            while self.workers_done < len(workers):
+                try:
+                    self.receive(results.get(timeout=1), done)
+                except queue.Empty:
+                    check_alive(workers)
+            finished = True
+        finally:
+            for worker in workers:
+                if finished:
+                    worker.join()
+                else:
+                    worker.terminate()
+            shutil.rmtree(pieces, ignore_errors=True)
+        self.log_sortedness()
+
+    def receive(self, result, done):
+        if 'failed' in result:
+            raise RuntimeError("Validation of chunk {} failed:\n{}".format(result['chunk'], result['failed']))
+        if 'qc' in result:
+            if result['qc'] is not None:
+                self.validator.qc.merge(result['qc'])
+            self.workers_done += 1
+            return
+        done[result['chunk']] = result
+
+    def append_pieces(self, pieces):
+        """
+        Append the valid rows of each partition of a chunk to the output of the partition.
+        """
+        for partition, piece in pieces.items():
+            state = self.summary.setdefault(partition, {'rows': 0, 'valid_rows': 0, 'unsorted_rows': 0,
+                                                        'first_unsorted_row': None, 'output': None})
+            state['rows'] += piece['rows']
+            if not piece['valid_rows']:
+                continue
+            self.last_positions[partition] = check_sorted(state, piece['row_numbers'], piece['positions'],
+                                                          self.last_positions.get(partition, -np.inf))
+            output = self.output(partition)
+            with open(output, 'ab' if state['output'] else 'wb') as out, open(piece['path'], 'rb') as f:
+                if not state['output']:
+                    out.write(('\t'.join(self.validator.header) + '\n').encode())
+                shutil.copyfileobj(f, out)
+            os.remove(piece['path'])
+            state['output'] = output
+            state['valid_rows'] += piece['valid_rows']
+
+    def log_sortedness(self):
+        for partition, summary in sorted(self.summary.items()):
+            if summary['unsorted_rows']:
+                logger.warning("base_pair_location is not sorted on chromosome {}: {} rows are before the row "
+                               "above them, the first is row {}".format(partition, summary['unsorted_rows'],
+                                                                        summary['first_unsorted_row']))
+
+
+def check_alive(workers):
+    if not all(worker.is_alive() or worker.exitcode == 0 for worker in workers):
+        raise RuntimeError("A partition worker stopped unexpectedly")
+
+
+def partition_worker(tasks, results, settings):
+    """
+    Read and validate the chunks given to this worker, writing the valid rows
+    of each chromosome in a chunk to a piece file, until it is given None.
+    """
+    # a forkserver's children start in the directory it was started from
+    os.chdir(settings['cwd'])
+    from ss_validate.validator import shard_validator
+    validator = shard_validator(settings['file'], settings['zero_pvalues'], settings['cross_field'],
+                                settings['logfile'])
+    validator.chunksize = settings['chunksize']
+    validator.row_index = settings['row_index']
+    ragged_rows = validator.row_index.ragged_rows
+    chr_col = settings['chr_col']
+    qc = QCStats(validator.header, validator.schema) if settings['qc_stats'] else None
+    while True:
+        number = tasks.get()
+        if number is None:
+            break
+        try:
+            rows = validator.read_chunk(number)
+            errors = validator.validate_df(rows)
+            if qc:
+                qc.add(rows)
+            dropped = rows.index.isin([error.row for error in errors]) | rows.index.isin(ragged_rows)
+            partitions = rows[chr_col].where(rows[chr_col].isin(settings['chromosomes']), OTHER)
+            pieces = {}
+            for partition, part in rows.groupby(partitions, sort=False):
+                valid = part[~dropped[rows.index.get_indexer(part.index)]]
+                piece = {'rows': len(part), 'valid_rows': len(valid)}
+                if len(valid):
+                    piece['path'] = os.path.join(settings['pieces'], '{}.{}.tsv'.format(number, partition))
+                    valid.to_csv(piece['path'], header=False, sep='\t', index=False, na_rep='NA')
+                    piece['row_numbers'] = valid.index.to_numpy(np.int64)
+                    piece['positions'] = pd.to_numeric(valid[settings['bp_col']], errors='coerce').to_numpy(float)
+                pieces[partition] = piece
+            results.put({'chunk': number, 'nrows': len(rows), 'errors': errors_to_records(errors), 'pieces': pieces})
+        except Exception:
+            results.put({'chunk': number, 'failed': traceback.format_exc()})
+            return
+    results.put({'qc': qc})
+
+
+def check_sorted(state, rows, positions, last_position):
+    """
+    Count the rows whose position is before that of a row above them on the same chromosome.
+
+    :param rows: the numbers of the rows
+    :param positions: their positions, as floats
+    :param last_position: the greatest position of the rows before these
+    :return: the greatest position including these rows
+    """
+    running_max = np.fmax.accumulate(np.concatenate([[last_position], positions]))
+    unsorted = np.flatnonzero(positions < running_max[:-1])
+    if len(unsorted):
+        if state['first_unsorted_row'] is None:
+            state['first_unsorted_row'] = int(rows[unsorted[0]])
+        state['unsorted_rows'] += len(unsorted)
+    return running_max[-1]
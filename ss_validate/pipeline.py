@@ -0,0 +1,169 @@
+import io
+import queue
+import threading
+import contextlib
+
+"""
+Overlapping reading, parsing, validating and writing a file.
+
+Each stage runs in its own thread and hands what it makes to the next stage
+through a queue, which holds at most `depth` items, so a stage waits rather
+than filling memory when the stage after it falls behind:
+
+    read and decompress blocks -> parse chunks -> validate -> write
+
+Reads, zlib, the pandas tokenizer and writes release the GIL, so the stages
+overlap even on one core, and the validation doesn't wait on a slow disk or
+network filesystem. When the consumer of a stage stops early, e.g. at the
+error limit, the stages before it stop before their next item and their
+files are closed. An error in a stage is raised where its items are used.
+"""
+
+
+DEPTH = 2
+"""chunks to parse ahead of the validation, and to hold for the writer"""
+BLOCK_SIZE = 1024 * 1024
+READ_AHEAD = 16
+"""blocks to read ahead of the parser"""
+POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+def prefetch(items, depth=DEPTH, pause=None, name='ss-validate-prefetch'):
+    """
+    Iterate over items in a thread, up to depth items ahead of the caller.
+    With a depth of 0 the items are simply iterated.
+
+    :param items: an iterable, which is only used by the thread
+    :param pause: function that returns True while the thread shouldn't get
+        ahead, e.g. under memory pressure
+    """
+    if not depth:
+        yield from items
+        return
+    ahead = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ahead.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        iterator = iter(items)
+        try:
+            while not stop.is_set():
+                while pause is not None and pause() and ahead.qsize() and not stop.is_set():
+                    stop.wait(POLL_SECONDS)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                if not put((item, None)):
+                    break
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = ahead.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+@contextlib.contextmanager
+def background(function, depth=DEPTH, name='ss-validate-writer'):
+    """
+    Yield a function that queues an item for function to be called on in a
+    thread, holding at most depth items. An error in the thread is raised by
+    the next call or on leaving the context. With a depth of 0 function is
+    called straight away.
+    """
+    if not depth:
+        yield function
+        return
+    items = queue.Queue(maxsize=depth)
+    errors = []
+
+    def run():
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if not errors:
+                try:
+                    function(item)
+                except BaseException as e:
+                    errors.append(e)
+
+    def put(item):
+        if errors:
+            raise errors[0]
+        items.put(item)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        yield put
+    finally:
+        items.put(_DONE)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class PrefetchReader(io.RawIOBase):
+    def __init__(self, open_file, read_ahead=READ_AHEAD, block_size=BLOCK_SIZE):
+        """
+        A file whose bytes are read ahead, in blocks, by a thread.
+
+        :param open_file: function that opens the file for reading bytes, called by the thread
+        """
+        super().__init__()
+        self.blocks = prefetch(read_blocks(open_file, block_size), read_ahead, name='ss-validate-reader')
+        self.block = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.block):
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.block = memoryview(block)
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.blocks.close()
+        super().close()
+
+
+def read_blocks(open_file, block_size):
+    with open_file() as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block
@@ -0,0 +1,305 @@
+import json
+import math
+from statistics import NormalDist
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+"""
+QC summary statistics computed while a file is validated.
+
+QCStats sees the rows of each chunk as they are read, as strings, and keeps
+only summaries that can be merged with those of other chunks, so the chunks
+of a sharded or partitioned validation are summarised by the workers and
+merged in any order:
+
+- the number of rows, rows per chromosome and missing values per column, as counts
+- effect_allele_frequency and p_value, as histograms with fixed bins
+- the median p_value, as a t-digest, from which the genomic inflation
+  factor λGC = median chi-square / 0.4549 is found without sorting the p-values
+- the beta, odds_ratio, hazard_ratio and standard_error, as their range
+
+Values that are not numbers are counted apart, so the statistics of a file
+with errors are still those of its well formed values.
+"""
+
+
+HISTOGRAM_BINS = 20
+DIGEST_COMPRESSION = 500
+CHISQ_MEDIAN = 0.454936423119572
+"""the median of the chi-square distribution with 1 degree of freedom"""
+RANGE_FIELDS = ('BETA', 'OR', 'HR', 'SE')
+
+
+class Histogram:
+    def __init__(self, lower, upper, bins=HISTOGRAM_BINS):
+        self.edges = np.linspace(lower, upper, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+        self.total = 0.0
+
+    def add(self, values):
+        """
+        :param values: finite numbers
+        """
+        inside = (values >= self.edges[0]) & (values <= self.edges[-1])
+        self.counts += np.histogram(values[inside], bins=self.edges)[0]
+        self.below += int((values < self.edges[0]).sum())
+        self.above += int((values > self.edges[-1]).sum())
+        self.total += float(values.sum())
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+        self.total += other.total
+
+    def to_dict(self):
+        return {'counts': self.counts.tolist(), 'below': self.below, 'above': self.above, 'total': self.total}
+
+    def load(self, state):
+        self.counts = np.array(state['counts'], dtype=np.int64)
+        self.below, self.above, self.total = state['below'], state['above'], state['total']
+
+    @property
+    def count(self):
+        return int(self.counts.sum()) + self.below + self.above
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'edges': self.edges.tolist(),
+                'counts': self.counts.tolist(),
+                'below': self.below,
+                'above': self.above}
+
+
+class TDigest:
+    def __init__(self, compression=DIGEST_COMPRESSION):
+        """
+        A merging t-digest: the values are kept as centroids (mean, weight),
+        small in the tails and larger in the middle, so that quantiles are
+        accurate to a fraction of the weight of the centroids around them.
+
+        :param compression: about twice the number of centroids kept
+        """
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self.compress(np.concatenate([self.means, values]),
+                          np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other):
+        if len(other.weights):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self.compress(np.concatenate([self.means, other.means]),
+                          np.concatenate([self.weights, other.weights]))
+
+    def compress(self, means, weights):
+        """
+        Merge neighbouring centroids whose quantiles are within one unit of the
+        scale function k(q) = compression / 2π * asin(2q - 1).
+        """
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def to_dict(self):
+        return {'means': self.means.tolist(), 'weights': self.weights.tolist(), 'min': self.min, 'max': self.max}
+
+    def load(self, state):
+        self.means = np.array(state['means'], dtype=float)
+        self.weights = np.array(state['weights'], dtype=float)
+        self.min, self.max = state['min'], state['max']
+
+    def quantile(self, q):
+        if not len(self.weights):
+            return None
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.weights.sum(),
+                               np.concatenate([[0], centres, [self.weights.sum()]]),
+                               np.concatenate([[self.min], self.means, [self.max]])))
+
+
+class Extent:
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        if len(values):
+            self.count += len(values)
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        return {'count': self.count, 'min': self.min, 'max': self.max}
+
+    def load(self, state):
+        self.count, self.min, self.max = state['count'], state['min'], state['max']
+
+    def summary(self):
+        return {'count': self.count,
+                'min': self.min if self.count else None,
+                'max': self.max if self.count else None}
+
+
+class QCStats:
+    def __init__(self, header, schema):
+        """
+        :param header: labels of the columns of the file
+        """
+        labels = {field_id: field['label'] for field_id, field in schema['fields'].items()}
+        present = {field_id: label for field_id, label in labels.items() if label in header}
+        self.header = list(header)
+        self.chr_col = present.get('CHR')
+        self.pval_col = present.get('PVAL')
+        self.neg_log_pval_col = present.get('NEG_LOG_PVAL')
+        self.eaf_col = present.get('EAF')
+        self.range_cols = [present[field_id] for field_id in RANGE_FIELDS if field_id in present]
+        self.rows = 0
+        self.chromosomes = Counter()
+        self.missing = Counter()
+        self.not_numeric = Counter()
+        self.eaf = Histogram(0, 1)
+        self.pvalues = Histogram(0, 1)
+        self.pvalue_digest = TDigest()
+        self.ranges = {column: Extent() for column in self.range_cols}
+
+    def get_errors(self, df):
+        """
+        Add the rows of a chunk. The statistics don't find errors, but are
+        gathered along with the checks that see every chunk.
+        """
+        self.add(df)
+        return []
+
+    def finish(self):
+        return []
+
+    def spill_memory_runs(self):
+        """
+        Nothing to move out of memory: the statistics don't grow with the rows.
+        """
+
+    def add(self, df):
+        self.rows += len(df)
+        # column by column, which is several times faster than DataFrame.isna() on strings
+        missing = {column: df[column].isna().to_numpy() for column in df.columns}
+        self.missing.update({column: int(mask.sum()) for column, mask in missing.items()})
+        if self.chr_col:
+            self.chromosomes.update(df[self.chr_col].value_counts().to_dict())
+        if self.eaf_col:
+            self.eaf.add(self.numbers(df, self.eaf_col, missing))
+        if self.pval_col:
+            pvalues = self.numbers(df, self.pval_col, missing)
+        elif self.neg_log_pval_col:
+            pvalues = 10 ** -self.numbers(df, self.neg_log_pval_col, missing)
+        else:
+            pvalues = None
+        if pvalues is not None:
+            self.pvalues.add(pvalues)
+            self.pvalue_digest.add(pvalues[(pvalues >= 0) & (pvalues <= 1)])
+        for column in self.range_cols:
+            self.ranges[column].add(self.numbers(df, column, missing))
+
+    def numbers(self, df, column, missing):
+        """
+        The finite numbers in a column, counting the values that are not.
+        """
+        numbers = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+        finite = np.isfinite(numbers)
+        self.not_numeric[column] += int((~finite & ~missing[column]).sum())
+        return numbers[finite]
+
+    def merge(self, other):
+        """
+        Add the statistics of other rows of the same file.
+        """
+        self.rows += other.rows
+        self.chromosomes.update(other.chromosomes)
+        self.missing.update(other.missing)
+        self.not_numeric.update(other.not_numeric)
+        self.eaf.merge(other.eaf)
+        self.pvalues.merge(other.pvalues)
+        self.pvalue_digest.merge(other.pvalue_digest)
+        for column, extent in other.ranges.items():
+            self.ranges[column].merge(extent)
+        return self
+
+    def to_dict(self):
+        """
+        The state of the statistics, for a worker to send as JSON.
+        """
+        return {'rows': self.rows,
+                'chromosomes': dict(self.chromosomes),
+                'missing': dict(self.missing),
+                'not_numeric': dict(self.not_numeric),
+                'eaf': self.eaf.to_dict(),
+                'pvalues': self.pvalues.to_dict(),
+                'pvalue_digest': self.pvalue_digest.to_dict(),
+                'ranges': {column: extent.to_dict() for column, extent in self.ranges.items()}}
+
+    @classmethod
+    def from_dict(cls, header, schema, state):
+        stats = cls(header, schema)
+        stats.rows = state['rows']
+        for name in ['chromosomes', 'missing', 'not_numeric']:
+            getattr(stats, name).update(state[name])
+        for name in ['eaf', 'pvalues', 'pvalue_digest']:
+            getattr(stats, name).load(state[name])
+        for column, extent in state['ranges'].items():
+            stats.ranges[column].load(extent)
+        return stats
+
+    def lambda_gc(self):
+        median = self.pvalue_digest.quantile(0.5)
+        if median is None or median <= 0:
+            return None
+        return NormalDist().inv_cdf(median / 2) ** 2 / CHISQ_MEDIAN
+
+    def summary(self):
+        summary = {'rows': self.rows,
+                   'chromosomes': dict(sorted(self.chromosomes.items(), key=chromosome_order)),
+                   'missing': {column: {'count': self.missing[column],
+                                        'fraction': self.missing[column] / self.rows if self.rows else None}
+                               for column in self.header},
+                   'not_numeric': {column: count for column, count in self.not_numeric.items() if count}}
+        if self.eaf_col:
+            summary[self.eaf_col] = self.eaf.summary()
+        if self.pval_col or self.neg_log_pval_col:
+            summary['p_value'] = dict(self.pvalues.summary(),
+                                      median=self.pvalue_digest.quantile(0.5),
+                                      lambda_gc=self.lambda_gc())
+        summary['ranges'] = {column: extent.summary() for column, extent in self.ranges.items()}
+        return summary
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def chromosome_order(item):
+    chromosome = str(item[0])
+    return (0, int(chromosome), '') if chromosome.isdigit() else (1, 0, chromosome)
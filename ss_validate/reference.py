@@ -0,0 +1,297 @@
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+"""
+Checking the alleles of each row against a reference genome.
+
+The reference is a local, uncompressed FASTA file with a samtools style .fai
+index, which is written next to it the first time it is used if it doesn't
+exist. The FASTA is memory mapped, and the bases at the positions of a whole
+chunk are looked up at once with numpy, so only the pages holding them are
+read. A row matches the reference if its effect_allele or other_allele is
+the sequence at base_pair_location, and is flipped if neither is, but the
+reverse complement of one of them is. Rows that don't match, flipped or
+not, are flagged.
+
+Most rows of a file on the same build as the reference match it, while a
+file on another build matches at about the rate of chance, so the mismatch
+rate tells whether the file is on the build of the reference, which is
+recognised by the length of its chromosome 1.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ALLELE_LENGTH = 50
+"""longer alleles are not checked"""
+MAX_FLAGGED_ROWS = 1000
+"""flagged rows to list in the summary, the rest are only counted"""
+MATCH_RATE = 0.9
+"""the fraction of rows that match a reference of the same build, at least"""
+BUILDS = {247249719: 'NCBI36', 249250621: 'GRCh37', 248956422: 'GRCh38'}
+"""length of chromosome 1 -> build"""
+CHROMOSOME_ALIASES = {'23': 'X', '24': 'Y', '25': 'MT', 'M': 'MT'}
+COMPLEMENT = np.frombuffer(bytes(range(256)).translate(bytes.maketrans(b'ACGT', b'TGCA')), dtype=np.uint8)
+"""byte -> byte of its complement"""
+IS_BASE = np.isin(np.arange(256), np.frombuffer(b'ACGT', dtype=np.uint8))
+
+
+def chromosome_key(name):
+    """
+    The name of a chromosome without a 'chr' prefix, in upper case, with
+    23, 24 and 25 for X, Y and MT.
+    """
+    key = str(name).upper()
+    if key.startswith('CHR'):
+        key = key[3:]
+    return CHROMOSOME_ALIASES.get(key, key)
+
+
+class FastaIndex:
+    def __init__(self, records):
+        """
+        :param records: (name, length, offset, line bases, line width) of each sequence
+        """
+        self.records = records
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls([(name, int(length), int(offset), int(line_bases), int(line_width))
+                        for name, length, offset, line_bases, line_width, *_ in
+                        (line.rstrip('\n').split('\t') for line in f if line.strip())])
+
+    @classmethod
+    def build(cls, fasta):
+        """
+        Index a FASTA file as samtools faidx does.
+        """
+        records = []
+        offset = 0
+        name = None
+        with open(fasta, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        records.append((name, length, start, line_bases, line_width))
+                    name = line[1:].split()[0].decode()
+                    start = offset + len(line)
+                    length = line_bases = line_width = 0
+                elif name is not None:
+                    bases = len(line.rstrip(b'\r\n'))
+                    if not line_bases:
+                        line_bases, line_width = bases, len(line)
+                    length += bases
+                offset += len(line)
+        if name is not None:
+            records.append((name, length, start, line_bases, line_width))
+        return cls(records)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write('\t'.join(str(value) for value in record) + '\n')
+
+
+class ReferenceGenome:
+    def __init__(self, fasta):
+        """
+        :param fasta: path of an uncompressed FASTA file
+        """
+        if fasta.endswith(('.gz', '.bgz')):
+            raise ValueError("The reference must be an uncompressed FASTA file: {}".format(fasta))
+        self.fasta = fasta
+        fai = fasta + '.fai'
+        if os.path.exists(fai):
+            self.index = FastaIndex.load(fai)
+        else:
+            logger.info("Indexing {}...".format(fasta))
+            self.index = FastaIndex.build(fasta)
+            try:
+                self.index.save(fai)
+            except OSError as e:
+                logger.warning("Could not save the index of the reference: {}".format(e))
+        self.bases = np.memmap(fasta, dtype=np.uint8, mode='r')
+        self.sequences = {chromosome_key(name): i for i, (name, *_) in enumerate(self.index.records)}
+        self.lengths = np.array([record[1] for record in self.index.records], dtype=np.int64)
+        self.offsets = np.array([record[2] for record in self.index.records], dtype=np.int64)
+        self.line_bases = np.array([max(1, record[3]) for record in self.index.records], dtype=np.int64)
+        self.line_widths = np.array([record[4] for record in self.index.records], dtype=np.int64)
+        chr1 = self.sequences.get('1')
+        self.build = BUILDS.get(int(self.lengths[chr1])) if chr1 is not None else None
+
+    def sequence_ids(self, chromosomes):
+        """
+        The number of the sequence of each chromosome, or -1 if the reference doesn't have it.
+        """
+        keys = {value: self.sequences.get(chromosome_key(value), -1) for value in chromosomes.dropna().unique()}
+        return chromosomes.map(keys).fillna(-1).to_numpy(dtype=np.int64)
+
+    def fetch(self, sequences, positions, length):
+        """
+        The upper case bases from 1-based positions, length of them for each,
+        as an array of shape (len(positions), length). Every position must be
+        within its sequence.
+        """
+        bases = positions[:, None] - 1 + np.arange(length)
+        lines, within = np.divmod(bases, self.line_bases[sequences][:, None])
+        offsets = self.offsets[sequences][:, None] + lines * self.line_widths[sequences][:, None] + within
+        # the bytes of lower case letters have bit 5 set
+        return self.bases[offsets] & 0xDF
+
+
+class ReferenceCheck:
+    def __init__(self, reference, chr_col, bp_col, effect_col, other_col):
+        """
+        :param reference: a ReferenceGenome
+        """
+        self.reference = reference
+        self.chr_col = chr_col
+        self.bp_col = bp_col
+        self.effect_col = effect_col
+        self.other_col = other_col
+        self.rows = 0
+        self.matched = 0
+        self.flipped = 0
+        self.mismatched = 0
+        self.unknown_chromosome = 0
+        self.out_of_range = 0
+        self.flagged_rows = []
+
+    def get_errors(self, df):
+        """
+        Check the rows of a chunk. Mismatches are counted and flagged rather
+        than made errors, so the check is gathered along with the checks that
+        see every chunk.
+        """
+        self.add(df)
+        return []
+
+    def finish(self):
+        return []
+
+    def spill_memory_runs(self):
+        """
+        Nothing to move out of memory: the counts are fixed in size, the
+        flagged rows are limited to MAX_FLAGGED_ROWS, and the reference is
+        memory mapped, so its pages are already given back under pressure.
+        """
+
+    def add(self, df):
+        self.rows += len(df)
+        sequences = self.reference.sequence_ids(df[self.chr_col])
+        positions = as_numbers(df[self.bp_col])
+        effect = Alleles(df[self.effect_col])
+        other = Alleles(df[self.other_col])
+        lengths = np.maximum(effect.lengths, other.lengths)
+        known = sequences >= 0
+        self.unknown_chromosome += int((~known & df[self.chr_col].notna().to_numpy()).sum())
+        checkable = known & np.isfinite(positions) & (lengths > 0) & (lengths <= MAX_ALLELE_LENGTH)
+        positions = np.where(checkable, positions, 1).astype(np.int64)
+        within = (positions >= 1) & (positions + lengths - 1 <= self.reference.lengths[np.maximum(sequences, 0)])
+        self.out_of_range += int((checkable & ~within).sum())
+        checkable &= within
+        rows = np.flatnonzero(checkable)
+        if not len(rows):
+            return
+        matched = np.zeros(len(rows), dtype=bool)
+        flipped = np.zeros(len(rows), dtype=bool)
+        # the rows whose longer allele has the same length are looked up together,
+        # and each allele is compared with as many bases as it has
+        for length in np.unique(lengths[rows]):
+            group = np.flatnonzero(lengths[rows] == length)
+            group_rows = rows[group]
+            bases = self.reference.fetch(sequences[group_rows], positions[group_rows], length)
+            offsets = np.arange(length)
+            for alleles in (effect, other):
+                allele_lengths = alleles.lengths[group_rows][:, None]
+                allele_bases = alleles.bases(group_rows, length)
+                beyond = offsets >= allele_lengths
+                present = allele_lengths[:, 0] > 0
+                matched[group] |= present & ((allele_bases == bases) | beyond).all(axis=1)
+                reversed_offsets = np.where(beyond, offsets, allele_lengths - 1 - offsets)
+                complement = np.take_along_axis(COMPLEMENT[allele_bases], reversed_offsets, axis=1)
+                flipped[group] |= present & ((complement == bases) | beyond).all(axis=1)
+        flipped &= ~matched
+        self.matched += int(matched.sum())
+        self.flipped += int(flipped.sum())
+        self.mismatched += int((~matched & ~flipped).sum())
+        if len(self.flagged_rows) < MAX_FLAGGED_ROWS:
+            flagged = df.index[rows[~matched]][:MAX_FLAGGED_ROWS - len(self.flagged_rows)]
+            self.flagged_rows.extend(int(row) for row in flagged)
+
+    @property
+    def checked(self):
+        return self.matched + self.flipped + self.mismatched
+
+    def likely_build(self):
+        """
+        The build of the reference if the rows match it, otherwise None.
+        """
+        if self.checked and self.matched / self.checked >= MATCH_RATE:
+            return self.reference.build or os.path.basename(self.reference.fasta)
+        return None
+
+    def summary(self):
+        checked = self.checked
+        return {'reference': self.reference.fasta,
+                'reference_build': self.reference.build,
+                'rows': self.rows,
+                'checked': checked,
+                'matched': self.matched,
+                'flipped': self.flipped,
+                'mismatched': self.mismatched,
+                'mismatch_rate': (self.flipped + self.mismatched) / checked if checked else None,
+                'unknown_chromosome': self.unknown_chromosome,
+                'out_of_range': self.out_of_range,
+                'likely_build': self.likely_build(),
+                'flagged_rows': self.flagged_rows}
+
+    def log_summary(self):
+        summary = self.summary()
+        if not summary['checked']:
+            logger.warning("No rows could be checked against the reference {}".format(self.reference.fasta))
+            return
+        logger.info("Alleles of {} of {} rows checked against the reference don't match it ({:.2%}), "
+                    "{} of them are strand flips".format(self.flipped + self.mismatched, summary['checked'],
+                                                         summary['mismatch_rate'], self.flipped))
+        if summary['likely_build']:
+            logger.info("The file is likely on {}".format(summary['likely_build']))
+        else:
+            logger.warning("The file is likely not on the build of the reference{}".format(
+                ', {}'.format(self.reference.build) if self.reference.build else ''))
+
+
+def as_numbers(column):
+    """
+    The values of a column as floats, NaN where they are not numbers.
+    """
+    try:
+        # much faster than to_numeric, when every value is a number
+        return column.astype(float).to_numpy()
+    except (ValueError, TypeError):
+        return pd.to_numeric(column, errors='coerce').to_numpy(dtype=float)
+
+
+class Alleles:
+    def __init__(self, column):
+        """
+        The alleles of a column, in upper case, as one array of bytes. Alleles
+        that are not all A, C, G and T are given a length of 0.
+        """
+        values = column.fillna('').tolist()
+        lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+        # a character that is not ASCII becomes one byte, so the alleles start where their lengths say
+        self.bytes = np.frombuffer((''.join(values) + '\0').encode('ascii', 'replace'), dtype=np.uint8) & 0xDF
+        self.starts = np.cumsum(lengths) - lengths
+        not_bases = np.concatenate([[0], np.cumsum(~IS_BASE[self.bytes])])
+        self.lengths = np.where(not_bases[self.starts + lengths] == not_bases[self.starts], lengths, 0)
+
+    def bases(self, rows, length):
+        """
+        The first length bytes of the alleles of some rows, as an array of shape (len(rows), length).
+        """
+        return self.bytes[np.minimum(self.starts[rows][:, None] + np.arange(length), len(self.bytes) - 1)]
@@ -0,0 +1,124 @@
+import json
+import math
+import time
+from collections import Counter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""
+Machine readable error reports.
+
+Errors are written to the report as they are found, one record per failing
+cell, followed by a summary record with the counts per field and rule, the
+number of rows scanned and the time taken by each stage. Reports ending in
+.parquet are written as Parquet (requires pyarrow), with the summary in a
+<report>.summary.json file alongside, and anything else as JSON Lines.
+"""
+
+
+ERROR_FIELDS = ['row', 'line', 'column', 'field', 'rule', 'value', 'message']
+PARQUET_BATCH_SIZE = 65536
+
+
+class ErrorReport:
+    def __init__(self, path):
+        self.path = path
+        self.counts = Counter()
+        self.nerrors = 0
+        self.start_time = time.time()
+
+    def add(self, records):
+        """
+        :param records: dicts with the keys in ERROR_FIELDS
+        """
+        for record in records:
+            self.counts[(record['field'], record['column'], record['rule'])] += 1
+        self.nerrors += len(records)
+        self.write_errors(records)
+
+    def close(self, **summary):
+        summary = dict(summary,
+                       errors=self.nerrors,
+                       counts=[{'field': field, 'column': column, 'rule': rule, 'count': count}
+                               for (field, column, rule), count in sorted(self.counts.items(), key=str)],
+                       elapsed_seconds=round(time.time() - self.start_time, 3))
+        self.write_summary(summary)
+
+    def write_errors(self, records):
+        raise NotImplementedError
+
+    def write_summary(self, summary):
+        raise NotImplementedError
+
+
+class JsonLinesReport(ErrorReport):
+    def __init__(self, path):
+        super().__init__(path)
+        self.fh = open(path, 'w')
+
+    def write_errors(self, records):
+        for record in records:
+            self.fh.write(json.dumps(dict(type='error', **record)) + '\n')
+
+    def write_summary(self, summary):
+        self.fh.write(json.dumps(dict(type='summary', **summary)) + '\n')
+        self.fh.close()
+
+
+class ParquetReport(ErrorReport):
+    def __init__(self, path, batch_size=PARQUET_BATCH_SIZE):
+        if pa is None:
+            raise ImportError("pyarrow is required to write the report as parquet")
+        super().__init__(path)
+        self.batch_size = batch_size
+        self.batch = []
+        self.schema = pa.schema([('row', pa.int64()),
+                                 ('line', pa.int64()),
+                                 ('column', pa.string()),
+                                 ('field', pa.string()),
+                                 ('rule', pa.string()),
+                                 ('value', pa.string()),
+                                 ('message', pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_errors(self, records):
+        self.batch.extend(records)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.writer.write_table(pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def write_summary(self, summary):
+        self.flush()
+        self.writer.close()
+        with open(self.path + '.summary.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def open_report(path):
+    if path.endswith('.parquet'):
+        return ParquetReport(path)
+    return JsonLinesReport(path)
+
+
+def error_record(error, line=None, field=None):
+    """
+    The report record of a pandas_schema ValidationWarning.
+    """
+    value = error.value
+    if isinstance(value, float) and math.isnan(value):
+        value = None
+    return {'row': int(error.row),
+            'line': line,
+            'column': error.column,
+            'field': field,
+            'rule': getattr(error, 'rule', None),
+            'value': None if value is None else str(value),
+            'message': error.message}
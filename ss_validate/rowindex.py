@@ -0,0 +1,247 @@
+import os
+import numpy as np
+
+from ss_validate.helpers import open_binary, is_data_line
+from ss_validate.storage import file_stat, local_name
+
+"""
+A single row numbering shared by every stage of the validation.
+
+Rows are numbered from 0 in the order of the data rows in the file, ignoring
+the header, comment lines and blank lines. This is the numbering that pandas
+gives a file read with comment='#' and index_col=False.
+Only the exceptions are stored (skipped lines, ragged rows and a checkpoint
+every `spacing` rows), so the index stays small for files with millions of rows.
+It can be saved next to the file, to look up the rows reported in the errors
+without rescanning the file.
+"""
+
+
+CHECKPOINT_SPACING = 1024
+INDEX_VERSION = 2
+"""the version of the saved index, an index saved by another version is rebuilt"""
+
+
+class RowIndex:
+    ARRAYS = ['skipped_lines', 'ragged_rows', 'ragged_nfields', 'checkpoint_rows', 'checkpoints', 'access_points']
+
+    def __init__(self, file, ncols, header_line, spacing=CHECKPOINT_SPACING):
+        self.file = file
+        self.ncols = ncols
+        self.header_line = header_line
+        self.spacing = spacing
+        self.nrows = 0
+        self.skipped_lines = np.empty(0, dtype=np.int64)
+        """1-based line numbers of comment and blank lines after the header"""
+        self.ragged_rows = np.empty(0, dtype=np.int64)
+        self.ragged_nfields = np.empty(0, dtype=np.int64)
+        self.checkpoint_rows = np.empty(0, dtype=np.int64)
+        self.checkpoints = np.empty(0, dtype=np.int64)
+        """byte offset (uncompressed) of the checkpoint rows, which are at most `spacing` rows apart"""
+        self.access_points = np.empty((0, 2), dtype=np.int64)
+        """(compressed offset, uncompressed offset) of gzip members to start reading from"""
+        self.chunk_rows = None
+        self.chunk_offsets = np.empty(0, dtype=np.int64)
+        self.chunk_digests = np.empty(0, dtype='U32')
+        """byte offset and content digest of every chunk of `chunk_rows` rows"""
+        self._blocks = []
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def square(self):
+        return len(self.ragged_rows) == 0
+
+    def line(self, rows):
+        """
+        1-based physical line numbers of the given rows.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        candidate = self.header_line + 1 + rows
+        return candidate + count_gaps_before(self.skipped_lines, candidate)
+
+    def ragged_lines(self):
+        return list(zip(self.line(self.ragged_rows).tolist(), self.ragged_nfields.tolist()))
+
+    def iter_rows(self, start=0):
+        """
+        Yield (row, offset, text) for the rows from `start` onwards, reading
+        from the nearest checkpoint rather than the start of the file.
+        """
+        checkpoint = np.searchsorted(self.checkpoint_rows, start, side='right') - 1
+        offset = int(self.checkpoints[checkpoint])
+        row = int(self.checkpoint_rows[checkpoint])
+        with open_binary(self.file, offset, self.access_points) as fh:
+            for text in fh:
+                if is_data_line(text):
+                    if row >= start:
+                        yield row, offset, text
+                    row += 1
+                offset += len(text)
+
+    def offset(self, row):
+        """
+        Byte offset of the start of a row in the (uncompressed) file.
+        """
+        self.check_row(row)
+        for _, offset, _ in self.iter_rows(row):
+            return offset
+
+    def fetch(self, row, context=0):
+        """
+        A row and up to `context` rows either side of it.
+
+        :return: list of (row, line number, text) tuples
+        """
+        self.check_row(row)
+        fetched = []
+        for current, _, text in self.iter_rows(max(row - context, 0)):
+            if current > row + context:
+                break
+            fetched.append((current, text.rstrip(b'\r\n').decode(errors='replace')))
+        rows = [current for current, _ in fetched]
+        return [(current, line, text) for (current, text), line in zip(fetched, self.line(rows).tolist())]
+
+    def set_chunks(self, chunk_rows, offsets, digests):
+        self.chunk_rows = chunk_rows
+        self.chunk_offsets = np.array(offsets, dtype=np.int64)
+        self.chunk_digests = np.array(digests, dtype='U32')
+
+    def read_chunk(self, chunk):
+        """
+        The bytes of a chunk of `chunk_rows` rows.
+        """
+        start = int(self.chunk_offsets[chunk])
+        with open_binary(self.file, start, self.access_points) as fh:
+            if chunk + 1 < len(self.chunk_offsets):
+                return fh.read(int(self.chunk_offsets[chunk + 1]) - start)
+            return fh.read()
+
+    def check_row(self, row):
+        if not 0 <= row < self.nrows:
+            raise IndexError("Row {} is not in {}, which has {} rows".format(row, self.file, self.nrows))
+
+    def save(self, path=None):
+        path = path or index_path(self.file)
+        size, mtime = file_stat(self.file)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f,
+                                index_version=INDEX_VERSION,
+                                file_size=size,
+                                file_mtime=mtime,
+                                ncols=self.ncols,
+                                header_line=self.header_line,
+                                spacing=self.spacing,
+                                nrows=self.nrows,
+                                skipped_lines=self.skipped_lines,
+                                ragged_rows=self.ragged_rows,
+                                ragged_nfields=self.ragged_nfields,
+                                checkpoint_rows=self.checkpoint_rows,
+                                checkpoints=self.checkpoints,
+                                access_points=self.access_points,
+                                chunk_rows=self.chunk_rows or 0,
+                                chunk_offsets=self.chunk_offsets,
+                                chunk_digests=self.chunk_digests)
+        return path
+
+    @classmethod
+    def load(cls, file, path=None):
+        """
+        Load the saved index of a file, or None if there isn't one, it was
+        saved by another version or the file has changed since it was saved.
+        """
+        path = path or index_path(file)
+        if not os.path.exists(path):
+            return None
+        size, mtime = file_stat(file)
+        with np.load(path) as saved:
+            if 'index_version' not in saved or saved['index_version'] != INDEX_VERSION:
+                return None
+            if saved['file_size'] != size or saved['file_mtime'] != mtime:
+                return None
+            index = cls(file,
+                        ncols=int(saved['ncols']),
+                        header_line=int(saved['header_line']),
+                        spacing=int(saved['spacing']))
+            index.nrows = int(saved['nrows'])
+            for name in cls.ARRAYS:
+                setattr(index, name, saved[name])
+            if saved['chunk_rows']:
+                index.set_chunks(int(saved['chunk_rows']), saved['chunk_offsets'], saved['chunk_digests'])
+        return index
+
+    def add_block(self, rows, nfields, skipped_lines, offsets):
+        """
+        Append the rows found in one block of the file.
+
+        :param rows: row numbers of the data rows in the block
+        :param nfields: number of fields on each data row
+        :param skipped_lines: line numbers of comment and blank lines
+        :param offsets: byte offsets of the data rows
+        """
+        self.nrows += len(rows)
+        ragged = nfields != self.ncols
+        checkpoint = rows % self.spacing == 0
+        self._blocks.append((skipped_lines,
+                             rows[ragged],
+                             nfields[ragged],
+                             rows[checkpoint],
+                             offsets[checkpoint]))
+
+    def extend(self, part, row_base, line_base, byte_base):
+        """
+        Append the index of a later part of the file, which was built with the
+        rows, lines and byte offsets numbered from the start of the part.
+
+        :param row_base: number of rows before the part
+        :param line_base: number of lines before the part
+        :param byte_base: (uncompressed) offset of the first row of the part
+        """
+        self.nrows += part.nrows
+        self._blocks.append((part.skipped_lines + line_base,
+                             part.ragged_rows + row_base,
+                             part.ragged_nfields,
+                             part.checkpoint_rows + row_base,
+                             part.checkpoints + byte_base))
+
+    def finalise(self):
+        if self._blocks:
+            # the blocks hold every array but the access points, in the order of ARRAYS
+            for name, arrays in zip(self.ARRAYS[:-1], zip(*self._blocks)):
+                setattr(self, name, np.concatenate((getattr(self, name),) + arrays))
+            self._blocks = []
+        return self
+
+    def to_dict(self):
+        """
+        The index as plain python types, to send it as JSON.
+        """
+        self.finalise()
+        return dict({name: getattr(self, name).tolist() for name in self.ARRAYS},
+                    ncols=int(self.ncols),
+                    header_line=int(self.header_line),
+                    spacing=int(self.spacing),
+                    nrows=int(self.nrows))
+
+    @classmethod
+    def from_dict(cls, file, fields):
+        index = cls(file, ncols=fields['ncols'], header_line=fields['header_line'], spacing=fields['spacing'])
+        index.nrows = fields['nrows']
+        for name in cls.ARRAYS:
+            setattr(index, name, np.array(fields[name], dtype=np.int64))
+        index.access_points = index.access_points.reshape(-1, 2)
+        return index
+
+
+def index_path(file):
+    return local_name(file) + ".idx.npz"
+
+
+def count_gaps_before(gaps, values):
+    """
+    For a sorted array of removed positions `gaps`, the number of them that
+    precede each of `values`, where values count only the positions left over.
+    """
+    shifted = gaps - np.arange(len(gaps))
+    return np.searchsorted(shifted, values, side='right')
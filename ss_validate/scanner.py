@@ -0,0 +1,246 @@
+import hashlib
+import numpy as np
+
+from ss_validate.helpers import open_binary
+from ss_validate.rowindex import RowIndex, CHECKPOINT_SPACING
+
+"""
+Squareness scanner for summary statistics files.
+
+Rather than parsing every row with the csv module, the file is read in large
+byte blocks and the delimiters on each line are counted with numpy. Comment
+lines (starting with '#') and blank lines are skipped, and anything after an
+inline '#' is ignored, in the same way that pandas.read_csv(comment='#') does
+in Validator.df_iterator(). Lines with a '"' are counted field by field, as
+pandas reads them, since a quoted field may hold the delimiter or a '#'.
+Quoted fields that run over more than one line are not supported: each line
+is counted as a row. The scan also builds the RowIndex that the other stages
+use to number rows.
+"""
+
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+COMMENT = ord('#')
+QUOTE = ord('"')
+BLOCKSIZE = 4 * 1024 * 1024
+
+
+def iter_line_blocks(fh, blocksize=BLOCKSIZE):
+    """
+    Yield blocks of bytes that always end on a newline.
+    A trailing line without a newline is yielded with one appended.
+    """
+    remainder = b''
+    while True:
+        data = fh.read(blocksize)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            remainder = data
+            continue
+        remainder = data[cut:]
+        yield data[:cut]
+    if remainder:
+        yield remainder + b'\n'
+
+
+def fields_per_line(block, sep):
+    """
+    Count the fields on every line of a block of complete lines.
+
+    :param block: bytes ending with a newline
+    :param sep: single byte delimiter
+    :return: (starts, nfields, is_record) numpy arrays with one element per line,
+        is_record being False for comment and blank lines
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == NEWLINE)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    lengths = ends - starts
+    has_content = lengths > 0
+    # ignore the '\r' of windows line endings
+    has_cr = np.zeros(len(ends), dtype=bool)
+    has_cr[has_content] = buf[ends[has_content] - 1] == CARRIAGE_RETURN
+    has_content &= (lengths - has_cr) > 0
+
+    first_byte = buf[np.minimum(starts, len(buf) - 1)]
+    is_record = has_content & (first_byte != COMMENT)
+
+    delimiters = np.flatnonzero(buf == ord(sep))
+    nfields = np.diff(np.searchsorted(delimiters, ends), prepend=0) + 1
+
+    # inline comments truncate the row, so count only the fields before them
+    hashes = np.flatnonzero(buf == COMMENT)
+    if len(hashes):
+        for i in np.unique(np.searchsorted(ends, hashes)):
+            if is_record[i]:
+                line = block[starts[i]:ends[i]]
+                nfields[i] = line[:line.index(b'#')].count(sep.encode()) + 1
+
+    quotes = np.flatnonzero(buf == QUOTE)
+    if len(quotes):
+        for i in np.unique(np.searchsorted(ends, quotes)):
+            if is_record[i]:
+                nfields[i] = count_quoted_fields(block[starts[i]:ends[i]], ord(sep))
+    return starts, nfields, is_record
+
+
+def count_quoted_fields(line, sep):
+    """
+    Count the fields of a line as the pandas parser does: a field that starts
+    with '"' runs to the next '"' that isn't doubled, and a '#' outside quotes
+    ends the line.
+
+    :param sep: the delimiter, as a byte
+    """
+    nfields = 1
+    quoted = False
+    field_start = True
+    i = 0
+    while i < len(line):
+        byte = line[i]
+        if quoted:
+            if byte == QUOTE:
+                if line[i + 1:i + 2] == b'"':
+                    i += 1
+                else:
+                    quoted = False
+        elif byte == QUOTE and field_start:
+            quoted = True
+            field_start = False
+        elif byte == sep:
+            nfields += 1
+            field_start = True
+        elif byte == COMMENT:
+            break
+        else:
+            field_start = False
+        i += 1
+    return nfields
+
+
+class ChunkFingerprints:
+    """
+    Digests of the bytes of each chunk of `chunk_rows` rows, from the start of
+    the first row of the chunk up to the start of the first row of the next.
+    """
+    def __init__(self, chunk_rows):
+        self.chunk_rows = chunk_rows
+        self.offsets = []
+        self.digests = []
+        self._hash = None
+
+    def add_block(self, block, rows, starts, byte_base):
+        """
+        :param rows: row numbers of the data rows in the block
+        :param starts: offsets of those rows within the block
+        :param byte_base: offset of the block in the file
+        """
+        view = memoryview(block)
+        position = 0
+        for start in starts[rows % self.chunk_rows == 0].tolist():
+            if self._hash is not None:
+                self._hash.update(view[position:start])
+                self.digests.append(self._hash.hexdigest())
+            self._hash = hashlib.blake2b(digest_size=16)
+            self.offsets.append(byte_base + start)
+            position = start
+        if self._hash is not None:
+            self._hash.update(view[position:])
+
+    def finish(self):
+        if self._hash is not None:
+            self.digests.append(self._hash.hexdigest())
+            self._hash = None
+
+
+class BlockScanner:
+    """
+    Builds the RowIndex of a file from its blocks of complete lines, in order.
+    """
+    def __init__(self, file, sep='\t', ncols=None, spacing=CHECKPOINT_SPACING, chunk_rows=None, has_header=True):
+        """
+        :param has_header: False to number the rows of a part of the file from its first line
+        """
+        self.file = file
+        self.sep = sep
+        self.ncols = ncols
+        self.spacing = spacing
+        self.index = None if has_header else RowIndex(file, ncols=ncols, header_line=0, spacing=spacing)
+        self.fingerprints = ChunkFingerprints(chunk_rows) if chunk_rows else None
+        self.chunk_rows = chunk_rows
+        self.nlines = 0
+        self.nbytes = 0
+
+    @property
+    def nrows(self):
+        return 0 if self.index is None else self.index.nrows
+
+    def add(self, block):
+        """
+        :return: offset in the block of the first line after the header,
+            the end of the block if the header has not been found yet
+        """
+        starts, nfields, is_record = fields_per_line(block, self.sep)
+        first_line = 0
+        if self.index is None:
+            records = np.flatnonzero(is_record)
+            if len(records):
+                header = records[0]
+                self.index = RowIndex(self.file,
+                                      ncols=int(nfields[header]) if self.ncols is None else self.ncols,
+                                      header_line=int(self.nlines + header + 1),
+                                      spacing=self.spacing)
+                first_line = header + 1
+            else:
+                first_line = len(starts)
+        if self.index is not None:
+            records = first_line + np.flatnonzero(is_record[first_line:])
+            skipped = first_line + np.flatnonzero(~is_record[first_line:])
+            rows = np.arange(self.index.nrows, self.index.nrows + len(records))
+            if self.fingerprints:
+                self.fingerprints.add_block(block, rows, starts[records], self.nbytes)
+            self.index.add_block(rows=rows,
+                                 nfields=nfields[records],
+                                 skipped_lines=self.nlines + skipped + 1,
+                                 offsets=self.nbytes + starts[records])
+        self.nlines += len(nfields)
+        self.nbytes += len(block)
+        return int(starts[first_line]) if first_line < len(starts) else len(block)
+
+    def finish(self, access_points=()):
+        index = self.index
+        if index is None:
+            index = RowIndex(self.file, ncols=self.ncols, header_line=0, spacing=self.spacing)
+        if len(access_points):
+            index.access_points = np.array(access_points, dtype=np.int64)
+        if self.fingerprints:
+            self.fingerprints.finish()
+            index.set_chunks(self.chunk_rows, self.fingerprints.offsets, self.fingerprints.digests)
+        return index.finalise()
+
+
+def scan_file(file, sep='\t', ncols=None, blocksize=BLOCKSIZE, spacing=CHECKPOINT_SPACING, chunk_rows=None):
+    """
+    Count the data rows in a file and find the rows with a different number
+    of fields to the header.
+
+    :param file: path to a (optionally gzipped) delimited file
+    :param sep: the field delimiter
+    :param ncols: expected number of fields, defaults to the number in the header
+    :param spacing: number of rows between byte offset checkpoints in the index
+    :param chunk_rows: if given, also fingerprint the content of every chunk of this many rows
+    :return: RowIndex
+    """
+    scanner = BlockScanner(file, sep=sep, ncols=ncols, spacing=spacing, chunk_rows=chunk_rows)
+    with open_binary(file, record_access_points=True) as fh:
+        for block in iter_line_blocks(fh, blocksize):
+            scanner.add(block)
+        access_points = getattr(fh.raw, 'access_points', [])
+    return scanner.finish(access_points)
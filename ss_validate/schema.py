@@ -1,6 +1,8 @@
 from pandas_schema import Column
 import numpy as np
-from ss_validate.helpers import InInclusiveRangeValidation, match_regex, in_list, in_range, is_dtype, p_value_validation
+from ss_validate.helpers import (InInclusiveRangeValidation, match_regex, in_list, in_range, is_dtype, p_value_validation,
+                                 VariantIdValidation, ConfidenceIntervalValidation, StandardErrorValidation,
+                                 NegLogPValueValidation)
 
 #=====================================#
 #Summary Statistics Validation Schema #
@@ -174,6 +176,36 @@ SCHEMA = {
             'validation': [in_list(["ea","oa","NA"])]
         }
     },
+    'cross_field_rules': {
+        # 'fields' are in the order that the validation takes them. A list is a choice of
+        # fields, of which the first one in the file is used. Errors are reported against
+        # the first field.
+        'VAR_ID_POSITION': {
+            'fields': ['VAR_ID', 'CHR', 'BP', 'OTHER', 'EFFECT'],
+            'description': 'variant_id must be <chromosome>_<base_pair_location>_<other_allele>_<effect_allele>',
+            'validation': VariantIdValidation()
+        },
+        'EFFECT_IN_CI': {
+            'fields': [['BETA', 'OR', 'HR'], 'RANGE_L', 'RANGE_U'],
+            'description': 'The effect size must be within the confidence interval',
+            'validation': ConfidenceIntervalValidation()
+        },
+        'SE_POSITIVE': {
+            'fields': ['SE', ['BETA', 'OR', 'HR']],
+            'description': 'The standard error must be positive where there is an effect size',
+            'validation': StandardErrorValidation()
+        },
+        'PVAL_AGREE': {
+            'fields': ['NEG_LOG_PVAL', 'PVAL'],
+            'description': 'neg_log_10_p_value must agree with p_value when both are given',
+            'validation': NegLogPValueValidation()
+        }
+    },
+    'duplicate_keys': [
+        ['CHR', 'BP', 'EFFECT', 'OTHER'],
+        ['VAR_ID'],
+        ['RSID']
+    ],
     'minimum_rows': 100000,
     'valid_file_extensions': [
         ".tsv",
@@ -0,0 +1,475 @@
+import io
+import hmac
+import json
+import time
+import logging
+import secrets
+import threading
+import traceback
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from ss_validate.helpers import is_gzipped, open_binary, is_data_line
+from ss_validate.gzindex import GzipMemberReader, bgzf_blocks, READ_SIZE
+from ss_validate.rowindex import RowIndex
+from ss_validate.scanner import BlockScanner, BLOCKSIZE
+from ss_validate.incremental import errors_to_records, errors_from_records
+from ss_validate.storage import open_raw, file_size
+from ss_validate.qcstats import QCStats
+
+"""
+Sharded validation by worker processes, which may be on other machines that
+see the file at the same path or S3 URL.
+
+The coordinator splits the file into byte ranges, or ranges of BGZF blocks
+for a compressed file, and hands them out to workers over HTTP:
+
+    GET  /task    the next shard to validate, {"wait": seconds} or {"done": true}
+    POST /result  the RowIndex and errors of a shard, numbered from its start,
+                  and its QC statistics if they are gathered
+
+Every request carries the coordinator's token, in an "Authorization: Bearer"
+header, and requests without it are refused, so that only the workers that
+were given the token can take tasks or send results.
+
+A shard holds the lines that start within its range, so a line that crosses
+the end of a range is read by the shard before it. The coordinator merges
+the results in the order of the shards, re-basing the row numbers, line
+numbers and byte offsets, into one RowIndex and a list of errors per shard,
+which Validator then reads in chunks of its chunk size, as it would the
+chunks of a local validation, so it stops at the error limit on the same row.
+A worker carries on validating for a chunk after its shard reaches the limit,
+and once the merged shards have reached it the remaining shards are only
+validated up to the end of the chunk the limit was reached in, and otherwise
+only checked for squareness. A gzip file that is not BGZF is a single shard.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+SHARD_SIZE = 64 * 1024 * 1024
+LEASE_SECONDS = 600
+"""a shard not returned this long after it was handed out is handed out again"""
+WORKER_TIMEOUT_SECONDS = 600
+"""the validation fails if no worker has asked for a task or sent a result for this long"""
+POLL_SECONDS = 1
+CONNECT_SECONDS = 30
+REQUEST_SECONDS = 60
+
+
+def split_file(file, shard_size=SHARD_SIZE):
+    """
+    The (start, end, previous) byte ranges of the shards of a file, in compressed
+    offsets for a gzip file, where previous is the start of the block before the shard.
+    The first shard always holds the header.
+    """
+    header_end = find_header_end(file)
+    if is_gzipped(file):
+        blocks = bgzf_blocks(file) or [(0, 0)]
+        starts, previous = [0], [0]
+        uncompressed = 0
+        for (prev_offset, prev_size), (offset, _) in zip(blocks, blocks[1:]):
+            uncompressed += prev_size
+            if offset - starts[-1] >= shard_size and uncompressed >= header_end:
+                starts.append(offset)
+                previous.append(prev_offset)
+        ends = starts[1:] + [file_size(file)]
+    else:
+        size = file_size(file)
+        starts = [0] + list(range(max(shard_size, header_end), size, shard_size))
+        previous = [max(start - 1, 0) for start in starts]
+        ends = starts[1:] + [size]
+    return [{'shard': shard, 'start': start, 'end': end, 'previous': prev}
+            for shard, (start, end, prev) in enumerate(zip(starts, ends, previous))]
+
+
+def find_header_end(file):
+    """
+    The (uncompressed) offset of the end of the header line.
+    """
+    offset = 0
+    with open_binary(file) as fh:
+        for line in fh:
+            offset += len(line)
+            if is_data_line(line):
+                break
+    return offset
+
+
+class ShardReader:
+    """
+    The lines that start within the range of a shard, in blocks of complete lines.
+    After iterating, `skipped` is the number of bytes at the start of the range
+    that belong to a line of the shard before, and `nbytes` is the (uncompressed)
+    length of the range.
+    """
+    def __init__(self, file, shard, blocksize=BLOCKSIZE):
+        self.file = file
+        self.shard = shard
+        self.blocksize = blocksize
+        self.skipped = 0
+        self.nbytes = 0
+
+    def __iter__(self):
+        skipping = self.shard['start'] > 0 and not self.previous_byte() == b'\n'
+        remainder = b''
+        with self.open_range() as fh:
+            while True:
+                data = fh.read(self.blocksize)
+                if not data:
+                    break
+                self.nbytes += len(data)
+                if skipping:
+                    cut = data.find(b'\n') + 1
+                    if cut == 0:
+                        self.skipped += len(data)
+                        continue
+                    self.skipped += cut
+                    data = data[cut:]
+                    skipping = False
+                data = remainder + data
+                cut = data.rfind(b'\n') + 1
+                remainder = data[cut:]
+                if cut:
+                    yield data[:cut]
+        if remainder:
+            # the last line carries on into the range of the next shard
+            remainder += self.rest_of_line()
+            yield remainder if remainder.endswith(b'\n') else remainder + b'\n'
+
+    def open_range(self):
+        if is_gzipped(self.file):
+            return io.BufferedReader(GzipMemberReader(self.file, start=(self.shard['start'], 0), end=self.shard['end']),
+                                     buffer_size=READ_SIZE)
+        return LimitedReader(self.file, self.shard['start'], self.shard['end'])
+
+    def previous_byte(self):
+        if is_gzipped(self.file):
+            with io.BufferedReader(GzipMemberReader(self.file, start=(self.shard['previous'], 0),
+                                                    end=self.shard['start'])) as fh:
+                return fh.read()[-1:]
+        with open_raw(self.file) as fh:
+            fh.seek(self.shard['start'] - 1)
+            return fh.read(1)
+
+    def rest_of_line(self):
+        if is_gzipped(self.file):
+            with io.BufferedReader(GzipMemberReader(self.file, start=(self.shard['end'], 0))) as fh:
+                return fh.readline()
+        with open_raw(self.file) as fh:
+            fh.seek(self.shard['end'])
+            return fh.readline()
+
+
+class LimitedReader(io.RawIOBase):
+    """
+    The bytes of a file from start up to end.
+    """
+    def __init__(self, file, start, end):
+        super().__init__()
+        self._fh = open_raw(file)
+        self._fh.seek(start)
+        self._left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._fh.readinto(memoryview(b)[:min(len(b), self._left)])
+        self._left -= n
+        return n
+
+    def close(self):
+        self._fh.close()
+        super().close()
+
+
+def validate_shard(validator, task):
+    """
+    Check the squareness of the rows of a shard and validate the data of its
+    first task['validate_rows'] rows, or of all of them if that is None. The
+    validation stops a chunk of task['chunksize'] rows after the row of the
+    task['error_limit']th error, by when the chunk in which the whole file
+    reaches the limit has been validated.
+
+    :param validator: a Validator of the file with its fields set up
+    :return: the result to send to the coordinator
+    """
+    reader = ShardReader(task['file'], task)
+    scanner = BlockScanner(task['file'], sep=task['sep'], ncols=task['ncols'], has_header=task['shard'] == 0)
+    validate_rows = task['validate_rows']
+    validate = validate_rows is None or validate_rows > 0
+    qc = QCStats(validator.header, validator.schema) if validate and task.get('qc_stats') else None
+    errors = []
+    for block in reader:
+        first_row = scanner.nrows
+        data_start = scanner.add(block)
+        if validate and scanner.nrows > first_row:
+            df = validator.parse_rows(block[data_start:], first_row)
+            errors.extend(validator.validate_df(df))
+            if qc:
+                qc.add(df)
+            if task['error_limit'] and len(errors) >= task['error_limit']:
+                limit_row = errors[task['error_limit'] - 1].row
+                if validate_rows is None or validate_rows > limit_row + 1 + task['chunksize']:
+                    validate_rows = limit_row + 1 + task['chunksize']
+            if validate_rows is not None and scanner.nrows >= validate_rows:
+                validate = False
+    return {'shard': task['shard'],
+            'index': scanner.finish().to_dict(),
+            'nlines': scanner.nlines,
+            'nbytes': reader.nbytes,
+            'skipped': reader.skipped,
+            'errors': errors_to_records(errors),
+            'qc': qc.to_dict() if qc else None}
+
+
+class Coordinator:
+    def __init__(self, file, host='127.0.0.1', port=0, shard_size=SHARD_SIZE, lease=LEASE_SECONDS, token=None,
+                 worker_timeout=WORKER_TIMEOUT_SECONDS):
+        """
+        The server is bound straight away, so that workers can connect before
+        the validation starts, but shards are only handed out by validate().
+
+        :param token: the secret the workers must send, a random one by default
+        :param worker_timeout: seconds without a request from a worker after which validate() fails
+        """
+        self.file = file
+        self.shards = split_file(file, shard_size)
+        self.lease = lease
+        self.token = token or secrets.token_urlsafe(24)
+        self.worker_timeout = worker_timeout
+        self.last_contact = None
+        self.server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+        self.server.coordinator = self
+        self.serving = None
+        self.url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        self.condition = threading.Condition()
+        self.settings = None
+        self.pending = list(range(len(self.shards)))
+        self.leases = {}
+        self.results = {}
+        self.failure = None
+        self.merged_index = None
+        self.row_index = None
+        self.chunks = []
+        """(number of rows, errors) of each merged shard"""
+        self.nlines = 0
+        self.nbytes = 0
+        self.chunksize = None
+        self.nerrors = 0
+        self.validate_until = None
+        """the row after the chunk in which the merged shards reached the error limit"""
+        self.qc = None
+        """the merged QC statistics of the shards, if the validator gathers them"""
+        self.qc_settings = None
+
+    def validate(self, validator):
+        """
+        Have the workers validate the file, with the settings of the validator.
+        The server keeps running, to tell the workers that there is nothing
+        left to do, until close() is called.
+
+        :return: RowIndex of the whole file
+        """
+        if self.row_index is not None:
+            return self.row_index
+        with self.condition:
+            self.settings = {'file': self.file,
+                             'sep': validator.sep,
+                             'ncols': len(validator.header),
+                             'zero_pvalues': validator.zero_pvalues,
+                             'cross_field': validator.cross_field,
+                             'error_limit': validator.error_limit,
+                             'chunksize': validator.chunksize,
+                             'qc_stats': validator.qc_stats}
+            self.qc_settings = (validator.header, validator.schema)
+            self.chunksize = validator.chunksize
+            self.last_contact = time.time()
+        logger.info("Waiting for workers at {} to validate {} shards".format(self.url, len(self.shards)))
+        self.serving = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.serving.start()
+        with self.condition:
+            while len(self.chunks) < len(self.shards) and self.failure is None:
+                if time.time() - self.last_contact > self.worker_timeout:
+                    break
+                self.condition.wait(POLL_SECONDS)
+            timed_out = len(self.chunks) < len(self.shards) and self.failure is None
+        if self.failure is not None:
+            self.close()
+            raise RuntimeError("Validation of shard {} failed:\n{}".format(*self.failure))
+        if timed_out:
+            self.close()
+            raise TimeoutError("No worker has asked {} for a shard or sent a result for {} seconds, {} of {} shards "
+                               "validated".format(self.url, self.worker_timeout, len(self.chunks), len(self.shards)))
+        self.row_index = self.merged_index.finalise()
+        return self.row_index
+
+    def chunk_errors(self):
+        """
+        Yield (number of rows, errors) for each chunk of the validator's chunk
+        size, as a local validation reads them.
+        """
+        errors = [error for _, shard_errors in self.chunks for error in shard_errors]
+        rows = np.array([error.row for error in errors], dtype=np.int64)
+        nrows = self.row_index.nrows
+        for start in range(0, nrows, self.chunksize):
+            first, last = np.searchsorted(rows, [start, start + self.chunksize])
+            yield min(self.chunksize, nrows - start), errors[first:last]
+
+    def close(self):
+        if self.serving is not None:
+            self.server.shutdown()
+            self.serving = None
+        self.server.server_close()
+
+    def next_task(self):
+        with self.condition:
+            self.last_contact = time.time()
+            if len(self.chunks) == len(self.shards):
+                return {'done': True}
+            if self.settings is None:
+                return {'wait': POLL_SECONDS}
+            if not self.pending:
+                expired = [shard for shard, handed_out in self.leases.items() if time.time() - handed_out > self.lease]
+                if not expired:
+                    return {'wait': POLL_SECONDS}
+                self.pending.append(min(expired))
+            shard = self.pending.pop(0)
+            self.leases[shard] = time.time()
+            validate_rows = None
+            if self.validate_until is not None:
+                # the shard starts no earlier than the first shard that hasn't been merged
+                validate_rows = max(0, self.validate_until - self.merged_index.nrows)
+            return dict(self.shards[shard], validate_rows=validate_rows, **self.settings)
+
+    def add_result(self, result):
+        with self.condition:
+            self.last_contact = time.time()
+            shard = result['shard']
+            if 'failed' in result:
+                self.failure = (shard, result['failed'])
+            elif shard >= len(self.chunks) and shard not in self.results:
+                self.leases.pop(shard, None)
+                self.results[shard] = result
+                while len(self.chunks) in self.results:
+                    self.merge(self.results.pop(len(self.chunks)))
+            self.condition.notify_all()
+
+    def merge(self, result):
+        part = RowIndex.from_dict(self.file, result['index'])
+        if not self.chunks:
+            self.merged_index = RowIndex(self.file, ncols=part.ncols, header_line=part.header_line, spacing=part.spacing)
+        shard = self.shards[len(self.chunks)]
+        first_row = self.merged_index.nrows
+        self.merged_index.extend(part,
+                                 row_base=first_row,
+                                 line_base=self.nlines,
+                                 byte_base=self.nbytes + result['skipped'])
+        if is_gzipped(self.file):
+            self.merged_index.access_points = np.append(self.merged_index.access_points,
+                                                        [[shard['start'], self.nbytes]], axis=0)
+        self.nlines += result['nlines']
+        self.nbytes += result['nbytes']
+        errors = errors_from_records(result['errors'], first_row)
+        if result.get('qc'):
+            shard_qc = QCStats.from_dict(*self.qc_settings, result['qc'])
+            self.qc = shard_qc if self.qc is None else self.qc.merge(shard_qc)
+        self.chunks.append((part.nrows, errors))
+        limit = self.settings['error_limit']
+        if limit and self.validate_until is None and self.nerrors + len(errors) >= limit:
+            limit_row = errors[limit - self.nerrors - 1].row
+            self.validate_until = (limit_row // self.chunksize + 1) * self.chunksize
+        self.nerrors += len(errors)
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path != '/task':
+            self.send_error(404)
+            return
+        self.send_json(self.server.coordinator.next_task())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path != '/result':
+            self.send_error(404)
+            return
+        result = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.coordinator.add_result(result)
+        self.send_json({})
+
+    def authorized(self):
+        expected = 'Bearer ' + self.server.coordinator.token
+        if hmac.compare_digest(self.headers.get('Authorization', '').encode(), expected.encode()):
+            return True
+        logger.warning("Refused a request from {} without the token".format(self.client_address[0]))
+        self.send_error(403)
+        return False
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def request(url, token, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json',
+                                                          'Authorization': 'Bearer ' + token})
+    with urllib.request.urlopen(req, timeout=REQUEST_SECONDS) as response:
+        return json.loads(response.read())
+
+
+def run_worker(url, make_validator, token, file=None, connect_timeout=CONNECT_SECONDS):
+    """
+    Validate shards for the coordinator at url until there are none left.
+
+    :param make_validator: function that makes a Validator from the settings of a task
+    :param token: the token of the coordinator
+    :param file: if given, the only file the worker will validate shards of
+    :param connect_timeout: seconds to keep trying to reach the coordinator before the first task
+    """
+    validators = {}
+    deadline = time.time() + connect_timeout
+    connected = False
+    while True:
+        try:
+            task = request(url + '/task', token)
+        except urllib.error.HTTPError:
+            raise
+        except OSError:
+            # the coordinator is not up yet, or has finished and gone away
+            if connected or time.time() > deadline:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        connected = True
+        if task.get('done'):
+            return
+        if 'wait' in task:
+            time.sleep(task['wait'])
+            continue
+        settings = {key: task[key] for key in ['file', 'zero_pvalues', 'cross_field']}
+        key = json.dumps(settings, sort_keys=True)
+        try:
+            if file is not None and task['file'] != file:
+                raise ValueError("This worker only validates {}, not {}".format(file, task['file']))
+            if key not in validators:
+                validators[key] = make_validator(**settings)
+            result = validate_shard(validators[key], task)
+        except Exception:
+            result = {'shard': task['shard'], 'failed': traceback.format_exc()}
+        request(url + '/result', token, result)
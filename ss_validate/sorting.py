@@ -0,0 +1,171 @@
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from ss_validate.gzindex import BgzfWriter
+from ss_validate.tabix import TabixIndex
+
+"""
+Writing rows sorted by chromosome and base_pair_location, compressed with
+BGZF and indexed with tabix in the same pass.
+
+Chunks of rows are kept in memory until they take more than the memory
+budget, then sorted and written to a temporary file as a sorted run. The
+runs are merged as the output is written. If every row fits in memory the
+rows are only sorted once, and nothing is written to temporary files.
+
+Rows whose chromosome or base_pair_location isn't an integer, which can only
+be rows that weren't validated because the error limit was reached, have no
+place in the sorted order. They are written, in the order they came, to
+<path without .gz>.unplaced, with the same header.
+"""
+
+
+WRITE_BATCH = 100000
+LINE_OVERHEAD = sys.getsizeof('') + 8
+"""bytes a buffered line takes on top of its text: the str object and its slot in the list"""
+
+
+class SortedTableWriter:
+    def __init__(self, path, columns, chr_col, bp_col, memory_budget=1024, tmp_dir=None):
+        """
+        :param path: the file to write, with the tabix index at <path>.tbi
+            and the rows that can't be sorted at <path without .gz>.unplaced
+        :param columns: the column labels, written as the header
+        :param chr_col: label of the chromosome column, which holds numbers
+        :param bp_col: label of the base pair location column
+        :param memory_budget: MB of rows to hold in memory before writing a sorted run
+        :param tmp_dir: where to write the sorted runs, defaults to the system temp dir
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.chr_col = chr_col
+        self.bp_col = bp_col
+        self.chr_field = self.columns.index(chr_col)
+        self.bp_field = self.columns.index(bp_col)
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.tmp_dir = tmp_dir
+        self._tmpdir = None
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.runs = []
+        self.unplaced_path = (path[:-len('.gz')] if path.endswith('.gz') else path) + '.unplaced'
+        self.unplaced = 0
+        self._unplaced_file = None
+        if os.path.exists(self.unplaced_path):
+            os.remove(self.unplaced_path)  # left by an earlier run
+
+    def add(self, df):
+        """
+        :param df: rows with the columns of the table, as strings
+        """
+        if df.empty:
+            return
+        lines = df.to_csv(sep='\t', header=False, index=False, na_rep='NA').splitlines()
+        chrs = pd.to_numeric(df[self.chr_col], errors='coerce').to_numpy(np.float64)
+        bps = pd.to_numeric(df[self.bp_col], errors='coerce').to_numpy(np.float64)
+        placed = np.isfinite(chrs) & np.isfinite(bps)
+        placed[placed] = (chrs[placed] == np.floor(chrs[placed])) & (bps[placed] == np.floor(bps[placed]))
+        if not placed.all():
+            self.write_unplaced([line for line, ok in zip(lines, placed.tolist()) if not ok])
+            lines = [line for line, ok in zip(lines, placed.tolist()) if ok]
+            chrs, bps = chrs[placed], bps[placed]
+        chrs, bps = chrs.astype(np.int64), bps.astype(np.int64)
+        self.buffer.append((chrs, bps, lines))
+        self.buffered_bytes += chrs.nbytes + bps.nbytes + sum(map(len, lines)) + LINE_OVERHEAD * len(lines)
+        if self.buffered_bytes > self.memory_budget:
+            self.spill()
+
+    def write_unplaced(self, lines):
+        if self._unplaced_file is None:
+            self._unplaced_file = open(self.unplaced_path, 'w')
+            self._unplaced_file.write('\t'.join(self.columns) + '\n')
+        for line in lines:
+            self._unplaced_file.write(line + '\n')
+        self.unplaced += len(lines)
+
+    def sorted_buffer(self):
+        """
+        The buffered rows as (chromosome, base pair location, line) sorted by
+        position, keeping rows with the same position in the order they were added.
+        """
+        if not self.buffer:
+            return [], [], []
+        chrs, bps, lines = zip(*self.buffer)
+        chrs, bps = np.concatenate(chrs), np.concatenate(bps)
+        lines = [line for chunk in lines for line in chunk]
+        order = np.lexsort((bps, chrs))
+        self.buffer = []
+        self.buffered_bytes = 0
+        return chrs[order], bps[order], [lines[i] for i in order.tolist()]
+
+    def spill(self):
+        if not self.buffer:
+            return
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='ss_validate_sort_', dir=self.tmp_dir)
+        path = os.path.join(self._tmpdir, 'run{}.tsv'.format(len(self.runs)))
+        with open(path, 'w') as f:
+            for chrom, bp, line in zip(*self.sorted_buffer()):
+                f.write('{}\t{}\t{}\n'.format(chrom, bp, line))
+        self.runs.append(path)
+
+    def read_run(self, path):
+        """
+        The rows of a run, each written after its chromosome and base pair
+        location as integers, which the line itself may not hold as such (e.g. "1.0").
+        """
+        with open(path) as f:
+            for line in f:
+                chrom, bp, line = line.split('\t', 2)
+                yield int(chrom), int(bp), line.rstrip('\n')
+
+    def sorted_batches(self):
+        """
+        All the rows in order, in batches of (chromosomes, base pair locations, lines).
+        """
+        if not self.runs:
+            chrs, bps, lines = self.sorted_buffer()
+            for i in range(0, len(lines), WRITE_BATCH):
+                yield chrs[i:i + WRITE_BATCH], bps[i:i + WRITE_BATCH], lines[i:i + WRITE_BATCH]
+            return
+        if self.buffer:
+            self.spill()
+        batch = []
+        for row in heapq.merge(*[self.read_run(path) for path in self.runs], key=lambda row: row[:2]):
+            batch.append(row)
+            if len(batch) == WRITE_BATCH:
+                yield tuple(zip(*batch))
+                batch = []
+        if batch:
+            yield tuple(zip(*batch))
+
+    def close(self):
+        """
+        Write the sorted table and its index.
+
+        :return: the path of the index
+        """
+        index = TabixIndex(seq_col=self.chr_field + 1, pos_col=self.bp_field + 1)
+        try:
+            with BgzfWriter(self.path) as out:
+                out.write(('\t'.join(self.columns) + '\n').encode())
+                for chrs, bps, lines in self.sorted_batches():
+                    data = [(line + '\n').encode() for line in lines]
+                    ends = out.position + np.cumsum([len(line) for line in data])
+                    starts = ends - [len(line) for line in data]
+                    index.add(np.asarray(chrs).astype(str), bps, starts, ends)
+                    out.write(b''.join(data))
+            index.write(self.path + '.tbi', out.virtual_offsets)
+        finally:
+            if self._unplaced_file is not None:
+                self._unplaced_file.close()
+                self._unplaced_file = None
+            if self._tmpdir is not None:
+                shutil.rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+        return self.path + '.tbi'
@@ -0,0 +1,289 @@
+import io
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+try:
+    import boto3
+    import botocore.config
+except ImportError:
+    boto3 = None
+
+"""
+Reading input files from S3-compatible object storage.
+
+`open_raw(file)` opens a local path or an s3://bucket/key URL as a seekable
+binary file. An object is read in blocks of `block_size` bytes with ranged
+GETs, and while it is read in order the next `prefetch` blocks are fetched
+in parallel, over a pool of connections shared by every object. Fetched
+blocks are also kept in a local read-through cache, keyed by the ETag of the
+object, so the several passes that a validation makes over a file only
+download it once. The object is looked up again each time it is opened, so
+a changed object is never read from blocks of an earlier version. The cache holds at most `cache_size` MB, dropping the
+least recently used blocks.
+
+The endpoint and credentials are found as boto3 finds them, so another
+S3-compatible store, e.g. MinIO, is used by setting AWS_ENDPOINT_URL. The
+files that are written next to a local input, like the .valid file and the
+row index, are written to the working directory, named after the key.
+"""
+
+
+SETTINGS = {
+    'block_size': 8 * 1024 * 1024,
+    'prefetch': 4,
+    'cache_dir': os.environ.get('SS_VALIDATE_CACHE_DIR',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'ss_validate')),
+    'cache_size': 1024,
+}
+REMOTE_SCHEMES = ('s3',)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure(**settings):
+    """
+    Change the block size, number of blocks to prefetch, cache directory or cache size (MB).
+    """
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError("Unknown storage settings: {}".format(sorted(unknown)))
+    SETTINGS.update({name: value for name, value in settings.items() if value is not None})
+
+
+def is_remote(file):
+    return urlparse(str(file)).scheme in REMOTE_SCHEMES
+
+
+def local_name(file):
+    """
+    The path to name files written alongside the input after.
+    """
+    if is_remote(file):
+        return os.path.basename(urlparse(file).path)
+    return file
+
+
+def file_size(file):
+    return S3Object(file).size if is_remote(file) else os.path.getsize(file)
+
+
+def file_stat(file):
+    """
+    (size, modification time in ns) of a file, for telling whether it has changed.
+    """
+    if is_remote(file):
+        obj = S3Object(file)
+        return obj.size, obj.mtime_ns
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def open_raw(file):
+    """
+    Open a local file or an object in S3 for reading bytes.
+    """
+    if is_remote(file):
+        return io.BufferedReader(RangedReader(S3Object(file)), buffer_size=1024 * 1024)
+    return open(file, 'rb')
+
+
+def s3_client():
+    global _client
+    if boto3 is None:
+        raise ImportError("boto3 is required to read files from S3")
+    with _client_lock:
+        if _client is None:
+            config = botocore.config.Config(max_pool_connections=max(10, 2 * SETTINGS['prefetch']),
+                                            retries={'max_attempts': 5, 'mode': 'standard'})
+            _client = boto3.session.Session().client('s3', config=config)
+        return _client
+
+
+class S3Object:
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.url = url
+        self.bucket = parsed.netloc
+        self.key = parsed.path.lstrip('/')
+        head = s3_client().head_object(Bucket=self.bucket, Key=self.key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag'].strip('"')
+        self.mtime_ns = int(head['LastModified'].timestamp() * 1e9)
+
+    def get(self, start, end):
+        """
+        The bytes from start up to end, pinned to the version of the object that was looked up.
+        """
+        response = s3_client().get_object(Bucket=self.bucket,
+                                          Key=self.key,
+                                          Range='bytes={}-{}'.format(start, end - 1),
+                                          IfMatch=self.etag)
+        return response['Body'].read()
+
+
+class BlockCache:
+    def __init__(self, directory, size):
+        """
+        :param directory: where to keep the blocks, which may be shared by several processes
+        :param size: MB of blocks to keep
+        """
+        self.directory = directory
+        self.size = size * 1024 * 1024
+        os.makedirs(directory, exist_ok=True)
+        self.total = None
+        """bytes in the cache as last counted, plus the blocks put since"""
+        self._lock = threading.Lock()
+
+    def path(self, obj, block, block_size):
+        name = hashlib.blake2b('{}\0{}\0{}'.format(obj.url, obj.etag, block_size).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, '{}-{}'.format(name, block))
+
+    def get(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # not cached, or evicted by another process
+            return None
+        return data
+
+    def put(self, path, data):
+        if len(data) > self.size:
+            return
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self.total is None:
+                self.total = self.evict()
+            else:
+                self.total += len(data)
+                if self.total > self.size:
+                    self.total = self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used blocks until the cache is within its size.
+        The directory is only listed when the blocks added may have filled it,
+        as other processes may have added or removed blocks since.
+
+        :return: the bytes left in the cache
+        """
+        blocks = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                blocks.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in blocks)
+        for _, size, path in sorted(blocks):
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+class RangedReader(io.RawIOBase):
+    def __init__(self, obj, block_size=None, prefetch=None, cache=None):
+        """
+        :param obj: the S3Object to read
+        :param cache: a BlockCache, defaults to one set up by SETTINGS, or none if cache_size is 0
+        """
+        super().__init__()
+        self.obj = obj
+        self.block_size = block_size or SETTINGS['block_size']
+        self.prefetch = SETTINGS['prefetch'] if prefetch is None else prefetch
+        if cache is None and SETTINGS['cache_size']:
+            cache = BlockCache(SETTINGS['cache_dir'], SETTINGS['cache_size'])
+        self.cache = cache
+        self._pos = 0
+        self._last = None
+        self._blocks = OrderedDict()
+        """the blocks read most recently"""
+        self._pending = {}
+        """block -> future of a block being fetched"""
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.prefetch))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.obj.size
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self.obj.size:
+            return 0
+        block, within = divmod(self._pos, self.block_size)
+        data = self.block(block)
+        n = min(len(b), len(data) - within)
+        b[:n] = data[within:within + n]
+        self._pos += n
+        return n
+
+    def block(self, block):
+        if block in self._blocks:
+            self._blocks.move_to_end(block)
+            return self._blocks[block]
+        if block == 0 or (self._last is not None and block == self._last + 1):
+            # reading in order, so fetch the blocks that will be read next
+            last_block = (self.obj.size - 1) // self.block_size
+            for ahead in range(block + 1, min(block + self.prefetch, last_block) + 1):
+                self.fetch(ahead)
+        else:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+        data = self.fetch(block).result()
+        del self._pending[block]
+        self._last = block
+        self._blocks[block] = data
+        while len(self._blocks) > self.prefetch + 2:
+            self._blocks.popitem(last=False)
+        return data
+
+    def fetch(self, block):
+        if block not in self._pending:
+            self._pending[block] = self._executor.submit(self.load, block)
+        return self._pending[block]
+
+    def load(self, block):
+        path = self.cache.path(self.obj, block, self.block_size) if self.cache else None
+        data = self.cache.get(path) if path else None
+        if data is None:
+            start = block * self.block_size
+            data = self.obj.get(start, min(start + self.block_size, self.obj.size))
+            if path:
+                self.cache.put(path, data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            self._pending = {}
+            self._blocks = OrderedDict()
+        super().close()
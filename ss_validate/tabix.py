@@ -0,0 +1,106 @@
+import struct
+import numpy as np
+
+from ss_validate.gzindex import BgzfWriter
+
+"""
+Tabix indexes of sorted, bgzipped tables of positions.
+
+The index is built while the table is written, from the uncompressed offsets
+of its lines, and written once the table is closed and the offsets can be
+turned into virtual offsets. It is the index that
+`tabix -s <seq col> -b <pos col> -e <pos col> -S 1` makes of the same file.
+"""
+
+
+TBI_MAGIC = b'TBI\x01'
+MIN_SHIFT = 14
+"""16kb windows for the linear index and the smallest bins"""
+SMALLEST_BIN = 4681
+"""the first bin of the deepest level, ((1 << 15) - 1) // 7"""
+
+
+class TabixIndex:
+    def __init__(self, seq_col, pos_col, skip=1, meta='#'):
+        """
+        :param seq_col: 1-based column of the sequence name, e.g. the chromosome
+        :param pos_col: 1-based column of the position, which is both the start and the end of the record
+        :param skip: number of header lines at the start of the table
+        :param meta: lines starting with this are comments
+        """
+        self.seq_col = seq_col
+        self.pos_col = pos_col
+        self.skip = skip
+        self.meta = meta
+        self.names = []
+        self.bins = []
+        """for each sequence, bin -> list of [start, end] uncompressed offsets"""
+        self.windows = []
+        """for each sequence, 16kb window -> uncompressed offset of its first record"""
+
+    def add(self, names, positions, starts, ends):
+        """
+        Index records in the order that they are written.
+
+        :param names: sequence name of each record
+        :param positions: 1-based position of each record
+        :param starts: uncompressed offset of the start of each line
+        :param ends: uncompressed offset of the end of each line
+        """
+        names = np.asarray(names)
+        windows = (np.asarray(positions, dtype=np.int64) - 1) >> MIN_SHIFT
+        # records of a single position are all in the smallest bin of their window
+        new_run = np.ones(len(names), dtype=bool)
+        new_run[1:] = (names[1:] != names[:-1]) | (windows[1:] != windows[:-1])
+        run_starts = np.flatnonzero(new_run)
+        run_ends = np.append(run_starts[1:], len(names)) - 1
+        for first, last in zip(run_starts.tolist(), run_ends.tolist()):
+            ref = self.ref(names[first])
+            window = int(windows[first])
+            if self.windows[ref] and window < next(reversed(self.windows[ref])):
+                raise ValueError("Rows are not sorted by position at {}:{}".format(names[first], positions[first]))
+            self.windows[ref].setdefault(window, int(starts[first]))
+            chunks = self.bins[ref].setdefault(SMALLEST_BIN + window, [])
+            if chunks and chunks[-1][1] == starts[first]:
+                chunks[-1][1] = int(ends[last])
+            else:
+                chunks.append([int(starts[first]), int(ends[last])])
+
+    def ref(self, name):
+        if self.names and self.names[-1] == name:
+            return len(self.names) - 1
+        if name in self.names:
+            raise ValueError("Rows are not sorted by sequence, the rows of {} are not together".format(name))
+        self.names.append(name)
+        self.bins.append({})
+        self.windows.append({})
+        return len(self.names) - 1
+
+    def write(self, path, virtual_offsets):
+        """
+        :param virtual_offsets: function turning uncompressed offsets in the table into virtual offsets
+        """
+        names = b''.join(name.encode() + b'\0' for name in self.names)
+        with BgzfWriter(path) as out:
+            out.write(TBI_MAGIC + struct.pack('<8i', len(self.names), 0, self.seq_col, self.pos_col, self.pos_col,
+                                              ord(self.meta), self.skip, len(names)) + names)
+            for bins, windows in zip(self.bins, self.windows):
+                out.write(struct.pack('<i', len(bins)))
+                for bin, chunks in bins.items():
+                    offsets = virtual_offsets(np.array(chunks, dtype=np.int64).ravel())
+                    out.write(struct.pack('<Ii', bin, len(chunks)) + offsets.astype('<u8').tobytes())
+                out.write(struct.pack('<i', max(windows) + 1) + self.linear_index(windows, virtual_offsets))
+
+    @staticmethod
+    def linear_index(windows, virtual_offsets):
+        """
+        The virtual offset of the first record in each window. Windows without
+        records take the offset of the window before, and any before the first
+        record take the offset of the first record.
+        """
+        offsets = np.full(max(windows) + 1, -1, dtype=np.int64)
+        offsets[list(windows)] = list(windows.values())
+        has_record = offsets >= 0
+        filled = offsets[np.maximum.accumulate(np.where(has_record, np.arange(len(offsets)), 0))]
+        filled[:np.argmax(has_record)] = offsets[np.argmax(has_record)]
+        return virtual_offsets(filled).astype('<u8').tobytes()
@@ -1,10 +1,13 @@
+import io
 import sys
-import gzip
-import csv
 import os
+import time
 import argparse
-import pathlib
+import functools
+import itertools
+import contextlib
 import logging
+import weakref
 from tqdm import tqdm
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -13,25 +16,44 @@ import pandas as pd
 from pandas_schema import Schema, Column
 
 from ss_validate.schema import SCHEMA
-from ss_validate.helpers import get_version, p_value_validation_allow_zero, is_dtype
+from ss_validate.helpers import get_version, p_value_validation_allow_zero, is_dtype, rule_name, csv_source, open_binary
+from ss_validate.scanner import scan_file
+from ss_validate.rowindex import RowIndex
+from ss_validate.report import open_report, error_record
+from ss_validate.incremental import IncrementalState, state_path, settings_key
+from ss_validate.duplicates import duplicate_checks
+from ss_validate.sharded import Coordinator, run_worker, WORKER_TIMEOUT_SECONDS
+from ss_validate.sorting import SortedTableWriter
+from ss_validate.arrowtable import TypedTableWriter
+from ss_validate.memory import MemoryGovernor, MemoryBudgetExceeded, ErrorLog, RowLog
+from ss_validate.partitioned import ChromosomePartitions
+from ss_validate.errorlogging import ErrorLogger
+from ss_validate.qcstats import QCStats
+from ss_validate.reference import ReferenceGenome, ReferenceCheck
+from ss_validate.pipeline import prefetch, background, PrefetchReader, DEPTH
+from ss_validate import storage, kernels
 
 """
 GWAS Summary statistics file validator using pandas_schema https://github.com/TMiguelT/PandasSchema
 """
 
 
-# set field size limit but catch overflow errors
-max_int = sys.maxsize
-while True:
-    try:
-        csv.field_size_limit(max_int)
-        break
-    except OverflowError:
-        max_int = int(max_int/10)
-
-
 logging.basicConfig(level=logging.INFO, format='(%(levelname)s): %(message)s')
 logger = logging.getLogger(__name__)
+_validator_ids = itertools.count()
+
+
+def stage(method):
+    """
+    Record whether a validation stage passed and how long it took, for the report.
+    """
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        start = time.time()
+        result = method(self, *args, **kwargs)
+        self.stages[method.__name__] = {'passed': result, 'seconds': round(time.time() - start, 3)}
+        return result
+    return timed
 
 
 class Validator:
@@ -43,28 +65,79 @@ class Validator:
                  minrows=SCHEMA['minimum_rows'],
                  dropbad=False,
                  zero_pvalues=False,
-                 chunksize=100000):
+                 chunksize=100000,
+                 report=None,
+                 incremental=False,
+                 check_duplicates=False,
+                 duplicate_memory=256,
+                 cross_field=False,
+                 coordinator=None,
+                 sort_memory=1024,
+                 memory_budget=None,
+                 split_by_chromosome=False,
+                 processes=None,
+                 jit=None,
+                 errors_per_rule=None,
+                 qc_stats=False,
+                 pipeline_depth=DEPTH,
+                 reference=None):
         self.file = file
+        self.logfile = logfile
+        # a logger of its own, so that what it logs only goes to its own logfile
+        self.logger = logging.getLogger('{}.{}'.format(__name__, next(_validator_ids)))
+        handler = logging.FileHandler(logfile)
+        handler.setLevel(logging.INFO)
+        self.logger.addHandler(handler)
+        self.error_logger = ErrorLogger(self.logger, errors_per_rule)
+        # the handler is removed when the validator is closed, or else when it is garbage collected
+        self._close_logging = weakref.finalize(self, close_logging, self.logger, handler, self.error_logger)
         self.schema = schema
         self.header = []
         self.conditional_fields = []
-        self.rows_to_drop = []
+        self.rows_to_drop = RowLog()
         self.cols_to_validate = []
         self.sep = get_seperator(self.file)
-        self.errors = []
+        self.errors = ErrorLog()
         self.valid_extensions = SCHEMA['valid_file_extensions']
         self.error_limit = int(error_limit) if dropbad is False else None
         self.minrows = int(minrows)
         self.nrows = None
+        self.row_index = None
+        self.rows_scanned = 0
+        self.stages = {}
+        self.report = open_report(report) if report else None
+        self.incremental = incremental
+        self.check_duplicates = check_duplicates
+        self.duplicate_memory = duplicate_memory
+        self.chunk_checks = []
+        self.cross_field = cross_field
+        self.cross_field_rules = []
+        self.coordinator = coordinator
+        self.sort_memory = sort_memory
+        self.governor = MemoryGovernor(memory_budget, chunksize) if memory_budget else None
+        self.split_by_chromosome = split_by_chromosome
+        self.processes = processes
+        self.partitions = None
+        self.qc_stats = qc_stats
+        self.pipeline_depth = pipeline_depth
+        self.reference = reference
+        self.reference_check = None
+        self.qc = None
+        if jit and not kernels.available():
+            self.logger.warning("Numba is not installed, validating without the JIT compiled kernels")
+        # by default the kernels are used if they can be
+        self.jit = kernels.available() and jit is not False
         self.psplit_row_index = -99
         self.chunksize = chunksize
         self.zero_pvalues = zero_pvalues
         if self.zero_pvalues is True:
             self.allow_zero_pvalues()
 
-        handler = logging.FileHandler(logfile)
-        handler.setLevel(logging.INFO)
-        logger.addHandler(handler)
+    def close(self):
+        """
+        Log the errors still queued and stop logging to the logfile.
+        """
+        self._close_logging()
 
     def setup_field_validation(self):
         fields = [f['label'] for f in SCHEMA['fields'].values()]
@@ -72,48 +145,198 @@ class Validator:
         self.cols_to_validate = [h for h in self.header if h in fields]
 
     def get_header(self):
-        first_row = pd.read_csv(self.file, sep=self.sep, comment='#', nrows=1, index_col=False)
+        with csv_source(self.file) as (source, compression):
+            first_row = pd.read_csv(source, sep=self.sep, comment='#', nrows=1, index_col=False, compression=compression)
         return first_row.columns.values
 
+    @stage
     def validate_file_squareness(self):
         self.setup_field_validation()
         square_file = self.open_file_and_check_for_squareness()
         if square_file is False:
-            logger.error("Please fix the table. Some rows have different numbers of columns to the header")
-            logger.info("Rows with different numbers of columns to the header are not validated")
-            logger.info("File is invalid")
+            self.logger.error("Please fix the table. Some rows have different numbers of columns to the header")
+            self.logger.info("Rows with different numbers of columns to the header are not validated")
+            self.logger.info("File is invalid")
             return False
         return True
 
+    @stage
     def validate_rows(self):
         if self.nrows < self.minrows:
-            logger.error("There are only {} rows detected in the file, but the minimum requirement is {}".format(str(self.nrows), str(self.minrows)))
-            logger.info("File is invalid")
+            self.logger.error("There are only {} rows detected in the file, but the minimum requirement is {}".format(str(self.nrows), str(self.minrows)))
+            self.logger.info("File is invalid")
             return False
         return True
 
     def allow_zero_pvalues(self):
-        self.schema['fields']['PVAL']['validation'] = [is_dtype(float), p_value_validation_allow_zero]
+        # on a copy, so that the schema shared by other validators still rejects zero
+        self.schema = dict(self.schema, fields=dict(self.schema['fields']))
+        self.schema['fields']['PVAL'] = dict(self.schema['fields']['PVAL'],
+                                             validation=[is_dtype(float), p_value_validation_allow_zero])
 
+    @stage
     def validate_data(self):
         self.setup_field_validation()
-        with tqdm(total=self.nrows) as pbar:
-            for chunk in self.df_iterator():
-                to_validate = self.setup_df_for_validation(chunk)
-                pd_schema = self.construct_validator(self.cols_to_validate)
-                errors = pd_schema.validate(to_validate)
-                self.store_errors(errors, self.errors)
+        self.get_row_index()
+        self.setup_cross_field_rules()
+        self.setup_chunk_checks()
+        with tqdm(total=self.nrows) as pbar, contextlib.closing(self.chunk_errors()) as chunks:
+            for nrows, errors in chunks:
+                self.report_errors(errors)
+                self.errors.extend(errors)
+                self.rows_scanned += nrows
                 stop = self.check_if_exceeding_line_limit()
-                self.evaluate_errors()
-                pbar.update(self.chunksize)
+                self.evaluate_errors(errors)
+                self.check_memory()
+                pbar.update(nrows)
                 if stop:
                     break
+            self.error_logger.flush()
+            if self.reference_check:
+                self.reference_check.log_summary()
             if self.rows_to_drop:
-                logger.info("File is invalid - {} rows with errors, limit set to {}".format(len(self.rows_to_drop), self.error_limit))
+                self.logger.info("File is invalid - {} rows with errors, limit set to {}".format(len(self.rows_to_drop), self.error_limit))
                 return False
-            logger.info("File is valid")
+            self.logger.info("File is valid")
             return True
 
+    def chunk_errors(self):
+        """
+        Yield (number of rows, errors) for each chunk of the file.
+        """
+        try:
+            if self.coordinator:
+                if self.qc and self.coordinator.qc:
+                    self.qc.merge(self.coordinator.qc)
+                yield from self.coordinator.chunk_errors()
+                return
+            if self.incremental:
+                yield from self.incremental_chunk_errors()
+                return
+            if self.split_by_chromosome:
+                self.partitions = ChromosomePartitions(self, self.processes)
+                yield from self.partitions.chunk_errors()
+                return
+            for chunk in self.df_iterator():
+                yield len(chunk), combine_errors(self.validate_df(chunk), self.run_chunk_checks(chunk))
+        finally:
+            for check in self.chunk_checks:
+                check.finish()
+
+    def setup_chunk_checks(self):
+        """
+        Checks that need to see every chunk of the file in order,
+        because they carry state from one chunk to the next.
+        """
+        self.chunk_checks = []
+        if self.check_duplicates:
+            self.chunk_checks.extend(duplicate_checks(self.header, self.schema, self.duplicate_memory))
+        if self.qc_stats:
+            self.qc = QCStats(self.header, self.schema)
+            if not (self.coordinator or self.split_by_chromosome):
+                # otherwise the workers gather the statistics of their rows, which are merged into these
+                self.chunk_checks.append(self.qc)
+        if self.reference:
+            self.reference_check = ReferenceCheck(ReferenceGenome(self.reference),
+                                                  *[self.prop_from_field(field_id, 'label')
+                                                    for field_id in ['CHR', 'BP', 'EFFECT', 'OTHER']])
+            self.chunk_checks.append(self.reference_check)
+
+    def run_chunk_checks(self, df):
+        errors = []
+        for check in self.chunk_checks:
+            errors.extend(check.get_errors(df))
+        return errors
+
+    def validate_df(self, df):
+        to_validate = self.setup_df_for_validation(df)
+        pd_schema = self.construct_validator(self.cols_to_validate)
+        errors = []
+        self.store_errors(self.validate_chunk(to_validate, pd_schema), errors)
+        if self.cross_field_rules:
+            errors = combine_errors(errors, self.validate_cross_fields(df))
+        return errors
+
+    def setup_cross_field_rules(self):
+        """
+        The schema's cross-field rules for which all the fields are in the file,
+        as (validation, column labels) pairs.
+        """
+        self.cross_field_rules = []
+        if not self.cross_field:
+            return
+        for rule in self.schema.get('cross_field_rules', {}).values():
+            columns = []
+            for field in rule['fields']:
+                choices = [self.prop_from_field(f, 'label') for f in (field if isinstance(field, list) else [field])]
+                present = [label for label in choices if label in self.header]
+                if not present:
+                    break
+                columns.append(present[0])
+            else:
+                self.cross_field_rules.append((rule['validation'], columns))
+
+    def validate_cross_fields(self, df):
+        errors = []
+        for validation, columns in self.cross_field_rules:
+            errors.extend(validation.get_errors(df, columns))
+        return errors
+
+    def incremental_chunk_errors(self):
+        """
+        As chunk_errors(), but reusing the errors stored by the last run
+        for every chunk whose content has not changed.
+        """
+        row_index = self.get_row_index()
+        state = IncrementalState.load(state_path(self.file), self.incremental_key())
+        nchunks = len(row_index.chunk_offsets)
+        try:
+            for chunk, digest in enumerate(row_index.chunk_digests):
+                first_row = chunk * self.chunksize
+                errors = state.errors(chunk, digest, first_row)
+                df = None
+                if errors is None:
+                    df = self.read_chunk(chunk)
+                    errors = self.validate_df(df)
+                    state.record(chunk, digest, first_row, errors)
+                if self.chunk_checks:
+                    df = self.read_chunk(chunk) if df is None else df
+                    errors = combine_errors(errors, self.run_chunk_checks(df))
+                yield min(self.chunksize, row_index.nrows - first_row), errors
+        finally:
+            state.save(nchunks)
+            self.logger.info("Reused the results of {} of {} chunks".format(state.reused, nchunks))
+
+    def incremental_key(self):
+        field_ids = [self.field_id_from_column_label(column) for column in self.cols_to_validate]
+        return settings_key(header=list(self.header),
+                            chunksize=self.chunksize,
+                            validations=[[v.message for v in self.prop_from_field(f, 'validation')] for f in field_ids],
+                            mandatory=[self.prop_from_field(f, 'mandatory') for f in field_ids],
+                            cross_field=[(v.rule, v.message, columns) for v, columns in self.cross_field_rules])
+
+    def read_chunk(self, chunk):
+        """
+        Parse one chunk of rows on its own, using the offsets in the row index.
+        """
+        return self.parse_rows(self.get_row_index().read_chunk(chunk), chunk * self.chunksize)
+
+    def parse_rows(self, data, first_row):
+        """
+        Parse the bytes of some rows without the header, numbering them from first_row.
+        Rows with too many fields are truncated rather than dropped, so that the
+        numbering still matches the row index.
+        """
+        read = functools.partial(pd.read_csv, sep=self.sep, dtype=str, comment='#', header=None,
+                                 names=self.header, index_col=False)
+        try:
+            df = read(io.BytesIO(data), usecols=range(len(self.header)))
+        except pd.errors.ParserError:
+            # the C parser fails on a block of only short rows, which need no truncating
+            df = read(io.BytesIO(data), engine='python')
+        df.index = pd.RangeIndex(first_row, first_row + len(df))
+        return df
+
     def setup_df_for_validation(self, df):
         """
         A dummy row with a scientific notation style pvalue is added.
@@ -127,6 +350,53 @@ class Validator:
         to_validate = to_validate.append(psplit_row, ignore_index=False)
         return to_validate
 
+    def validate_chunk(self, df, pd_schema):
+        """
+        Equivalent to pd_schema.validate(df), but each error is tagged
+        with the name of the rule that it failed. With jit, the rules that
+        the kernels can check are checked by them.
+        """
+        errors = []
+        verdicts = kernels.chunk_verdicts(df, pd_schema) if self.jit else {}
+        for column in pd_schema.columns:
+            for i, validation in enumerate(column.validations):
+                checked = validation
+                if (column.name, i) in verdicts:
+                    checked = kernels.PrecomputedValidation(validation, verdicts[(column.name, i)])
+                for error in checked.get_errors(df[column.name], column):
+                    error.rule = rule_name(validation)
+                    errors.append(error)
+        return sorted(errors, key=lambda e: e.row)
+
+    def report_errors(self, errors):
+        if self.report and errors:
+            lines = self.get_row_index().line([error.row for error in errors]).tolist()
+            fields = {column: self.field_id_from_column_label(column) for column in self.cols_to_validate}
+            self.report.add([error_record(error, line, fields.get(error.column))
+                             for error, line in zip(errors, lines)])
+
+    def close_report(self):
+        """
+        Write the summary and close the report, if one was requested.
+        """
+        if self.report:
+            summary = {}
+            if self.partitions:
+                summary['chromosomes'] = self.partitions.summary
+            if self.qc:
+                self.qc.write(self.report.path + '.qc.json')
+            if self.reference_check:
+                summary['reference'] = self.reference_check.summary()
+            self.report.close(file=self.file,
+                              rows=self.nrows,
+                              rows_scanned=self.rows_scanned,
+                              rows_with_errors=len(self.rows_to_drop),
+                              valid='validate_data' in self.stages and
+                                    all(s['passed'] is not False for s in self.stages.values()),
+                              stages=self.stages,
+                              **summary)
+            self.report = None
+
     def store_errors(self, errors, store):
         for error in errors:
             if error.row != self.psplit_row_index:
@@ -134,7 +404,8 @@ class Validator:
 
     def check_if_exceeding_line_limit(self):
         if self.error_limit and len(self.errors) >= self.error_limit:
-            logger.error("Reached limit of {} errors. Stopping validation process now.".format(self.error_limit))
+            self.error_logger.wait()
+            self.logger.error("Reached limit of {} errors. Stopping validation process now.".format(self.error_limit))
             return True
         return False
 
@@ -155,16 +426,20 @@ class Validator:
                 dependent_column = list(fields - {column_to_check})[0]
         return dependent_column
 
-    def evaluate_errors(self):
-        if len(self.errors) > 0:
-            for error in self.errors:
-                if error.row not in self.rows_to_drop:
-                    self.rows_to_drop.append(error.row)
-                    if self.error_limit:
-                        if len(self.rows_to_drop) <= self.error_limit:
-                            logger.error(error)
-                        else:
-                            break
+    def evaluate_errors(self, errors=None):
+        """
+        :param errors: the errors found since the last call, defaults to all of them
+        """
+        errors = self.errors if errors is None else errors
+        to_log = []
+        for error in errors:
+            if self.rows_to_drop.add(error.row):
+                if self.error_limit:
+                    if len(self.rows_to_drop) <= self.error_limit:
+                        to_log.append(error)
+                    else:
+                        break
+        self.error_logger.log(to_log)
 
     def construct_validator(self, column_list):
         validator_list = []
@@ -189,64 +464,200 @@ class Validator:
                 column_id = field
         return column_id
 
+    @stage
     def write_valid_lines_to_file(self):
-        newfile = self.file + ".valid"
-        first_chunk = True
+        newfile = storage.local_name(self.file) + ".valid"
+        with open(newfile, 'w', newline='') as f:
+            # written by a thread while the next chunks are read
+            def write(task):
+                chunk, header = task
+                chunk.to_csv(f, header=header, sep='\t', index=False, na_rep='NA')
+            with background(write, self.pipeline_depth) as write_chunk:
+                first_chunk = True
+                for chunk in self.valid_chunks():
+                    write_chunk((chunk, first_chunk))
+                    first_chunk = False
+
+    @stage
+    def write_sorted_valid_lines_to_file(self):
+        """
+        Like write_valid_lines_to_file(), but the rows are sorted by chromosome and
+        base_pair_location and written with BGZF compression to <file>.valid.gz,
+        with a tabix index at <file>.valid.gz.tbi.
+        """
+        newfile = storage.local_name(self.file) + ".valid.gz"
+        writer = SortedTableWriter(newfile,
+                                   columns=self.header,
+                                   chr_col=self.prop_from_field('CHR', 'label'),
+                                   bp_col=self.prop_from_field('BP', 'label'),
+                                   memory_budget=self.sort_memory)
+        for chunk in self.valid_chunks(spill=[writer.spill]):
+            writer.add(chunk)
+        self.logger.info("Tabix index written to {}".format(writer.close()))
+        if writer.unplaced:
+            self.logger.warning("{} rows without an integer {} or {} written unsorted to {}".format(
+                writer.unplaced, writer.chr_col, writer.bp_col, writer.unplaced_path))
+
+    @stage
+    def write_typed_valid_lines_to_file(self, format='parquet', partition=False):
+        """
+        Write the rows without errors to <file>.valid.parquet or <file>.valid.arrow,
+        with the columns typed by the dtypes of the schema.
+
+        :param partition: write a parquet table as a directory partitioned by chromosome
+        """
+        newfile = "{}.valid.{}".format(storage.local_name(self.file), format)
+        writer = TypedTableWriter(newfile,
+                                  columns=self.header,
+                                  schema=self.schema,
+                                  format=format,
+                                  partition_col=self.prop_from_field('CHR', 'label') if partition else None)
+        for chunk in self.valid_chunks():
+            writer.add(chunk)
+        self.logger.info("Validated rows written to {}".format(writer.close()))
+        if writer.dropped:
+            self.logger.warning("{} rows with values that don't fit the types of their columns left out of {}".format(
+                writer.dropped, newfile))
+
+    def valid_chunks(self, spill=()):
+        """
+        Chunks of the file without the rows with errors or a different number of fields to the header.
+
+        :param spill: functions that move the state of the writer out of memory, if it is needed
+        """
+        ragged_rows = self.get_row_index().ragged_rows
         with tqdm(total=self.nrows) as pbar:
             for chunk in self.df_iterator():
-                chunk.drop(self.rows_to_drop, inplace=True, errors='ignore')
-                if first_chunk:
-                    chunk.to_csv(newfile, mode='w', sep='\t', index=False, na_rep='NA')
-                    first_chunk = False
-                else:
-                    chunk.to_csv(newfile, mode='a', header=False, sep='\t', index=False, na_rep='NA')
-                pbar.update(self.chunksize)
+                pbar.update(len(chunk))
+                chunk.drop(self.rows_to_drop.among(chunk.index), inplace=True, errors='ignore')
+                chunk.drop(ragged_rows, inplace=True, errors='ignore')
+                yield chunk
+                self.check_memory(spill)
 
+    def check_memory(self, spill=()):
+        """
+        With a memory budget, free memory or shrink the next chunks if too much is in use.
+        Raises MemoryBudgetExceeded if the budget can't be met.
+        """
+        if self.governor:
+            self.governor.check(spill=[self.errors.spill,
+                                       self.rows_to_drop.spill,
+                                       *[check.spill_memory_runs for check in self.chunk_checks],
+                                       *spill])
+
+    @stage
     def validate_file_extension(self):
         check_exts = [check_ext(self.file, ext) for ext in self.valid_extensions]
         if not any(check_exts):
-            logger.error("File extension should be in {}".format(self.valid_extensions))
+            self.logger.error("File extension should be in {}".format(self.valid_extensions))
             return False
         return True
 
 
     def df_iterator(self):
-        df = pd.read_csv(self.file, 
-                         sep=self.sep, 
-                         dtype=str, 
-                         error_bad_lines=False,
-                         warn_bad_lines=False,
-                         comment='#', 
-                         chunksize=self.chunksize)
-        return df
+        """
+        Chunks of the file, indexed by row number. Rows with too many fields are
+        truncated to the columns of the header, as in parse_rows(), rather than
+        skipped, so the index matches the row index built by the squareness scan.
+        """
+        row_index = self.get_row_index()
+        nread = 0
+        # with a pipeline, the chunks are parsed by a thread while the ones before them are validated
+        pause = (lambda: self.governor.under_pressure) if self.governor else None
+        for chunk in prefetch(self.read_chunks(), self.pipeline_depth, pause=pause, name='ss-validate-parser'):
+            nread += len(chunk)
+            yield chunk
+        if nread != row_index.nrows:
+            self.logger.warning("Read {} rows but expected {}, row numbers may not match the file".format(
+                nread, row_index.nrows))
+
+    def read_chunks(self):
+        header = self.get_header()
+        with self.open_source() as (source, compression):
+            df = pd.read_csv(source,
+                             sep=self.sep,
+                             compression=compression,
+                             dtype=str,
+                             comment='#',
+                             header=0,
+                             names=header,
+                             usecols=range(len(header)),
+                             index_col=False,
+                             chunksize=self.chunksize)
+            while True:
+                try:
+                    # the governor can shrink the chunks while the file is read
+                    chunk = df.get_chunk(self.governor.chunk_rows if self.governor else None)
+                except StopIteration:
+                    break
+                yield chunk
 
-    def check_rows(self, csv_file):
-        square = True
-        dialect = csv.Sniffer().sniff(csv_file.readline())
-        csv_file.seek(0)
-        reader = csv.reader(csv_file, dialect)
-        self.nrows = 0
-        try:
-            for row in reader:
-                if len(row) != len(self.header):
-                    logger.error("Length of row {c} is: {l} instead of {h}".format(c=self.nrows,
-                                                                                   l=str(len(row)),
-                                                                                   h=str(len(self.header))))
-                    square = False
-                self.nrows += 1
-        except csv.Error as e:
-            logger.error("There was the following error when checking the squareness of the csv: {}".format(e))
-            square = False
-        return square
+    @contextlib.contextmanager
+    def open_source(self):
+        """
+        What to give pandas to read the file, with its compression. With a
+        pipeline, the file is read and decompressed ahead by a thread.
+        """
+        if not self.pipeline_depth:
+            with csv_source(self.file) as source:
+                yield source
+            return
+        with contextlib.closing(PrefetchReader(lambda: open_binary(self.file))) as reader:
+            yield reader, None
+
+    def get_row_index(self):
+        """
+        The row index is built once, by the squareness check if that has been run,
+        and shared by every later stage. A saved index is used if it is up to date.
+        """
+        if self.row_index is None and self.coordinator:
+            self.setup_cross_field_rules()
+            self.row_index = self.coordinator.validate(self)
+        if self.row_index is None:
+            self.row_index = RowIndex.load(self.file)
+        if self.row_index is None or (self.chunk_rows() and self.row_index.chunk_rows != self.chunk_rows()):
+            self.row_index = scan_file(self.file, sep=self.sep, chunk_rows=self.chunk_rows())
+        self.nrows = self.row_index.nrows
+        return self.row_index
+
+    def chunk_rows(self):
+        """
+        The chunk size to record the offsets and fingerprints of chunks with
+        during the scan, if they are needed.
+        """
+        return self.chunksize if self.incremental or self.split_by_chromosome else None
 
-    def open_file_and_check_for_squareness(self):
-        if pathlib.Path(self.file).suffix in [".gz", ".gzip"]:
-             with gzip.open(self.file, 'rt') as f:
-                 return self.check_rows(f)
-        else: 
-            with open(self.file, 'r') as f:
-                 return self.check_rows(f)
+    def save_row_index(self):
+        path = self.get_row_index().save()
+        self.logger.info("Row index saved to {}".format(path))
 
+    def open_file_and_check_for_squareness(self):
+        try:
+            if self.coordinator:
+                self.get_row_index()
+            else:
+                self.row_index = scan_file(self.file, sep=self.sep, ncols=len(self.header), chunk_rows=self.chunk_rows())
+        except (OSError, EOFError) as e:
+            self.logger.error("There was the following error when checking the squareness of the file: {}".format(e))
+            return False
+        self.nrows = self.row_index.nrows
+        ragged_lines = self.row_index.ragged_lines()
+        if self.report:
+            self.report.add([{'row': row,
+                              'line': line,
+                              'column': None,
+                              'field': None,
+                              'rule': 'squareness',
+                              'value': str(nfields),
+                              'message': 'has {} fields instead of {}'.format(nfields, len(self.header))}
+                             for row, (line, nfields) in zip(self.row_index.ragged_rows.tolist(), ragged_lines)])
+        for line, nfields in ragged_lines:
+            self.logger.error("Length of line {c} is: {l} instead of {h}".format(c=line,
+                                                                            l=str(nfields),
+                                                                            h=str(len(self.header))))
+        return self.row_index.square
+
+    @stage
     def validate_headers(self):
         """
         Assumes that the fields in the schema with a 'column_index' are the mandatory fields.
@@ -263,11 +674,15 @@ class Validator:
             else:
                 missing.append(fields)
         if len(missing) > 0:
-            logger.error("The following fields where either missing or in the wrong order: {}".format(missing))
+            self.logger.error("The following fields where either missing or in the wrong order: {}".format(missing))
             return False
         return True
 
 
+def combine_errors(*error_lists):
+    return sorted([error for errors in error_lists for error in errors], key=lambda e: e.row)
+
+
 def check_ext(filename, ext):
     if filename.endswith(ext):
         return True
@@ -281,10 +696,43 @@ def get_seperator(file):
     return sep
 
 
+def show_rows(file, rows, context=0):
+    """
+    Print rows reported in the errors, with `context` rows either side,
+    using the saved row index of the file if there is one.
+    """
+    row_index = RowIndex.load(file)
+    if row_index is None:
+        logger.info("No up to date row index for {}, scanning the file...".format(file))
+        row_index = scan_file(file, sep=get_seperator(file))
+    for row in rows:
+        for current, line, text in row_index.fetch(row, context):
+            print("{m} row {r} (line {l}): {t}".format(m='>' if current == row else ' ',
+                                                       r=current,
+                                                       l=line,
+                                                       t=text))
+
+
+def close_logging(validator_logger, handler, error_logger):
+    error_logger.close()
+    validator_logger.removeHandler(handler)
+    handler.close()
+
+
+def shard_validator(file, zero_pvalues, cross_field, logfile='VALIDATE.log'):
+    """
+    A Validator set up to validate the shards of a file in a worker.
+    """
+    validator = Validator(file, logfile=logfile, zero_pvalues=zero_pvalues, cross_field=cross_field)
+    validator.setup_field_validation()
+    validator.setup_cross_field_rules()
+    return validator
+
+
 def main():
     argparser = argparse.ArgumentParser()
     argparser.add_argument("-f", "--file",
-                           help='The path to the summary statistics file to be validated')
+                           help='The path or s3://bucket/key URL of the summary statistics file to be validated')
     argparser.add_argument("-l", "--logfile",
                            help='Provide the filename for the logs',
                            default='VALIDATE.log')
@@ -299,12 +747,132 @@ def main():
                                  If this option is used, --linelimit will be set to None',
                            action='store_true',
                            dest='dropbad')
+    argparser.add_argument("-b", "--bgzip",
+                           help='With --drop-bad-rows, write the good rows sorted by chromosome and base_pair_location \
+                                 to <summary-stats-file>.valid.gz, compressed with BGZF and indexed with tabix',
+                           action='store_true')
+    argparser.add_argument("-t", "--typed-output",
+                           help='Also write the rows without errors, typed by the schema, to \
+                                 <summary-stats-file>.valid.parquet or <summary-stats-file>.valid.arrow (Arrow IPC). \
+                                 Without --drop-bad-rows this is only done if the file is valid',
+                           choices=['parquet', 'arrow'],
+                           dest='typed_output')
+    argparser.add_argument("--partition-by-chromosome",
+                           help='Write --typed-output parquet as a directory with a table for each chromosome',
+                           action='store_true',
+                           dest='partition')
+    argparser.add_argument("--sort-memory",
+                           help='MB of rows to sort in memory for --bgzip before sorting them on disk',
+                           type=int,
+                           default=1024,
+                           dest='sort_memory')
+    argparser.add_argument("--memory-budget",
+                           help='MB of memory the validation may use. Over 80%% of it, errors are moved to disk \
+                                 and smaller chunks are read, and it stops if the budget still can\'t be met',
+                           type=int,
+                           dest='memory_budget')
+    argparser.add_argument("--cache-dir",
+                           help='Where to cache the blocks of a file read from an s3:// URL',
+                           dest='cache_dir')
+    argparser.add_argument("--cache-size",
+                           help='MB of blocks of files read from s3:// URLs to cache, 0 to not cache them',
+                           type=int,
+                           dest='cache_size')
+    argparser.add_argument("--prefetch",
+                           help='Number of blocks of a file read from an s3:// URL to fetch ahead, in parallel',
+                           type=int)
     argparser.add_argument("-v", "--version",
                            help='Just return the version of the validator',
                            action='store_true')
     argparser.add_argument("-z", "--zero_pvalues",
                            help="Use if you want allow p-values of zero",
                            action='store_true')
+    argparser.add_argument("-i", "--save-index",
+                           help='Save a row index to <summary-stats-file>.idx.npz, \
+                                 so that the rows with errors can be looked up with --show-rows',
+                           action='store_true',
+                           dest='save_index')
+    argparser.add_argument("-s", "--show-rows",
+                           help='Just print these comma separated rows, as numbered in the errors, and exit',
+                           dest='show_rows')
+    argparser.add_argument("-r", "--report",
+                           help='Write the errors and a summary to this file as JSON Lines, \
+                                 or as Parquet if it ends with .parquet')
+    argparser.add_argument("-n", "--incremental",
+                           help='Save the results of each chunk to <summary-stats-file>.state.json and, \
+                                 if it already exists, only revalidate the chunks that have changed',
+                           action='store_true')
+    argparser.add_argument("-u", "--check-duplicates",
+                           help='Also report rows that duplicate the variant (chromosome, base_pair_location \
+                                 and alleles), variant_id or rsid of an earlier row',
+                           action='store_true',
+                           dest='check_duplicates')
+    argparser.add_argument("--duplicate-memory",
+                           help='MB of memory to use for the duplicate check before spilling to disk',
+                           type=int,
+                           default=256,
+                           dest='duplicate_memory')
+    argparser.add_argument("-x", "--cross-field",
+                           help='Also check that the fields of a row are consistent with each other, e.g. that \
+                                 variant_id matches the position and alleles and the effect is within the CI',
+                           action='store_true',
+                           dest='cross_field')
+    argparser.add_argument("--coordinator",
+                           help='Split the file into shards and serve them to workers started with --worker \
+                                 at this host:port, merging their results')
+    argparser.add_argument("--shard-size",
+                           help='MB of the file (compressed, for a BGZF file) in each shard given to a worker',
+                           type=int,
+                           default=64,
+                           dest='shard_size')
+    argparser.add_argument("--worker",
+                           help='Validate shards for the coordinator at this URL, e.g. http://host:port, \
+                                 until there are none left. With -f, only shards of that file are validated')
+    argparser.add_argument("--token",
+                           help='The secret shared by the coordinator and its workers, by default the \
+                                 SS_VALIDATE_TOKEN environment variable. The coordinator makes one up if neither \
+                                 is given',
+                           default=os.environ.get('SS_VALIDATE_TOKEN'))
+    argparser.add_argument("--worker-timeout",
+                           help='Seconds the coordinator waits without hearing from a worker before failing',
+                           type=int,
+                           default=WORKER_TIMEOUT_SECONDS,
+                           dest='worker_timeout')
+    argparser.add_argument("--split-by-chromosome",
+                           help='With --drop-bad-rows, validate the rows of each chromosome in parallel and write \
+                                 the good rows of each to <summary-stats-file>.chr<chromosome>.valid, \
+                                 also checking that base_pair_location is sorted within each chromosome',
+                           action='store_true',
+                           dest='split_by_chromosome')
+    argparser.add_argument("--processes",
+                           help='Number of processes for --split-by-chromosome, by default the number of CPUs',
+                           type=int)
+    argparser.add_argument("--no-jit",
+                           help="Don't use the JIT compiled validation kernels, which are used if Numba is installed",
+                           action='store_const',
+                           const=False,
+                           dest='jit')
+    argparser.add_argument("--errors-per-rule",
+                           help='Log at most this number of errors for each column and rule, and how many more '
+                                'there were. 0, the default, logs them all',
+                           type=int,
+                           default=0)
+    argparser.add_argument("--qc-stats",
+                           help='Also summarise the rows per chromosome, missing values, allele frequencies, p-values, '
+                                'genomic inflation and effect size ranges, in <report>.qc.json. Needs --report',
+                           action='store_true')
+    argparser.add_argument("--pipeline-depth",
+                           help='Chunks to read and parse ahead of the validation, and to queue for writing, '
+                                'in background threads. 0 does each in turn',
+                           type=int,
+                           default=DEPTH)
+    argparser.add_argument("--reference",
+                           help='Check the alleles of each row against this reference genome, an uncompressed FASTA '
+                                'file, which is indexed the first time it is used if it has no .fai index')
+    argparser.add_argument("-c", "--context",
+                           help='Number of rows to print either side of each row given to --show-rows',
+                           type=int,
+                           default=2)
     args = argparser.parse_args()
 
     file_to_validate = args.file
@@ -314,22 +882,86 @@ def main():
     logfile = args.logfile
     print_version = args.version
     zero_pvalues = args.zero_pvalues
+    save_index = args.save_index
+
+    storage.configure(cache_dir=args.cache_dir, cache_size=args.cache_size, prefetch=args.prefetch)
 
     if print_version:
         print(get_version())
         sys.exit(0)
+    elif args.worker:
+        if not args.token:
+            logger.error("--worker needs the --token of the coordinator")
+            sys.exit(1)
+        run_worker(args.worker, functools.partial(shard_validator, logfile=logfile), args.token, file=file_to_validate)
+        sys.exit(0)
+    elif args.show_rows and file_to_validate:
+        show_rows(file_to_validate, [int(r) for r in args.show_rows.split(',')], args.context)
+        sys.exit(0)
     else:
         if not file_to_validate:
             logger.error("the following arguments are required: -f/--file")
             sys.exit()
 
+    if args.qc_stats and not args.report:
+        logger.error("--qc-stats needs --report")
+        sys.exit()
+
+    if args.split_by_chromosome:
+        if not drop_bad:
+            logger.error("--split-by-chromosome needs --drop-bad-rows")
+            sys.exit()
+        if args.incremental or args.check_duplicates or args.coordinator or args.bgzip or args.reference:
+            logger.error("--incremental, --check-duplicates, --coordinator, --bgzip and --reference can't be used "
+                         "with --split-by-chromosome")
+            sys.exit()
+
+    coordinator = None
+    if args.coordinator:
+        if args.incremental or args.check_duplicates or args.reference:
+            logger.error("--incremental, --check-duplicates and --reference can't be used with --coordinator")
+            sys.exit()
+        host, port = args.coordinator.rsplit(':', 1)
+        coordinator = Coordinator(file_to_validate, host, int(port), shard_size=args.shard_size * 1024 * 1024,
+                                  token=args.token, worker_timeout=args.worker_timeout)
+        if not args.token:
+            logger.info("Start the workers with --token {}".format(coordinator.token))
+
     validator = Validator(file=file_to_validate,
                           logfile=logfile,
                           error_limit=error_limit,
                           minrows=minrows,
                           dropbad=drop_bad,
-                          zero_pvalues=zero_pvalues)
-
+                          zero_pvalues=zero_pvalues,
+                          report=args.report,
+                          incremental=args.incremental,
+                          check_duplicates=args.check_duplicates,
+                          duplicate_memory=args.duplicate_memory,
+                          cross_field=args.cross_field,
+                          coordinator=coordinator,
+                          sort_memory=args.sort_memory,
+                          memory_budget=args.memory_budget,
+                          split_by_chromosome=args.split_by_chromosome,
+                          processes=args.processes,
+                          jit=args.jit,
+                          errors_per_rule=args.errors_per_rule or None,
+                          qc_stats=args.qc_stats,
+                          pipeline_depth=args.pipeline_depth,
+                          reference=args.reference)
+    try:
+        run_validation(validator, file_to_validate, drop_bad, save_index, args.bgzip, args.typed_output, args.partition)
+    except MemoryBudgetExceeded as e:
+        validator.logger.error("Stopping validation: {}".format(e))
+        sys.exit(1)
+    finally:
+        validator.close_report()
+        validator.close()
+        if coordinator:
+            coordinator.close()
+
+
+def run_validation(validator, file_to_validate, drop_bad, save_index, bgzip=False, typed_output=None, partition=False):
+    logger = validator.logger
     logger.info("Validating file extension...")
     if not validator.validate_file_extension():
         logger.info("Invalid file extesion: {}".format(file_to_validate))
@@ -346,7 +978,10 @@ def main():
         logger.info("ok")
 
     logger.info("Validating file for squareness...")
-    if not validator.validate_file_squareness():
+    square = validator.validate_file_squareness()
+    if save_index and validator.row_index is not None:
+        validator.save_row_index()
+    if not square:
         logger.info("Rows are malformed..exiting before any further checks")
         sys.exit()
     else:
@@ -360,10 +995,18 @@ def main():
         logger.info("ok")
 
     logger.info("Validating data...")
-    validator.validate_data()
-    if drop_bad:
-        logger.info("Writing good lines to {}.valid".format(file_to_validate))
+    valid = validator.validate_data()
+    if drop_bad and validator.split_by_chromosome:
+        logger.info("Good lines written to {}.chr<chromosome>.valid".format(storage.local_name(file_to_validate)))
+    elif drop_bad and bgzip:
+        logger.info("Writing sorted good lines to {}.valid.gz".format(storage.local_name(file_to_validate)))
+        validator.write_sorted_valid_lines_to_file()
+    elif drop_bad:
+        logger.info("Writing good lines to {}.valid".format(storage.local_name(file_to_validate)))
         validator.write_valid_lines_to_file()
+    if typed_output and (valid or drop_bad):
+        logger.info("Writing typed good lines to {}.valid.{}".format(storage.local_name(file_to_validate), typed_output))
+        validator.write_typed_valid_lines_to_file(typed_output, partition)
 
 
 if __name__ == '__main__':
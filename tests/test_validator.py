@@ -1,11 +1,34 @@
 import unittest
 import shutil
 import os
+import gzip
+import sys
+import subprocess
+import threading
+import urllib.error
+import urllib.request
 import tests.prep_tests as prep
 import ss_validate.validator as v
 from ss_validate.schema import SCHEMA
+from ss_validate.rowindex import RowIndex
+from ss_validate.scanner import scan_file
+from ss_validate.helpers import match_regex, open_binary
+from ss_validate.gzindex import bgzf_block, GzipMemberReader
+from ss_validate.sharded import Coordinator
+from ss_validate.memory import MemoryBudgetExceeded, RowLog
+from ss_validate import differential, duplicates, kernels, memory, pipeline
+from pandas_schema.validation import MatchesPatternValidation
+import numpy as np
+import pandas as pd
 import hashlib
+import json
 from collections import OrderedDict
+from ss_validate import storage
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 
 class BasicTestCase(unittest.TestCase):
@@ -93,6 +116,115 @@ class BasicTestCase(unittest.TestCase):
         valid_headers = validator.validate_headers()
         self.assertFalse(valid_headers)
 
+    def test_validate_square_file(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.prep_test_file()
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        self.assertTrue(validator.validate_file_squareness())
+        self.assertEqual(validator.nrows, 4)
+
+    def test_validate_ragged_file(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.prep_test_file()
+        with open(test_filepath, 'a') as f:
+            f.write("1\t123\n")
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        self.assertFalse(validator.validate_file_squareness())
+        self.assertEqual(validator.nrows, 5)
+
+    def test_squareness_skips_comment_lines(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv.gz")
+        setup_file = prep.SSTestFile(filename="test_file.tsv")
+        setup_file.prep_test_file()
+        with open(os.path.join(self.test_storepath, "test_file.tsv"), 'rb') as f:
+            lines = f.readlines()
+        lines.insert(0, b"# a comment\twith\tdelimiters\n")
+        lines.insert(3, b"\n")
+        lines[4] = lines[4].rstrip(b"\n") + b"# trailing\tcomment\n"
+        with gzip.open(test_filepath, 'wb') as f:
+            f.writelines(lines)
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        self.assertTrue(validator.validate_file_squareness())
+        self.assertEqual(validator.nrows, 4)
+
+    def test_squareness_of_quoted_fields(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.prep_test_file()
+        with open(test_filepath, 'rb') as f:
+            lines = f.readlines()
+        lines[1] = b'"1\t#"' + lines[1][1:]  # a delimiter and a '#' within quotes
+        lines[2] = b'"1""\t"' + lines[2][1:]  # a doubled quote, then a delimiter within quotes
+        lines.append(lines[3].rstrip(b"\n") + b'\t"extra"\n')
+        with open(test_filepath, 'wb') as f:
+            f.writelines(lines)
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        self.assertFalse(validator.validate_file_squareness())
+        self.assertEqual(validator.nrows, 5)
+        self.assertEqual(validator.get_row_index().ragged_rows.tolist(), [4])
+        df = pd.read_csv(test_filepath, sep='\t', dtype=str, comment='#', nrows=2)
+        self.assertEqual(df.iloc[:, 0].tolist(), ['1\t#', '1"\t'])
+
+    def test_row_numbers_survive_skipped_lines(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, 0.2, 0.3, 100]  # last row bad
+        setup_file.prep_test_file()
+        with open(test_filepath, 'rb') as f:
+            lines = f.readlines()
+        lines.insert(1, b"# comment\n")
+        lines.insert(2, lines[2].rstrip(b"\n") + b"\textra\n")  # too many fields
+        with open(test_filepath, 'wb') as f:
+            f.writelines(lines)
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        validator.validate_data()
+        self.assertEqual(validator.nrows, 5)
+        self.assertEqual(validator.rows_to_drop, [4])
+        row_index = validator.get_row_index()
+        self.assertEqual(row_index.line([0, 4]).tolist(), [3, 7])
+        with open(test_filepath, 'rb') as f:
+            f.seek(row_index.offset(4))
+            self.assertEqual(f.readline(), lines[6])
+        validator.write_valid_lines_to_file()
+        with open(test_filepath + ".valid", 'r') as f:
+            self.assertEqual(len(f.readlines()), 4)  # header and rows 1-3
+
+    def test_fetch_rows_from_saved_index(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv.gz")
+        setup_file = prep.SSTestFile(filename="test_file.tsv")
+        setup_file.prep_test_file()
+        with open(os.path.join(self.test_storepath, "test_file.tsv"), 'rb') as f:
+            lines = f.readlines()
+        with open(test_filepath, 'wb') as f:
+            for line in lines:  # one gzip member per line, like a tiny BGZF file
+                f.write(gzip.compress(line))
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG")
+        validator.validate_file_squareness()
+        validator.save_row_index()
+        row_index = RowIndex.load(test_filepath)
+        self.assertEqual(row_index.nrows, 4)
+        self.assertEqual(row_index.fetch(2, context=1),
+                         [(r, r + 2, lines[r + 1].decode().rstrip("\n")) for r in [1, 2, 3]])
+        index_file = test_filepath + ".idx.npz"
+        with np.load(index_file) as saved:
+            older = {name: saved[name] for name in saved.files if name != 'index_version'}
+        with open(index_file, 'wb') as f:
+            np.savez_compressed(f, **older)
+        self.assertIsNone(RowIndex.load(test_filepath))  # saved by an earlier version
+        row_index = scan_file(test_filepath, spacing=2)
+        row_index.access_points = np.array([(0, 0), (len(gzip.compress(lines[0])), len(lines[0]))])
+        self.assertEqual(row_index.fetch(3)[0][2], lines[4].decode().rstrip("\n"))
+        # from the start the gzip module reads the file, with access points the member reader, in reads of any size
+        with open_binary(test_filepath) as plain, open_binary(test_filepath, record_access_points=True) as members:
+            self.assertNotIsInstance(plain.raw, GzipMemberReader)
+            self.assertEqual(b''.join(iter(lambda: members.raw.read(7), b'')), plain.read())
+        with open(test_filepath, 'ab') as f:
+            f.write(gzip.compress(lines[-1]))
+        self.assertIsNone(RowIndex.load(test_filepath))
+
     def test_validate_good_file_data(self):
         test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
         logfile=test_filepath.replace('tsv', 'LOG')
@@ -330,6 +462,494 @@ class BasicTestCase(unittest.TestCase):
         valid_data = validator.validate_data()
         self.assertTrue(valid_data)
 
+    def test_errors_logged_per_rule(self):
+        test_filename = "bad_pval.tsv"
+        test_filepath = os.path.join(self.test_storepath, test_filename)
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile(filename=test_filename)
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [100.0, -1.0, 0.5, 0.5]
+        setup_file.test_data_dict[SCHEMA['fields']['BP']['label']] = [1, 2, 0, -5]
+        setup_file.prep_test_file()
+        validator = v.Validator(file=test_filepath, logfile=logfile, errors_per_rule=1)
+        other = v.Validator(file=test_filepath, logfile=test_filepath.replace('tsv', 'other.LOG'))
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.rows_to_drop, [0, 1, 2, 3])
+        validator.close()
+        self.assertEqual(validator.logger.handlers, [])
+        other.close()
+        with open(test_filepath.replace('tsv', 'other.LOG')) as f:
+            self.assertEqual(f.read(), '')  # each validator logs to its own logfile
+        with open(logfile) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(sum(line.startswith('{row: ') for line in lines), 2)
+        self.assertIn('...and 1 more p_value p_value errors', lines)
+        self.assertIn('...and 1 more base_pair_location in_range errors', lines)
+        os.remove(logfile)
+        validator = v.Validator(file=test_filepath, logfile=logfile)  # by default every error is logged
+        self.assertFalse(validator.validate_data())
+        validator.close()
+        with open(logfile) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(sum(line.startswith('{row: ') for line in lines), 4)
+        self.assertFalse(any(line.startswith('...and') for line in lines))
+        os.remove(logfile)
+        validator = v.Validator(file=test_filepath, logfile=logfile, error_limit=2, chunksize=1)
+        self.assertFalse(validator.validate_data())
+        validator.close()
+        with open(logfile) as f:
+            lines = f.read().splitlines()
+        # the errors of the chunks before the one that reaches the limit are logged before it
+        self.assertEqual([line.split(',')[0] for line in lines[:3]],
+                         ['{row: 0', 'Reached limit of 2 errors. Stopping validation process now.', '{row: 1'])
+
+    def test_json_lines_report(self):
+        test_filename = "bad_pval.tsv"
+        test_filepath = os.path.join(self.test_storepath, test_filename)
+        logfile = test_filepath.replace('tsv', 'LOG')
+        report = os.path.join(self.test_storepath, "report.jsonl")
+        setup_file = prep.SSTestFile(filename=test_filename)
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, -1.0, 0.1, 1.0]
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = [1, 1, "CHR1", 20]
+        setup_file.prep_test_file()
+        validator = v.Validator(file=test_filepath, logfile=logfile, report=report)
+        self.assertFalse(validator.validate_data())
+        validator.close_report()
+        with open(report) as f:
+            records = [json.loads(line) for line in f]
+        errors = [r for r in records if r['type'] == 'error']
+        self.assertEqual([(e['row'], e['line'], e['field'], e['rule'], e['value']) for e in errors],
+                         [(1, 3, 'PVAL', 'p_value', '-1.0'), (2, 4, 'CHR', 'in_list', 'CHR1')])
+        summary = records[-1]
+        self.assertEqual(summary['type'], 'summary')
+        self.assertEqual(summary['rows_scanned'], 4)
+        self.assertEqual(summary['errors'], 2)
+        self.assertFalse(summary['valid'])
+        self.assertIn('validate_data', summary['stages'])
+
+    def test_qc_stats(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        report = os.path.join(self.test_storepath, "report.jsonl")
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = ["2", "1", "X", "1"]
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = ['NA', 0.1, 0.3, 0.92]
+        setup_file.test_data_dict[SCHEMA['fields']['EAF']['label']] = [0.5, 0.5, 'x', 0.04]
+        setup_file.prep_test_file()
+        summaries = []
+        for kwargs in [{}, {'split_by_chromosome': True, 'processes': 2}]:
+            validator = v.Validator(file=test_filepath, logfile=logfile, dropbad=True, chunksize=1, report=report,
+                                    qc_stats=True, **kwargs)
+            validator.validate_data()
+            validator.close_report()
+            with open(report + '.qc.json') as f:
+                summaries.append(json.load(f))
+        validator = v.Validator(file=test_filepath, logfile=logfile, dropbad=True, chunksize=1, report=report,
+                                qc_stats=True, memory_budget=100)
+        validator.governor.measure = lambda: 90  # over the high water mark, so the chunk checks are spilled
+        validator.validate_data()
+        validator.close_report()
+        with open(report + '.qc.json') as f:
+            summaries.append(json.load(f))
+        qc = summaries[0]
+        self.assertEqual(summaries[1], qc)
+        self.assertEqual(summaries[2], qc)
+        self.assertEqual(qc['rows'], 4)
+        self.assertEqual(qc['chromosomes'], {'1': 2, '2': 1, 'X': 1})
+        self.assertEqual(qc['missing']['p_value'], {'count': 1, 'fraction': 0.25})
+        self.assertEqual(qc['not_numeric'], {'effect_allele_frequency': 1})
+        self.assertEqual(qc['effect_allele_frequency']['counts'][0], 1)
+        self.assertEqual(qc['effect_allele_frequency']['counts'][10], 2)
+        self.assertEqual(qc['p_value']['count'], 3)
+        self.assertAlmostEqual(qc['p_value']['median'], 0.3)
+        self.assertAlmostEqual(qc['p_value']['lambda_gc'], 2.3612, places=4)
+
+    def test_reference_allele_check(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        report = os.path.join(self.test_storepath, "report.jsonl")
+        fasta = os.path.join(self.test_storepath, "reference.fa")
+        with open(fasta, 'w') as f:
+            f.write(">chr1 the first\nacgtACGTAC\nGTACGT\n>chr2\nTTTTTTTTTT\nGGGGGGGGGG\n")
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = ["1", "1", "2", "25"]
+        setup_file.test_data_dict[SCHEMA['fields']['BP']['label']] = [3, 5, 12, 2]
+        setup_file.test_data_dict[SCHEMA['fields']['EFFECT']['label']] = ["A", "CCG", "C", "T"]
+        setup_file.test_data_dict[SCHEMA['fields']['OTHER']['label']] = ["G", "C", "T", "TTT"]
+        setup_file.prep_test_file()
+        for memory_budget in [None, 100]:
+            validator = v.Validator(file=test_filepath, logfile=logfile, report=report, reference=fasta,
+                                    chunksize=2, memory_budget=memory_budget)
+            if memory_budget:
+                validator.governor.measure = lambda: 90  # over the high water mark, so the chunk checks are spilled
+            self.assertTrue(validator.validate_data())
+            validator.close_report()
+            with open(fasta + '.fai') as f:
+                self.assertEqual(f.read(), "chr1\t16\t16\t10\t11\nchr2\t20\t40\t10\t11\n")
+            with open(report) as f:
+                summary = [json.loads(line) for line in f][-1]['reference']
+            self.assertEqual((summary['matched'], summary['flipped'], summary['mismatched']), (1, 1, 1))
+            self.assertEqual(summary['unknown_chromosome'], 1)
+            self.assertAlmostEqual(summary['mismatch_rate'], 2 / 3)
+            self.assertEqual(summary['flagged_rows'], [1, 2])
+            self.assertIsNone(summary['likely_build'])
+
+    def test_incremental_revalidation(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, -1.0, 0.1, 100]
+        setup_file.prep_test_file()
+        validator = v.Validator(test_filepath, logfile=logfile, chunksize=2, incremental=True)
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.rows_to_drop, [1, 3])
+        with open(test_filepath) as f:
+            lines = f.readlines()
+        lines[4] = lines[4].replace("\t100.0\t", "\t0.5\t")  # fix row 3
+        lines.append(lines[1].replace("\t0.1\t", "\t-5\t"))  # append a bad row 4
+        with open(test_filepath, 'w') as f:
+            f.writelines(lines)
+        validator = v.Validator(test_filepath, logfile=logfile, chunksize=2, incremental=True)
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.rows_to_drop, [1, 4])
+        self.assertEqual(str(validator.errors[0]), '{row: 1, column: "p_value"}: "-1.0" ' +
+                         str(validator.errors[0].message))
+        full = v.Validator(test_filepath, logfile=logfile, chunksize=2)
+        full.validate_data()
+        self.assertEqual([str(e) for e in validator.errors], [str(e) for e in full.errors])
+
+    def test_duplicate_variants(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        for label in ['CHR', 'BP', 'EFFECT', 'OTHER']:
+            values = setup_file.test_data_dict[SCHEMA['fields'][label]['label']]
+            values[3] = values[0]  # row 3 is the variant of row 0
+        setup_file.test_data_dict[SCHEMA['fields']['RSID']['label']] = ["rs1", "rs2", "rs2", "NA"]
+        setup_file.prep_test_file()
+        validator = v.Validator(test_filepath, logfile=logfile)
+        self.assertTrue(validator.validate_data())
+        for memory in [256, 0]:  # 0 spills the seen variants to disk after every chunk
+            validator = v.Validator(test_filepath, logfile=logfile, chunksize=2,
+                                    check_duplicates=True, duplicate_memory=memory)
+            self.assertFalse(validator.validate_data())
+            self.assertEqual(validator.rows_to_drop, [2, 3])
+            self.assertEqual([(e.row, e.column, e.value, e.message) for e in validator.errors],
+                             [(2, 'rsid', 'rs2', 'is a duplicate of row 1'),
+                              (3, 'chromosome+base_pair_location+effect_allele+other_allele', '1:1118275:A:G',
+                               'is a duplicate of row 0')])
+
+    def test_duplicates_found_across_merged_spills(self):
+        check = duplicates.DuplicateCheck(['key'], memory_budget=0)  # every chunk is spilled to disk
+        keys = list(range(3 * duplicates.MAX_DISK_RUNS)) + [5, 0, 3 * duplicates.MAX_DISK_RUNS - 1]
+        errors = []
+        for row, key in enumerate(keys):
+            errors.extend(check.get_errors(pd.DataFrame({'key': [str(key)]}, index=[row])))
+        self.assertLess(len(check.disk_runs), duplicates.MAX_DISK_RUNS)
+        self.assertEqual([(e.row, e.message) for e in errors],
+                         [(24, 'is a duplicate of row 5'), (25, 'is a duplicate of row 0'),
+                          (26, 'is a duplicate of row 23')])
+        check.finish()
+        # merged a few keys of each run at a time, the runs are merged as if they were all in memory
+        runs = [duplicates.sort_run(np.array(h1, dtype=np.uint64), np.array(h2, dtype=np.uint64),
+                                    np.array(rows, dtype=np.int64))
+                for h1, h2, rows in [([3, 1, 1, 7], [0, 2, 1, 0], [0, 1, 2, 3]), ([1, 9], [1, 0], [4, 5]),
+                                     ([2, 2, 3, 8, 1], [5, 4, 0, 0, 2], [6, 7, 8, 9, 10])]]
+        paths = [os.path.join(self.test_storepath, name + '.npy') for name in ['h1', 'h2', 'row']]
+        duplicates.merge_disk_runs(runs, paths, block=2)
+        for merged, expected in zip(duplicates.load_run(paths), duplicates.merge_runs(runs)):
+            self.assertEqual(merged.tolist(), expected.tolist())
+
+    def test_pipeline_stops_cleanly(self):
+        closed = []
+
+        def numbers():
+            try:
+                for i in range(100):
+                    yield i
+                raise ValueError("unreadable")
+            finally:
+                closed.append(True)
+
+        items = pipeline.prefetch(numbers(), depth=2)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(closed, [True])
+        with self.assertRaises(ValueError):
+            list(pipeline.prefetch(numbers(), depth=2))
+        written = []
+        with self.assertRaises(ZeroDivisionError):
+            with pipeline.background(lambda n: written.append(1 / n), depth=1) as write:
+                for n in [1, 2, 0, 4]:
+                    write(n)
+        self.assertEqual(written, [1, 0.5])
+
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv.gz")
+        setup_file = prep.SSTestFile(filename="test_file.tsv")
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, 2, 3, 0.4]
+        setup_file.prep_test_file()
+        with open(os.path.join(self.test_storepath, "test_file.tsv"), 'rb') as f, gzip.open(test_filepath, 'wb') as gz:
+            gz.write(f.read())
+        validator = v.Validator(test_filepath, logfile=test_filepath + ".LOG", error_limit=1, chunksize=1)
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.rows_scanned, 2)
+        validator.close()
+        self.assertEqual([t.name for t in threading.enumerate() if t.name.startswith('ss-validate-')], [])
+
+    def test_memory_budget(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, -1.0, 0.1, 100]
+        setup_file.prep_test_file()
+        full = v.Validator(test_filepath, logfile=logfile, chunksize=2)
+        full.validate_data()
+        validator = v.Validator(test_filepath, logfile=logfile, chunksize=2, dropbad=True, memory_budget=100)
+        validator.governor.min_chunk_rows = 1
+        validator.governor.measure = lambda: 90  # over the high water mark but within the budget
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.governor.chunk_rows, 1)
+        self.assertEqual(validator.errors.nspilled, 2)
+        self.assertEqual(validator.rows_to_drop.nspilled, 2)
+        self.assertEqual(validator.rows_to_drop, [1, 3])
+        self.assertEqual([str(e) for e in validator.errors], [str(e) for e in full.errors])
+        validator.write_valid_lines_to_file()
+        with open(test_filepath + ".valid") as f:
+            self.assertEqual(len(f.readlines()), 3)
+        validator = v.Validator(test_filepath, logfile=logfile, chunksize=2, memory_budget=100)
+        validator.governor.min_chunk_rows = 1
+        validator.governor.measure = lambda: 110
+        with self.assertRaises(MemoryBudgetExceeded):
+            validator.validate_data()
+        rows = RowLog()
+        added = [5, 3, 9, 3, 0, 7, 5] + list(range(100, 100 + 2 * memory.MAX_ROW_RUNS)) + [9, 12]
+        for row in added:
+            rows.add(row)
+            rows.spill()  # a run for every row, merged as they accumulate
+        # 22 runs of one row: two merged runs of MAX_ROW_RUNS rows and the 6 spilled since
+        self.assertEqual(rows.levels, [1, 1, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(list(rows), list(dict.fromkeys(added)))
+        self.assertEqual(rows.among(range(13)).tolist(), [0, 3, 5, 7, 9, 12])
+        rows.append(13)
+        rows.append(5)
+        self.assertEqual((rows[0], rows[6], rows[-1]), (5, 101, 13))  # spilled, spilled and in memory
+        self.assertEqual(rows[-3:], [115, 12, 13])
+        self.assertEqual(len(rows), len(set(added)) + 1)
+        self.assertRaises(TypeError, hash, rows)
+        runs = [np.array(run, dtype=np.int64) for run in [[1, 4, 9], [0, 2, 3, 10, 11], [5], [6, 7, 8]]]
+        path = os.path.join(self.test_storepath, 'rows.npy')
+        memory.merge_sorted_runs(runs, path, block=2)
+        self.assertEqual(np.load(path).tolist(), list(range(12)))
+
+    def test_engines_agree_with_reference(self):
+        engines = ['reference', 'plain', 'small_chunks', 'incremental', 'memory_governed']
+        report = differential.run_harness(nrows=300, seeds=[0], engines=engines)
+        self.assertEqual(report.divergences, [])
+        self.assertEqual(report.failures, [])
+        self.assertEqual(report.rows['incremental'], 4 * 300)  # plain and gzip, with and without zero_pvalues
+
+        @differential.engine('drops_last_error')
+        def drops_last_error(file, zero_pvalues, workdir):
+            found = differential.reference_engine(file, zero_pvalues, workdir)
+            return found._replace(errors=found.errors[:-1])
+        try:
+            report = differential.run_harness(nrows=300, seeds=[0], engines=['drops_last_error'], zero_pvalues=[False])
+        finally:
+            del differential.ENGINES['drops_last_error']
+        self.assertFalse(report.ok)
+        self.assertEqual({(d.engine, d.field) for d in report.divergences}, {('drops_last_error', 'errors')})
+
+    @unittest.skipUnless(kernels.available(), "needs numba")
+    def test_jit_kernels_match_validations(self):
+        values = (differential.FLOAT_EDGES + differential.PVALUE_EDGES + differential.INT_EDGES +
+                  differential.ALLELE_EDGES + differential.RSID_EDGES +
+                  ['0.000000000000000001', '0.00000000000000001e5', '1.00000000000000001', '999999999.0000000001',
+                   '1e-300', '9e307', '12345678901234567890', '000000000000000000001', '1000e1000', np.nan])
+        df = pd.DataFrame({'cell': values})
+        validations = [validation for field in SCHEMA['fields'].values() for validation in field['validation']]
+        validations.append(v.p_value_validation_allow_zero)
+        schema = v.Schema([v.Column('cell', validations)])
+        verdicts = kernels.chunk_verdicts(df, schema)
+        self.assertGreater(len(verdicts), 20)
+        for (column, i), verdict in verdicts.items():
+            expected = np.asarray(validations[i].validate(df['cell']), dtype=bool)
+            self.assertEqual(df['cell'][verdict != expected].tolist(), [], validations[i].message)
+
+    def test_cross_field_rules(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['VAR_ID']['label']] = \
+            ["1_1118275_G_A", "1_1120431_C_CCG", "2_49129966_C_T", "25_48480252_TTT_T"]
+        setup_file.test_data_dict[SCHEMA['fields']['NEG_LOG_PVAL']['label']] = ["0.3129", "14.4214", "1.2229", "1"]
+        setup_file.prep_test_file()
+        validator = v.Validator(test_filepath, logfile=logfile)
+        self.assertTrue(validator.validate_data())
+        validator = v.Validator(test_filepath, logfile=logfile, chunksize=2, cross_field=True)
+        self.assertFalse(validator.validate_data())
+        self.assertEqual(validator.rows_to_drop, [1, 2, 3])
+        self.assertEqual([(e.row, e.column, e.rule) for e in validator.errors],
+                         [(1, 'beta', 'effect_in_confidence_interval'),
+                          (2, 'variant_id', 'variant_id_matches_position'),
+                          (3, 'neg_log_10_p_value', 'p_values_agree')])
+
+    def test_distinct_value_validation_matches_cell_by_cell(self):
+        pattern = '^LONG_STRING$|^[ACTGactg]+$'
+        validation = match_regex(pattern)
+        validation.cache_size = 2
+        for values in [['A', 'C', 'A', 'x', np.nan, 'A', 'C', 'A'],
+                       ['x', 'TT', 'x', 'A', 'TT', 'x', np.nan, np.nan],
+                       ['rs1', 'rs2', 'rs3', 'A']]:  # mostly distinct, validated cell by cell
+            series = pd.Series(values, dtype=object, index=range(10, 10 + len(values)))
+            self.assertTrue(validation.validate(series).equals(MatchesPatternValidation(pattern).validate(series)))
+        self.assertLessEqual(len(validation._verdicts), 2)
+
+    def test_sharded_validation_matches_local(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        for label, values in setup_file.test_data_dict.items():
+            setup_file.test_data_dict[label] = values * 50
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']][17] = 2
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']][150] = -1
+        setup_file.prep_test_file()
+        with open(test_filepath, 'rb') as f:
+            lines = f.readlines()
+        lines[40] = lines[40].replace(b'\t', b'', 1)  # a ragged row
+        lines[90:90] = [b'# a comment\n']
+        with open(test_filepath, 'wb') as f:
+            f.writelines(lines)
+        with open(test_filepath + ".gz", 'wb') as f:
+            for i in range(0, len(lines), 7):
+                f.write(bgzf_block(b''.join(lines[i:i + 7])))
+            f.write(bgzf_block(b''))
+        def validate_sharded(filepath, shard_size, **kwargs):
+            coordinator = Coordinator(filepath, shard_size=shard_size)
+            self.assertGreater(len(coordinator.shards), 3)
+            workers = [subprocess.Popen([sys.executable, "-m", "ss_validate.validator", "--worker", coordinator.url,
+                                         "--token", coordinator.token, "-f", filepath, "--logfile", logfile])
+                       for _ in range(2)]
+            try:
+                sharded = v.Validator(filepath, logfile=logfile, coordinator=coordinator, **kwargs)
+                self.assertFalse(sharded.validate_file_squareness())
+                sharded.validate_data()
+            finally:
+                coordinator.close()
+                for worker in workers:
+                    worker.wait(timeout=60)
+            return sharded
+
+        for filepath, shard_size in [(test_filepath, 1000), (test_filepath + ".gz", 200)]:
+            logfile = filepath + ".LOG"
+            local = v.Validator(filepath, logfile=logfile, qc_stats=True)
+            local.validate_file_squareness()
+            local.validate_data()
+            sharded = validate_sharded(filepath, shard_size, qc_stats=True)
+            self.assertEqual(sharded.nrows, 200)
+            self.assertEqual(sharded.row_index.ragged_lines(), local.row_index.ragged_lines())
+            self.assertEqual(sharded.row_index.line(range(200)).tolist(), local.row_index.line(range(200)).tolist())
+            self.assertEqual([(e.row, e.column, e.value) for e in sharded.errors],
+                             [(e.row, e.column, e.value) for e in local.errors])
+            self.assertEqual(sharded.rows_to_drop, [17, 39, 150])
+            qc, local_qc = sharded.qc.summary(), local.qc.summary()
+            for field in ['p_value', 'effect_allele_frequency']:
+                self.assertAlmostEqual(qc[field].pop('mean'), local_qc[field].pop('mean'))
+            self.assertEqual(qc, local_qc)
+            self.assertEqual(sharded.row_index.fetch(120), local.row_index.fetch(120))
+            # the error limit is reached in the first chunk of 100 rows, which has another error in a later shard
+            local = v.Validator(filepath, logfile=logfile, error_limit=1, chunksize=100)
+            local.validate_file_squareness()
+            local.validate_data()
+            sharded = validate_sharded(filepath, shard_size, error_limit=1, chunksize=100)
+            self.assertEqual([(e.row, e.column) for e in sharded.errors], [(e.row, e.column) for e in local.errors])
+            self.assertEqual(sharded.rows_to_drop, [17, 39])
+            self.assertEqual(sharded.rows_scanned, local.rows_scanned)
+            # a shard can hold nothing but a short row
+            self.assertEqual(local.parse_rows(lines[40], 39).index.tolist(), [39])
+        # the coordinator refuses requests without its token, and gives up without workers
+        coordinator = Coordinator(test_filepath, shard_size=1000, worker_timeout=2)
+        sharded = v.Validator(test_filepath, logfile=test_filepath + ".LOG", coordinator=coordinator)
+        square = []
+        waiting = threading.Thread(target=lambda: square.append(sharded.validate_file_squareness()))
+        waiting.start()
+        try:
+            with self.assertRaises(urllib.error.HTTPError) as refused:
+                urllib.request.urlopen(coordinator.url + '/task', timeout=10)
+            self.assertEqual(refused.exception.code, 403)
+        finally:
+            waiting.join()
+            coordinator.close()
+        self.assertEqual(square, [False])
+
+    @unittest.skipIf(mock_aws is None, "needs boto3 and moto")
+    def test_validate_file_in_s3(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        for label, values in setup_file.test_data_dict.items():
+            setup_file.test_data_dict[label] = values * 25
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']][17] = 2
+        setup_file.prep_test_file()
+        with open(test_filepath, 'rb') as f:
+            data = f.read()
+        settings = dict(storage.SETTINGS)
+        cwd = os.getcwd()
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        try:
+            # small blocks, so that reads cross blocks and are prefetched
+            storage.configure(block_size=500, prefetch=3, cache_dir=os.path.abspath(self.test_storepath + "/cache"))
+            with mock_aws():
+                s3 = boto3.client('s3')
+                s3.create_bucket(Bucket='sumstats')
+                s3.put_object(Bucket='sumstats', Key='in/test_file.tsv', Body=data)
+                s3.put_object(Bucket='sumstats', Key='in/test_file.tsv.gz', Body=gzip.compress(data))
+                os.chdir(self.test_storepath)
+                local = v.Validator("test_file.tsv", logfile="test_file.LOG", dropbad=True)
+                local.validate_file_squareness()
+                local.validate_data()
+                for name in ["test_file.tsv", "test_file.tsv.gz"]:
+                    validator = v.Validator("s3://sumstats/in/" + name, logfile="test_file.LOG", dropbad=True)
+                    self.assertTrue(validator.validate_file_extension())
+                    self.assertTrue(validator.validate_headers())
+                    self.assertTrue(validator.validate_file_squareness())
+                    self.assertFalse(validator.validate_data())
+                    self.assertEqual(validator.nrows, 100)
+                    self.assertEqual([str(e) for e in validator.errors], [str(e) for e in local.errors])
+                    self.assertEqual(validator.row_index.fetch(60), local.row_index.fetch(60))
+                    validator.write_valid_lines_to_file()
+                    with open(name + ".valid") as f:
+                        self.assertEqual(len(f.readlines()), 100)
+                self.assertGreater(len(os.listdir("cache")), 0)
+                # every block is now in the cache, so the object is not read again
+                get = storage.S3Object.get
+                storage.S3Object.get = lambda obj, start, end: self.fail("read a cached block")
+                try:
+                    validator = v.Validator("s3://sumstats/in/test_file.tsv", logfile="test_file.LOG")
+                    self.assertFalse(validator.validate_data())
+                finally:
+                    storage.S3Object.get = get
+                # a new version of the object is looked up when it is opened again, not read from the cache
+                s3.put_object(Bucket='sumstats', Key='in/test_file.tsv', Body=b''.join(data.splitlines(True)[:11]))
+                validator = v.Validator("s3://sumstats/in/test_file.tsv", logfile="test_file.LOG")
+                self.assertTrue(validator.validate_data())
+                self.assertEqual(validator.nrows, 10)
+                cache = storage.BlockCache(os.path.abspath("cache2"), size=0.002)
+                for block in range(5):
+                    cache.put(os.path.join(cache.directory, str(block)), b'x' * 500)
+                self.assertEqual((cache.total, sorted(os.listdir("cache2"))), (2000, ['1', '2', '3', '4']))
+        finally:
+            os.chdir(cwd)
+            storage.SETTINGS.update(settings)
+            storage._client = None
+
     def test_drop_bad_rows_does_not_drop_good_lines(self):
         test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
         logfile=test_filepath.replace('tsv', 'LOG')
@@ -359,6 +979,116 @@ class BasicTestCase(unittest.TestCase):
         valid_data = validator.validate_data()
         self.assertTrue(valid_data)
 
+    def test_drop_bad_rows_to_sorted_bgzipped_file(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = ["2", "1", "25", "1"]
+        setup_file.test_data_dict[SCHEMA['fields']['BP']['label']] = [5, 200000, 3, 100000]
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, 0.2, -1, 0.3]
+        setup_file.prep_test_file()
+        for sort_memory in [1024, 0]:  # 0 sorts every chunk on disk and merges them
+            validator = v.Validator(file=test_filepath, logfile=logfile, chunksize=1, sort_memory=sort_memory)
+            self.assertFalse(validator.validate_data())
+            validator.write_sorted_valid_lines_to_file()
+            with gzip.open(test_filepath + ".valid.gz", 'rt') as f:
+                rows = [line.split('\t')[:2] for line in f]
+            self.assertEqual(rows, [['chromosome', 'base_pair_location'], ['1', '100000'], ['1', '200000'], ['2', '5']])
+            with gzip.open(test_filepath + ".valid.gz.tbi", 'rb') as f:
+                tbi = f.read()
+            self.assertEqual(tbi[:4], b'TBI\x01')
+            self.assertEqual(tbi[36:40], b'1\x002\x00')  # the sequence names, after the header
+
+    def test_sorting_rows_without_a_position(self):
+        from ss_validate.sorting import SortedTableWriter, LINE_OVERHEAD
+        path = os.path.join(self.test_storepath, "test_file.tsv.valid.gz")
+        df = pd.DataFrame({'chromosome': ['2', 'X', '1', '1.0'], 'base_pair_location': ['5', '7', 'NA', '3']})
+        for sort_memory in [1024, 0]:
+            writer = SortedTableWriter(path, columns=df.columns, chr_col='chromosome',
+                                       bp_col='base_pair_location', memory_budget=sort_memory)
+            writer.add(df)
+            if sort_memory:
+                lines = ['2\t5', '1.0\t3']
+                self.assertEqual(writer.buffered_bytes, 2 * 16 + sum(map(len, lines)) + 2 * LINE_OVERHEAD)
+            writer.close()
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual(f.read().splitlines(), ['chromosome\tbase_pair_location', '1.0\t3', '2\t5'])
+            with open(writer.unplaced_path) as f:
+                self.assertEqual(f.read().splitlines(), ['chromosome\tbase_pair_location', 'X\t7', '1\tNA'])
+            self.assertEqual(writer.unplaced, 2)
+
+    def test_typed_output_of_good_rows(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = ["2", "1", "25", "1"]
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = ["1e-400", 0.2, -1, 0.3]
+        setup_file.prep_test_file()
+        validator = v.Validator(file=test_filepath, logfile=logfile, chunksize=1)
+        self.assertFalse(validator.validate_data())
+        validator.write_typed_valid_lines_to_file('parquet')
+        table = pq.read_table(test_filepath + ".valid.parquet")
+        self.assertEqual(table.schema.field('chromosome').type, pa.int64())
+        self.assertEqual(table.schema.field('beta').type, pa.float64())
+        self.assertEqual(table.column('chromosome').to_pylist(), [2, 1, 1])
+        self.assertEqual(table.column('p_value').to_pylist(), ['1e-400', '0.2', '0.3'])
+        validator.write_typed_valid_lines_to_file('arrow')
+        with pa.ipc.open_file(test_filepath + ".valid.arrow") as f:
+            self.assertTrue(f.read_all().equals(table))
+        validator.write_typed_valid_lines_to_file('parquet', partition=True)
+        self.assertEqual(sorted(os.listdir(test_filepath + ".valid.parquet")), ['chromosome=1', 'chromosome=2'])
+        part = pq.ParquetFile(os.path.join(test_filepath + ".valid.parquet", 'chromosome=1', 'part-0.parquet'))
+        self.assertEqual(part.metadata.num_rows, 2)
+        self.assertNotIn('chromosome', part.schema_arrow.names)
+        # rows past the error limit aren't validated, and are left out if their values don't fit
+        from ss_validate.arrowtable import TypedTableWriter
+        df = pd.DataFrame({'chromosome': ['1', '1.5', 'abc', '2'], 'beta': ['0.1', '0.2', '0.3', None]})
+        writer = TypedTableWriter(test_filepath + ".valid.parquet", columns=df.columns, schema=SCHEMA)
+        writer.add(df)
+        writer.close()
+        self.assertEqual(writer.dropped, 2)
+        table = pq.read_table(test_filepath + ".valid.parquet")
+        self.assertEqual(table.column('chromosome').to_pylist(), [1, 2])
+        self.assertEqual(table.column('beta').to_pylist(), [0.1, None])
+
+    def test_split_by_chromosome(self):
+        test_filepath = os.path.join(self.test_storepath, "test_file.tsv")
+        logfile = test_filepath.replace('tsv', 'LOG')
+        setup_file = prep.SSTestFile()
+        setup_file.set_test_data_dict()
+        setup_file.test_data_dict[SCHEMA['fields']['CHR']['label']] = ["2", "1", "X", "1"]
+        setup_file.test_data_dict[SCHEMA['fields']['BP']['label']] = [5, 200000, 3, 100000]
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, 0.2, 0.3, -1]
+        setup_file.prep_test_file()
+        serial = v.Validator(file=test_filepath, logfile=logfile, dropbad=True, chunksize=1)
+        self.assertFalse(serial.validate_data())
+        with open(test_filepath + ".chr7.valid", 'w') as f:
+            f.write("left by an earlier run\n")
+        validator = v.Validator(file=test_filepath, logfile=logfile, dropbad=True, chunksize=1,
+                                split_by_chromosome=True, processes=2)
+        self.assertFalse(validator.validate_data())
+        self.assertFalse(os.path.exists(test_filepath + ".chr7.valid"))
+        self.assertEqual([(e.row, e.column) for e in validator.errors], [(e.row, e.column) for e in serial.errors])
+        self.assertEqual(sorted(validator.rows_to_drop), [2, 3])
+        for chromosome, positions in [('1', ['200000']), ('2', ['5'])]:
+            with open("{}.chr{}.valid".format(test_filepath, chromosome)) as f:
+                self.assertEqual([line.split('\t')[1] for line in f], ['base_pair_location'] + positions)
+        self.assertFalse(os.path.exists(test_filepath + ".chrother.valid"))
+        self.assertEqual(validator.partitions.summary['1']['rows'], 2)
+        self.assertEqual(validator.partitions.summary['1']['unsorted_rows'], 0)
+
+        setup_file.test_data_dict[SCHEMA['fields']['PVAL']['label']] = [0.1, 0.2, 0.3, 0.4]
+        setup_file.prep_test_file()
+        validator = v.Validator(file=test_filepath, logfile=logfile, dropbad=True, chunksize=1,
+                                split_by_chromosome=True, processes=2)
+        validator.validate_data()
+        self.assertEqual(validator.partitions.summary['1']['unsorted_rows'], 1)
+        self.assertEqual(validator.partitions.summary['1']['first_unsorted_row'], 3)
+
     def test_drop_bad_rows_drops_bad_rows_even_with_linelimit(self):
         test_filename = "test_file.tsv"
         test_filepath = os.path.join(self.test_storepath, test_filename)